@@ -133,7 +133,10 @@ class GlueJobStack(Stack):
         glue_assets=glue_assets_s3_bucket_name),
       #XXX: enable the Iceberg framework.
       # For more informatio, see https://docs.aws.amazon.com/glue/latest/dg/aws-glue-programming-etl-format-iceberg.html#aws-glue-programming-etl-format-iceberg-enable
-      "--datalake-formats": "iceberg"
+      "--datalake-formats": "iceberg",
+      #XXX: The MERGE helpers shared with the streaming jobs, see ../streaming-etl/common
+      "--extra-py-files": "s3://{glue_assets}/scripts/streaming_batch_helpers.py".format(
+        glue_assets=glue_assets_s3_bucket_name)
     }
 
     glue_job_default_arguments.update(glue_job_input_arguments)
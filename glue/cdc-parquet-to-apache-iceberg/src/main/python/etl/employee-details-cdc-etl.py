@@ -2,9 +2,13 @@
 # -*- encoding: utf-8 -*-
 #vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
 
+import boto3
+import json
 import sys
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 import traceback
+from urllib.parse import urlparse
 
 from awsglue.transforms import *
 from awsglue.utils import getResolvedOptions
@@ -14,16 +18,22 @@ from awsglue.job import Job
 from awsglue.dynamicframe import DynamicFrame
 
 from pyspark.conf import SparkConf
-from pyspark.sql.window import Window
+from pyspark.sql.types import StructType
 from pyspark.sql.functions import (
   concat,
   col,
+  count,
+  countDistinct,
+  expr,
+  input_file_name,
   lit,
-  max,
-  rank,
-  to_timestamp
+  struct,
+  to_timestamp,
+  when
 )
 
+from streaming_batch_helpers import buildCombinedMergeQuery, buildMergePruningPredicate, getOptionalResolvedOptions
+
 # Define Glue job arguments from Glue job parameters
 args = getResolvedOptions(sys.argv, ['JOB_NAME',
   'raw_s3_path',
@@ -35,6 +45,26 @@ args = getResolvedOptions(sys.argv, ['JOB_NAME',
   'partition_key',
   'lock_table_name'])
 
+args.update(getOptionalResolvedOptions(sys.argv, {
+  'merge_mode': 'combined',
+  'merge_pruning_key_range': 'true',
+  'merge_pruning_partition_columns': '',
+  'merge_pruning_max_values': '1000',
+  'incremental_mode': 'bookmark',
+  'manifest_s3_path': '',
+  'manifest_lookback_minutes': '60',
+  'raw_keys_time_ordered': 'false',
+  'input_max_partition_mb': '128',
+  'dedup_tiebreak_columns': '',
+  'TempDir': '',
+  'lock_acquire_interval_ms': '',
+  'lock_acquire_timeout_ms': '',
+  'commit_retry_num_retries': '',
+  'commit_retry_min_wait_ms': '',
+  'commit_retry_max_wait_ms': '',
+  'commit_retry_total_timeout_ms': ''
+}))
+
 # Examples of Glue Job Parameters
 # raw_s3_path : s3://aws-glue-input-parquet-atq4q5u/cdc-load/
 # iceberg_s3_path : s3://aws-glue-output-iceberg-atq4q5u
@@ -44,6 +74,22 @@ args = getResolvedOptions(sys.argv, ['JOB_NAME',
 # primary_key : emp_no
 # partition_key : department
 # lock_table_name : employee_details_lock
+# merge_mode : combined (optional, one of 'combined' or 'separate')
+# merge_pruning_key_range : true (optional)
+# merge_pruning_partition_columns : (optional, comma-separated partition columns whose values never change for a primary key)
+# merge_pruning_max_values : 1000 (optional)
+# incremental_mode : bookmark (optional, one of 'bookmark' or 'manifest')
+# manifest_s3_path : s3://aws-glue-assets-123456789012-us-east-1/temporary/employee-details-cdc-etl/cdc-manifest.json (optional, default: under TempDir)
+# manifest_lookback_minutes : 60 (optional)
+# raw_keys_time_ordered : false (optional)
+# input_max_partition_mb : 128 (optional)
+# dedup_tiebreak_columns : (optional, comma-separated columns ordering the changes of a primary key with the same m_time, e.g. a change sequence number)
+# lock_acquire_interval_ms : 5000 (optional, default: Iceberg's)
+# lock_acquire_timeout_ms : 180000 (optional, default: Iceberg's)
+# commit_retry_num_retries : 4 (optional, default: the table property or Iceberg's)
+# commit_retry_min_wait_ms : 100 (optional, default: the table property or Iceberg's)
+# commit_retry_max_wait_ms : 60000 (optional, default: the table property or Iceberg's)
+# commit_retry_total_timeout_ms : 1800000 (optional, default: the table property or Iceberg's)
 
 # Set variables
 RAW_S3_PATH = args.get("raw_s3_path")
@@ -54,6 +100,40 @@ TABLE_NAME = args.get("table_name")
 PK = args.get("primary_key")
 PARTITION = args.get("partition_key")
 DYNAMODB_LOCK_TABLE = args.get("lock_table_name")
+MERGE_MODE = args.get("merge_mode")
+MERGE_PRUNING_KEY_RANGE = args.get("merge_pruning_key_range").lower() == 'true'
+#XXX: Only list partition columns whose values never change for a primary key,
+# otherwise an update moving a row to another partition is inserted as a new row.
+MERGE_PRUNING_PARTITION_COLUMNS = [c.strip() for c in args.get("merge_pruning_partition_columns").split(',') if c.strip()]
+MERGE_PRUNING_MAX_VALUES = int(args.get("merge_pruning_max_values"))
+INCREMENTAL_MODE = args.get("incremental_mode")
+if INCREMENTAL_MODE not in ('bookmark', 'manifest'):
+  raise ValueError(f"Unsupported incremental_mode: {INCREMENTAL_MODE}")
+MANIFEST_S3_PATH = args.get("manifest_s3_path") or \
+  (f"{args['TempDir'].rstrip('/')}/{args['JOB_NAME']}/cdc-manifest.json" if args.get("TempDir") else '')
+if INCREMENTAL_MODE == 'manifest' and not MANIFEST_S3_PATH:
+  raise ValueError("manifest_s3_path or TempDir is required with incremental_mode 'manifest'")
+#XXX: Objects last modified this long before the newest processed one are taken as processed,
+# so that the manifest only keeps the keys of recent objects.
+MANIFEST_LOOKBACK = timedelta(minutes=int(args.get("manifest_lookback_minutes")))
+#XXX: Only set it when new objects always get keys that sort after the existing ones, e.g. the timestamped file names of AWS DMS,
+# so that listing starts after the last processed key instead of going through the whole history.
+RAW_KEYS_TIME_ORDERED = args.get("raw_keys_time_ordered").lower() == 'true'
+INPUT_MAX_PARTITION_BYTES = int(args.get("input_max_partition_mb")) * 1024 * 1024
+DEDUP_TIEBREAK_COLUMNS = [c.strip() for c in args.get("dedup_tiebreak_columns").split(',') if c.strip()]
+
+#XXX: Empty values keep the defaults of Iceberg, i.e. the DynamoDB lock is tried every 5 seconds for up to 3 minutes,
+# and a commit that conflicts with another writer is retried 4 times, waiting from 100 ms up to 60 seconds in between.
+LOCK_ACQUIRE_PROPERTIES = {
+  'lock.acquire-interval-ms': args['lock_acquire_interval_ms'],
+  'lock.acquire-timeout-ms': args['lock_acquire_timeout_ms']
+}
+COMMIT_RETRY_PROPERTIES = {
+  'commit.retry.num-retries': args['commit_retry_num_retries'],
+  'commit.retry.min-wait-ms': args['commit_retry_min_wait_ms'],
+  'commit.retry.max-wait-ms': args['commit_retry_max_wait_ms'],
+  'commit.retry.total-timeout-ms': args['commit_retry_total_timeout_ms']
+}
 
 # Set the Spark Configuration of Apache Iceberg. You can refer the Apache Iceberg Connector Usage Instructions.
 def set_spark_iceberg_conf() -> SparkConf:
@@ -66,10 +146,128 @@ def set_spark_iceberg_conf() -> SparkConf:
   conf.set(f"spark.sql.catalog.glue_catalog.io-impl", "org.apache.iceberg.aws.s3.S3FileIO")
   conf.set(f"spark.sql.catalog.glue_catalog.lock-impl", "org.apache.iceberg.aws.glue.DynamoLockManager")
   conf.set(f"spark.sql.catalog.glue_catalog.lock.table", DYNAMODB_LOCK_TABLE)
+  for key, value in LOCK_ACQUIRE_PROPERTIES.items():
+    if value:
+      conf.set(f"spark.sql.catalog.glue_catalog.{key}", value)
   conf.set("spark.sql.iceberg.handle-timestamp-without-timezone","true")
 
   return conf
 
+def build_merge_condition(source_df, primary_key) -> str:
+  merge_condition = f"s.{primary_key} = t.{primary_key}"
+  pruning_predicate = buildMergePruningPredicate(source_df, primary_key,
+    MERGE_PRUNING_PARTITION_COLUMNS,
+    key_range=MERGE_PRUNING_KEY_RANGE,
+    max_values=MERGE_PRUNING_MAX_VALUES)
+  return f"{merge_condition} AND {pruning_predicate}" if pruning_predicate else merge_condition
+
+def deduplicate_cdc(cdc_df, primary_key, order_column='m_time', tiebreak_columns=None, op_column='Op'):
+  '''Keep the latest change of every primary key
+
+  max_by() picks it with a single aggregation, i.e. one shuffle and no sort of the changes of each key as a window would need.
+  '''
+  #XXX: Of the changes that share the same timestamp (and tie-break columns), an insert comes first and a delete comes last.
+  op_order = when(col(op_column) == 'I', 0).when(col(op_column) == 'U', 1).when(col(op_column) == 'D', 2)
+  ordering = struct(col(order_column), *[col(c) for c in (tiebreak_columns or [])], op_order.alias('_op_order'))
+  return cdc_df.withColumn('_ordering', ordering) \
+    .groupBy(primary_key) \
+    .agg(expr(f"max_by(struct({', '.join([f'`{c}`' for c in cdc_df.columns])}), _ordering)").alias('_latest')) \
+    .select('_latest.*')
+
+def split_s3_path(s3_path):
+  url = urlparse(s3_path)
+  return url.netloc, url.path.lstrip('/')
+
+def list_raw_files(s3_client, raw_s3_path, start_after=None):
+  '''List the Parquet objects under `raw_s3_path`, as dicts with Key, Size and LastModified'''
+  bucket, prefix = split_s3_path(raw_s3_path)
+  params = {'Bucket': bucket, 'Prefix': prefix}
+  if start_after:
+    params['StartAfter'] = start_after
+  for page in s3_client.get_paginator('list_objects_v2').paginate(**params):
+    for obj in page.get('Contents', []):
+      if obj['Key'].endswith('.parquet'):
+        yield obj
+
+def load_manifest_state(s3_client, manifest_s3_path, raw_s3_path) -> dict:
+  bucket, key = split_s3_path(manifest_s3_path)
+  try:
+    manifest = json.loads(s3_client.get_object(Bucket=bucket, Key=key)['Body'].read())
+  except s3_client.exceptions.NoSuchKey:
+    manifest = {}
+  return manifest.get('raw_paths', {}).get(raw_s3_path, {})
+
+def save_manifest_state(s3_client, manifest_s3_path, raw_s3_path, state):
+  bucket, key = split_s3_path(manifest_s3_path)
+  try:
+    manifest = json.loads(s3_client.get_object(Bucket=bucket, Key=key)['Body'].read())
+  except s3_client.exceptions.NoSuchKey:
+    manifest = {}
+  manifest.setdefault('raw_paths', {})[raw_s3_path] = state
+  s3_client.put_object(Bucket=bucket, Key=key, Body=json.dumps(manifest).encode('utf-8'))
+
+def select_new_raw_files(objects, state, lookback) -> list:
+  '''Pick the objects that are not in the manifest of processed files'''
+  recent_keys = state.get('recent_keys', {})
+  watermark = datetime.fromisoformat(state['watermark']) if state.get('watermark') else None
+  return [obj for obj in objects
+    if obj['Key'] not in recent_keys and (watermark is None or obj['LastModified'] > watermark - lookback)]
+
+def advance_manifest_state(state, processed_objects, lookback) -> dict:
+  '''Add the processed objects to the manifest, and drop the keys that fell behind the watermark'''
+  recent = {k: datetime.fromisoformat(v) for k, v in state.get('recent_keys', {}).items()}
+  recent.update({obj['Key']: obj['LastModified'] for obj in processed_objects})
+  if not recent:
+    return state
+  watermark = sorted(recent.values())[-1]
+  return {
+    'watermark': watermark.isoformat(),
+    'recent_keys': {k: v.isoformat() for k, v in recent.items() if v > watermark - lookback},
+    'last_key': sorted([state.get('last_key', '')] + list(recent))[-1]
+  }
+
+def set_commit_retry_properties(table_ident, retry_properties) -> dict:
+  '''Set the commit retries given as job arguments on the table, and return its properties'''
+  properties = {row['key']: row['value'] for row in spark.sql(f"SHOW TBLPROPERTIES {table_ident}").collect()}
+  changed = {k: v for k, v in retry_properties.items() if v and properties.get(k) != v}
+  if changed:
+    table_properties = ', '.join([f"'{k}' = '{v}'" for k, v in changed.items()])
+    spark.sql(f"ALTER TABLE {table_ident} SET TBLPROPERTIES ({table_properties})")
+  return {**properties, **changed}
+
+def report_commit_contention(table_ident, properties, committed_after, start_time, end_time) -> dict:
+  '''Report the commits of this job run and the commits other writers made while it was merging
+
+  Iceberg 0.13 and 1.0 do not count the attempts of a commit, so the conflict retries are bounded by the commits
+  of other writers before the last commit of this run, each of which can fail one attempt at most.
+  `commit_sec` is the time from the last snapshot of this run to the end of the merge, i.e. the DynamoDB lock wait,
+  metadata write and catalog update of the attempt that succeeded.
+  '''
+  snapshots_df = spark.table(f"{table_ident}.snapshots")
+  if committed_after is not None:
+    snapshots_df = snapshots_df.filter(col('committed_at') > committed_after)
+  app_id = spark.sparkContext.applicationId
+  snapshots = [(row['committed_at'], (row['summary'] or {}).get('spark.app.id'))
+    for row in snapshots_df.orderBy('committed_at').select('committed_at', 'summary').collect()]
+  commit_times = [committed_at for committed_at, snapshot_app_id in snapshots if snapshot_app_id == app_id]
+  conflicting_commits = len([committed_at for committed_at, snapshot_app_id in snapshots
+    if snapshot_app_id != app_id and commit_times and committed_at < commit_times[-1]])
+  max_retries = min(conflicting_commits, int(properties.get('commit.retry.num-retries', 4)) * len(commit_times))
+
+  report = {
+    'event': 'iceberg_commit_contention',
+    'table': table_ident,
+    'commits': len(commit_times),
+    'concurrent_commits': len(snapshots) - len(commit_times),
+    'max_conflict_retries': max_retries,
+    'max_commit_attempts': len(commit_times) + max_retries,
+    'write_sec': end_time - start_time,
+    'commit_sec': max(end_time - commit_times[-1].timestamp(), 0.0) if commit_times else None,
+    'retry_properties': {k: properties[k] for k in COMMIT_RETRY_PROPERTIES if k in properties}
+  }
+  print(json.dumps(report))
+  return report
+
 # Set the Spark + Glue context
 conf = set_spark_iceberg_conf()
 glueContext = GlueContext(SparkContext(conf=conf))
@@ -79,95 +277,179 @@ job = Job(glueContext)
 job.init(args['JOB_NAME'], args)
 
 # Read data from S3 location where is cdc-loaded by DMS
-cdcDynamicFrame = glueContext.create_dynamic_frame_from_options(
-  connection_type='s3',
-  connection_options={
-    'paths': [f'{RAW_S3_PATH}'],
-    'groupFiles': 'none',
-    'recurse': True
-  },
-  format='parquet',
-  transformation_ctx='cdcDyf')
-
-print(f"Count of CDC data after last job bookmark:{cdcDynamicFrame.count()}")
-
-if cdcDynamicFrame.count() == 0:
-  print(f"No Data changed.")
+list_start_time = time.monotonic()
+if INCREMENTAL_MODE == 'manifest':
+  #XXX: Find the new files from the manifest of processed S3 keys, so that a run lists and reads only what arrived since the last one.
+  s3_client = boto3.client('s3')
+  manifestState = load_manifest_state(s3_client, MANIFEST_S3_PATH, RAW_S3_PATH)
+  listedRawFiles = list(list_raw_files(s3_client, RAW_S3_PATH,
+    start_after=manifestState.get('last_key') if RAW_KEYS_TIME_ORDERED else None))
+  newRawFiles = select_new_raw_files(listedRawFiles, manifestState, MANIFEST_LOOKBACK)
+
+  #XXX: AWS Glue cannot group Parquet files (groupFiles), so let Spark pack the small DMS files
+  # into input partitions of up to `input_max_partition_mb` instead of reading each file as its own task.
+  spark.conf.set("spark.sql.files.maxPartitionBytes", str(INPUT_MAX_PARTITION_BYTES))
+  if newRawFiles:
+    bucket, _ = split_s3_path(RAW_S3_PATH)
+    rawCDCDF = spark.read.option("mergeSchema", "true").parquet(*[f"s3://{bucket}/{obj['Key']}" for obj in newRawFiles])
+  else:
+    rawCDCDF = spark.createDataFrame([], StructType([]))
+  inputStats = {
+    'listed_files': len(listedRawFiles),
+    'files': len(newRawFiles),
+    'bytes': sum([obj['Size'] for obj in newRawFiles])
+  }
 else:
-  cdcDF = cdcDynamicFrame.toDF()
-  cdcDF = cdcDF.withColumn('m_time', to_timestamp(col('m_time')))
-
-  # Apply De-duplication logic on input data, to pickup latest record based on timestamp and operation
-  # For example, emp_no is unique key
-  IDWindowDF = Window.partitionBy(cdcDF.emp_no).orderBy(cdcDF.m_time).rangeBetween(-sys.maxsize, sys.maxsize)
-
-  # Add new columns to capture first and last OP value and what is the latest timestamp
-  inputDFWithTS = cdcDF.withColumn("max_op_date", max(cdcDF.m_time).over(IDWindowDF))
-
-  # Filter out new records that are inserted, then select latest record from existing records and merge both to get deduplicated output 
-  newInsertedDF = inputDFWithTS.filter("m_time=max_op_date").filter("Op='I'")
-  updatedOrDeletedDF = inputDFWithTS.filter("m_time=max_op_date").filter("Op IN ('U', 'D')")
-  finalInputDF = newInsertedDF.unionAll(updatedOrDeletedDF)
-
-  CURRENT_DATETIME = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-  finalInputDF = finalInputDF.withColumn('last_applied_date', to_timestamp(lit(CURRENT_DATETIME)))
-
-  cdcInsertCount = finalInputDF.filter("Op = 'I'").count()
-  cdcUpdateCount = finalInputDF.filter("Op = 'U'").count()
-  cdcDeleteCount = finalInputDF.filter("Op = 'D'").count()
-  totalCDCCount = finalInputDF.count()
-  print(f"Inserted count:  {cdcInsertCount}")
-  print(f"Updated count:   {cdcUpdateCount}")
-  print(f"Deleted count:   {cdcDeleteCount}")
-  print(f"Total CDC count: {totalCDCCount}")
-
-  # Merge CDC data into Iceberg Table
-  dropColumnList = ['Op', 'schema_name', 'table_name', 'max_op_date']
-
-  tablesDF = spark.sql(f"SHOW TABLES IN {CATALOG}.{DATABASE}")
-  table_list = tablesDF.select('tableName').rdd.flatMap(lambda x: x).collect()
-  if f"{TABLE_NAME}" not in table_list:
-    print(f"Table {TABLE_NAME} doesn't exist in {CATALOG}.{DATABASE}.")
+  cdcDynamicFrame = glueContext.create_dynamic_frame_from_options(
+    connection_type='s3',
+    connection_options={
+      'paths': [f'{RAW_S3_PATH}'],
+      'groupFiles': 'none',
+      'recurse': True
+    },
+    format='parquet',
+    transformation_ctx='cdcDyf')
+
+  #XXX: The job bookmark filters the files inside the read, and inputFiles() of a DataFrame converted from
+  # a DynamicFrame is empty, so the files are counted from the file name of each row while the rows are counted.
+  rawCDCDF = cdcDynamicFrame.toDF().withColumn('_input_file', input_file_name())
+  inputStats = {}
+
+discoverySec = time.monotonic() - list_start_time
+inputPartitions = rawCDCDF.rdd.getNumPartitions()
+
+#XXX: Persist the raw CDC data so that counting it does not read the S3 files twice
+rawCDCDF.persist()
+
+try:
+  if INCREMENTAL_MODE == 'bookmark':
+    inputCounts = rawCDCDF.agg(count(lit(1)).alias('rows'), countDistinct('_input_file').alias('files')).collect()[0]
+    cdcCount = inputCounts['rows']
+    inputStats['files'] = inputCounts['files']
   else:
-    # DataFrame for the inserted or updated data
-    upsertedDF = finalInputDF.filter("Op != 'D'").drop(*dropColumnList)
-    if upsertedDF.count() > 0:
-      upsertedDF.createOrReplaceTempView(f"{TABLE_NAME}_upsert")
-      print(f"Table '{TABLE_NAME}' is upserting...")
-      try:
-        spark.sql(f"""MERGE INTO {CATALOG}.{DATABASE}.{TABLE_NAME} t
-          USING {TABLE_NAME}_upsert s ON s.{PK} = t.{PK}
-          WHEN MATCHED THEN UPDATE SET *
-          WHEN NOT MATCHED THEN INSERT *
-          """)
-      except Exception as ex:
-        traceback.print_exc()
-        raise ex
-    else:
-      print("No data to insert or update.")
-
-    # DataFrame for the deleted data
-    deletedDF = finalInputDF.filter("Op = 'D'").drop(*dropColumnList)
-    if deletedDF.count() > 0:
-      deletedDF.createOrReplaceTempView(f"{TABLE_NAME}_delete")
-      print(f"Table '{TABLE_NAME}' is deleting...")
-      try:
-        spark.sql(f"""MERGE INTO {CATALOG}.{DATABASE}.{TABLE_NAME} t
-          USING {TABLE_NAME}_delete s ON s.{PK} = t.{PK}
-          WHEN MATCHED THEN DELETE
-          """)
-      except Exception as ex:
-        traceback.print_exc()
-        raise ex
+    cdcCount = rawCDCDF.count()
+
+  print(json.dumps({
+    'event': 'cdc_input_files',
+    'incremental_mode': INCREMENTAL_MODE,
+    'raw_s3_path': RAW_S3_PATH,
+    **inputStats,
+    'input_partitions': inputPartitions,
+    'discovery_sec': discoverySec
+  }))
+  print(f"Count of CDC data after last job bookmark:{cdcCount}")
+
+  #XXX: Whether the CDC data is in the table, so that its files can be added to the manifest of processed files
+  cdcApplied = False
+  if cdcCount == 0:
+    print(f"No Data changed.")
+    cdcApplied = True
+  else:
+    cdcDF = rawCDCDF.drop('_input_file').withColumn('m_time', to_timestamp(col('m_time')))
+
+    # Apply De-duplication logic on input data, to pickup latest record based on timestamp and operation
+    # For example, emp_no is unique key
+    latestCDCDF = deduplicate_cdc(cdcDF, PK, tiebreak_columns=DEDUP_TIEBREAK_COLUMNS)
+    finalInputDF = latestCDCDF.filter("Op IN ('I', 'U', 'D')")
+
+    CURRENT_DATETIME = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    finalInputDF = finalInputDF.withColumn('last_applied_date', to_timestamp(lit(CURRENT_DATETIME)))
+
+    #XXX: Persist the deduplicated data once and count every operation in a single aggregation,
+    # so that the counts and both MERGE statements do not re-run the window de-duplication.
+    finalInputDF.persist()
+    cdcOpCounts = {row['Op']: row['count'] for row in finalInputDF.groupBy('Op').count().collect()}
+    rawCDCDF.unpersist()
+
+    cdcInsertCount = cdcOpCounts.get('I', 0)
+    cdcUpdateCount = cdcOpCounts.get('U', 0)
+    cdcDeleteCount = cdcOpCounts.get('D', 0)
+    totalCDCCount = sum(cdcOpCounts.values())
+    print(f"Inserted count:  {cdcInsertCount}")
+    print(f"Updated count:   {cdcUpdateCount}")
+    print(f"Deleted count:   {cdcDeleteCount}")
+    print(f"Total CDC count: {totalCDCCount}")
+
+    # Merge CDC data into Iceberg Table
+    dropColumnList = ['Op', 'schema_name', 'table_name']
+
+    tablesDF = spark.sql(f"SHOW TABLES IN {CATALOG}.{DATABASE}")
+    table_list = tablesDF.select('tableName').rdd.flatMap(lambda x: x).collect()
+    if f"{TABLE_NAME}" not in table_list:
+      print(f"Table {TABLE_NAME} doesn't exist in {CATALOG}.{DATABASE}.")
     else:
-      print("No data to delete.")
-
-    # Read data from Apache Iceberg Table
-    spark.sql(f"SELECT * FROM {CATALOG}.{DATABASE}.{TABLE_NAME} limit 5").show()
-    print(f"Total count of {TABLE_NAME} Table Results:\n")
-    countDF = spark.sql(f"SELECT count(*) FROM {CATALOG}.{DATABASE}.{TABLE_NAME}")
-    print(f"{countDF.show()}")
-    print(f"Iceberg data load is completed successfully.")
+      tableIdent = f"{CATALOG}.{DATABASE}.{TABLE_NAME}"
+      tableProperties = set_commit_retry_properties(tableIdent, COMMIT_RETRY_PROPERTIES)
+      committedAfter = spark.sql(f"SELECT max(committed_at) AS committed_at FROM {tableIdent}.snapshots").collect()[0]['committed_at']
+      mergeStartTime = time.time()
+      merge_condition = build_merge_condition(finalInputDF, PK)
+
+      if MERGE_MODE == 'combined':
+        #XXX: A single MERGE makes one Iceberg commit, scans the target table once and
+        # acquires the DynamoDB commit lock once, instead of doing it for upserts and deletes separately.
+        mergeColumnList = [c for c in finalInputDF.columns if c not in dropColumnList]
+        mergeInputDF = finalInputDF.select(mergeColumnList + ['Op'])
+        mergeInputDF.createOrReplaceTempView(f"{TABLE_NAME}_cdc")
+        print(f"Table '{TABLE_NAME}' is merging...")
+        try:
+          spark.sql(buildCombinedMergeQuery(f"{CATALOG}.{DATABASE}.{TABLE_NAME}",
+            f"{TABLE_NAME}_cdc", merge_condition, mergeColumnList, op_column='Op', delete_op='D'))
+        except Exception as ex:
+          traceback.print_exc()
+          raise ex
+      else:
+        # DataFrame for the inserted or updated data
+        upsertedDF = finalInputDF.filter("Op != 'D'").drop(*dropColumnList)
+        if cdcInsertCount + cdcUpdateCount > 0:
+          upsertedDF.createOrReplaceTempView(f"{TABLE_NAME}_upsert")
+          print(f"Table '{TABLE_NAME}' is upserting...")
+          try:
+            spark.sql(f"""MERGE INTO {CATALOG}.{DATABASE}.{TABLE_NAME} t
+              USING {TABLE_NAME}_upsert s ON {merge_condition}
+              WHEN MATCHED THEN UPDATE SET *
+              WHEN NOT MATCHED THEN INSERT *
+              """)
+          except Exception as ex:
+            traceback.print_exc()
+            raise ex
+        else:
+          print("No data to insert or update.")
+
+        # DataFrame for the deleted data
+        deletedDF = finalInputDF.filter("Op = 'D'").drop(*dropColumnList)
+        if cdcDeleteCount > 0:
+          deletedDF.createOrReplaceTempView(f"{TABLE_NAME}_delete")
+          print(f"Table '{TABLE_NAME}' is deleting...")
+          try:
+            spark.sql(f"""MERGE INTO {CATALOG}.{DATABASE}.{TABLE_NAME} t
+              USING {TABLE_NAME}_delete s ON {merge_condition}
+              WHEN MATCHED THEN DELETE
+              """)
+          except Exception as ex:
+            traceback.print_exc()
+            raise ex
+        else:
+          print("No data to delete.")
+
+      report_commit_contention(tableIdent, tableProperties, committedAfter, mergeStartTime, time.time())
+
+      # Read data from Apache Iceberg Table
+      spark.sql(f"SELECT * FROM {CATALOG}.{DATABASE}.{TABLE_NAME} limit 5").show()
+      print(f"Total count of {TABLE_NAME} Table Results:\n")
+      countDF = spark.sql(f"SELECT count(*) FROM {CATALOG}.{DATABASE}.{TABLE_NAME}")
+      print(f"{countDF.show()}")
+      print(f"Iceberg data load is completed successfully.")
+      cdcApplied = True
+
+    finalInputDF.unpersist()
+finally:
+  #XXX: Also release the raw CDC data when there is no change to apply or the MERGE fails.
+  rawCDCDF.unpersist()
+
+if INCREMENTAL_MODE == 'manifest' and cdcApplied and newRawFiles:
+  save_manifest_state(s3_client, MANIFEST_S3_PATH, RAW_S3_PATH,
+    advance_manifest_state(manifestState, newRawFiles, MANIFEST_LOOKBACK))
+  print(f"{len(newRawFiles)} files are added to the manifest {MANIFEST_S3_PATH}.")
 
 job.commit()
 print(f"Glue Job is completed successfully.")
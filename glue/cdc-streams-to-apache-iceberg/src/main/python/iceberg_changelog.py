@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import json
+import sys
+import time
+
+from awsglue.utils import getResolvedOptions
+from awsglue.context import GlueContext
+from awsglue.job import Job
+
+from pyspark.context import SparkContext
+from pyspark.conf import SparkConf
+from pyspark.sql import Row
+from pyspark.sql.utils import AnalysisException
+from pyspark.sql.types import (
+  LongType,
+  StringType,
+  StructField,
+  StructType
+)
+from pyspark.sql.functions import (
+  coalesce,
+  col,
+  desc,
+  lit,
+  struct,
+  when
+)
+
+from streaming_batch_helpers import getOptionalResolvedOptions
+
+
+args = getResolvedOptions(sys.argv, ['JOB_NAME',
+  'catalog',
+  'database_name',
+  'table_name',
+  'primary_key',
+  'iceberg_s3_path',
+  'lock_table_name',
+  'aws_region',
+  'changelog_s3_path'
+])
+
+args.update(getOptionalResolvedOptions(sys.argv, {
+  'start_snapshot_id': '',
+  'end_snapshot_id': '',
+  'max_records_per_file': '1000000'
+}))
+
+CATALOG = args['catalog']
+ICEBERG_S3_PATH = args['iceberg_s3_path']
+DATABASE = args['database_name']
+TABLE_NAME = args['table_name']
+#XXX: e.g., 'trans_id' or 'order_id,line_no'
+PRIMARY_KEYS = [c.strip() for c in args['primary_key'].split(',') if c.strip()]
+DYNAMODB_LOCK_TABLE = args['lock_table_name']
+AWS_REGION = args['aws_region']
+CHANGELOG_S3_PATH = args['changelog_s3_path'].rstrip('/')
+#XXX: Empty start_snapshot_id continues from the end of the last interval written to changelog_s3_path,
+# and empty end_snapshot_id stops at the current snapshot of the table.
+START_SNAPSHOT_ID = int(args['start_snapshot_id']) if args['start_snapshot_id'] else None
+END_SNAPSHOT_ID = int(args['end_snapshot_id']) if args['end_snapshot_id'] else None
+MAX_RECORDS_PER_FILE = int(args['max_records_per_file'])
+
+def setSparkIcebergConf() -> SparkConf:
+  conf_list = [
+    (f"spark.sql.catalog.{CATALOG}", "org.apache.iceberg.spark.SparkCatalog"),
+    (f"spark.sql.catalog.{CATALOG}.warehouse", ICEBERG_S3_PATH),
+    (f"spark.sql.catalog.{CATALOG}.catalog-impl", "org.apache.iceberg.aws.glue.GlueCatalog"),
+    (f"spark.sql.catalog.{CATALOG}.io-impl", "org.apache.iceberg.aws.s3.S3FileIO"),
+    (f"spark.sql.catalog.{CATALOG}.lock-impl", "org.apache.iceberg.aws.glue.DynamoLockManager"),
+    (f"spark.sql.catalog.{CATALOG}.lock.table", DYNAMODB_LOCK_TABLE),
+    ("spark.sql.extensions", "org.apache.iceberg.spark.extensions.IcebergSparkSessionExtensions"),
+    ("spark.sql.iceberg.handle-timestamp-without-timezone", "true")
+  ]
+  spark_conf = SparkConf().setAll(conf_list)
+  return spark_conf
+
+# Set the Spark + Glue context
+conf = setSparkIcebergConf()
+sc = SparkContext(conf=conf)
+glueContext = GlueContext(sc)
+spark = glueContext.spark_session
+job = Job(glueContext)
+job.init(args['JOB_NAME'], args)
+
+#XXX: Rewriting an interval only replaces its own partitions of the changelog, so a failed run can simply be run again.
+spark.conf.set("spark.sql.sources.partitionOverwriteMode", "dynamic")
+
+
+class IcebergChangelog:
+  '''Compute the rows of a table that changed between two of its snapshots, as inserts, updates and deletes
+
+  The `changes` view of Iceberg (`create_changelog_view`) needs Iceberg 1.2 or later, and incremental reads of
+  Iceberg 0.13 and 1.0 (AWS Glue 3.0 and 4.0) only support append snapshots, while the MERGE of the CDC job
+  commits overwrite snapshots. So an interval of append snapshots is read incrementally, and every other interval
+  is computed from the data files its snapshots added and removed (`all_entries`): a copy-on-write MERGE rewrites
+  whole data files, so the rows of the removed files are the old versions of the rows of the added files,
+  and comparing them by primary key leaves the inserted, updated and deleted rows. Intervals with delete files
+  (merge-on-read) compare the whole table at both snapshots instead.
+  '''
+
+  ADDED, DELETED = 1, 2
+
+  def __init__(self, spark, table_ident, primary_keys):
+    self.spark = spark
+    self.table_ident = table_ident
+    self.primary_keys = primary_keys
+
+  def currentSnapshotId(self):
+    rows = self.spark.table(f"{self.table_ident}.history") \
+      .filter(col('is_current_ancestor')) \
+      .orderBy(desc('made_current_at')) \
+      .select('snapshot_id') \
+      .limit(1) \
+      .collect()
+    return rows[0]['snapshot_id'] if rows else None
+
+  def snapshots(self, start_snapshot_id, end_snapshot_id) -> list:
+    '''The snapshots after `start_snapshot_id` up to `end_snapshot_id`, oldest first'''
+    snapshots = {row['snapshot_id']: row for row in self.spark.table(f"{self.table_ident}.snapshots") \
+      .select('snapshot_id', 'parent_id', 'committed_at', 'operation') \
+      .collect()}
+    if end_snapshot_id not in snapshots:
+      raise ValueError(f"Snapshot {end_snapshot_id} is not a snapshot of {self.table_ident}")
+    if start_snapshot_id is None:
+      return [snapshots[end_snapshot_id]]
+
+    interval, snapshot_id = [], end_snapshot_id
+    while snapshot_id != start_snapshot_id:
+      if snapshot_id is None:
+        raise ValueError(f"Snapshot {start_snapshot_id} is not an ancestor of snapshot {end_snapshot_id}")
+      if snapshot_id not in snapshots:
+        #XXX: The manifests of expired snapshots may have been deleted, so their changes cannot be read anymore.
+        raise ValueError(f"Snapshot {snapshot_id} between {start_snapshot_id} and {end_snapshot_id} has expired")
+      interval.append(snapshots[snapshot_id])
+      snapshot_id = snapshots[snapshot_id]['parent_id']
+    return interval[::-1]
+
+  def changedFiles(self, snapshot_ids) -> dict:
+    '''The data files the snapshots added and removed in total, and whether they wrote delete files'''
+    entries = self.spark.table(f"{self.table_ident}.all_entries") \
+      .filter(col('snapshot_id').isin(snapshot_ids) & col('status').isin(self.ADDED, self.DELETED)) \
+      .select('status',
+        col('data_file.content').alias('content'),
+        col('data_file.file_path').alias('file_path'),
+        col('data_file.file_format').alias('file_format')) \
+      .distinct() \
+      .collect()
+    data_files = [e for e in entries if e['content'] == 0]
+    added = set([e['file_path'] for e in data_files if e['status'] == self.ADDED])
+    removed = set([e['file_path'] for e in data_files if e['status'] == self.DELETED])
+    #XXX: A file both added and removed within the interval, e.g. by two micro-batches, never changed the table across it.
+    return {
+      'added': sorted(added - removed),
+      'removed': sorted(removed - added),
+      'file_formats': set([e['file_format'].lower() for e in data_files]),
+      'has_delete_files': any([e['content'] != 0 for e in entries])
+    }
+
+  def read(self, snapshot_id):
+    return self.spark.read.format('iceberg').option('snapshot-id', snapshot_id).load(self.table_ident)
+
+  def _readFiles(self, paths, schema, file_formats):
+    if not paths:
+      return self.spark.createDataFrame([], schema)
+    if len(file_formats) != 1 or not file_formats <= {'parquet', 'orc'}:
+      raise ValueError(f"Cannot read the data files of {self.table_ident} directly: {sorted(file_formats)}")
+    #XXX: The files are read by column name, so a column renamed within the interval is read as null.
+    return self.spark.read.schema(schema).format(next(iter(file_formats))).load(paths)
+
+  def diff(self, before_df, after_df):
+    '''The rows of `after_df` that are not in `before_df` as inserts or updates, and the other way around as deletes'''
+    columns = after_df.columns
+    before_df = before_df.select(*self.primary_keys, struct(*columns).alias('_before'))
+    after_df = after_df.select(*self.primary_keys, struct(*columns).alias('_after'))
+    operation = when(col('_before').isNull(), 'insert') \
+      .when(col('_after').isNull(), 'delete') \
+      .otherwise('update')
+    return before_df.join(after_df, self.primary_keys, 'full_outer') \
+      .filter(~col('_before').eqNullSafe(col('_after'))) \
+      .select(operation.alias('operation'), coalesce(col('_after'), col('_before')).alias('_row')) \
+      .select('operation', '_row.*')
+
+  def changes(self, start_snapshot_id, end_snapshot_id):
+    '''The changed rows with an `operation` column, and a report of how they were computed'''
+    interval = self.snapshots(start_snapshot_id, end_snapshot_id)
+    report = {'snapshots': len(interval), 'end_committed_at': interval[-1]['committed_at']}
+    if start_snapshot_id is None:
+      report['mode'] = 'initial'
+      changes_df = self.read(end_snapshot_id).select(lit('insert').alias('operation'), '*')
+    elif all([s['operation'] == 'append' for s in interval]):
+      report['mode'] = 'append'
+      changes_df = self.spark.read.format('iceberg') \
+        .option('start-snapshot-id', start_snapshot_id) \
+        .option('end-snapshot-id', end_snapshot_id) \
+        .load(self.table_ident) \
+        .select(lit('insert').alias('operation'), '*')
+    else:
+      files = self.changedFiles([s['snapshot_id'] for s in interval])
+      if files['has_delete_files']:
+        report['mode'] = 'full'
+        changes_df = self.diff(self.read(start_snapshot_id), self.read(end_snapshot_id))
+      else:
+        report.update({'mode': 'files', 'added_files': len(files['added']), 'removed_files': len(files['removed'])})
+        schema = self.read(end_snapshot_id).schema
+        changes_df = self.diff(self._readFiles(files['removed'], schema, files['file_formats']),
+          self._readFiles(files['added'], schema, files['file_formats']))
+    return changes_df, report
+
+
+class ChangelogIntervals:
+  '''The intervals written to a changelog path, kept as JSON lines under its `_intervals` directory
+
+  Spark, AWS Glue crawlers and Amazon Athena skip paths starting with an underscore,
+  so they do not show up in the changelog table.
+  '''
+
+  SCHEMA = StructType([
+    StructField('table', StringType()),
+    StructField('start_snapshot_id', LongType()),
+    StructField('end_snapshot_id', LongType()),
+    StructField('interval_end', StringType()),
+    StructField('rows', LongType())
+  ])
+
+  def __init__(self, spark, changelog_path):
+    self.spark = spark
+    self.path = f"{changelog_path}/_intervals"
+
+  def lastEndSnapshotId(self):
+    try:
+      rows = self.spark.read.schema(self.SCHEMA).json(self.path) \
+        .orderBy(desc('interval_end')) \
+        .limit(1) \
+        .collect()
+    except AnalysisException:
+      #XXX: The path does not exist before the first interval is written.
+      return None
+    return rows[0]['end_snapshot_id'] if rows else None
+
+  def add(self, table, start_snapshot_id, end_snapshot_id, interval_end, rows):
+    interval = Row(table=table, start_snapshot_id=start_snapshot_id, end_snapshot_id=end_snapshot_id, interval_end=interval_end, rows=rows)
+    self.spark.createDataFrame([interval], self.SCHEMA).coalesce(1).write.mode('append').json(self.path)
+
+
+start_time = time.monotonic()
+table_ident = f"{CATALOG}.{DATABASE}.{TABLE_NAME}"
+changelog = IcebergChangelog(spark, table_ident, PRIMARY_KEYS)
+changelog_intervals = ChangelogIntervals(spark, CHANGELOG_S3_PATH)
+
+start_snapshot_id = START_SNAPSHOT_ID if START_SNAPSHOT_ID is not None else changelog_intervals.lastEndSnapshotId()
+end_snapshot_id = END_SNAPSHOT_ID if END_SNAPSHOT_ID is not None else changelog.currentSnapshotId()
+report = {
+  'event': 'iceberg_changelog',
+  'table': table_ident,
+  'start_snapshot_id': start_snapshot_id,
+  'end_snapshot_id': end_snapshot_id
+}
+
+if end_snapshot_id is None or end_snapshot_id == start_snapshot_id:
+  report['skipped'] = 'no snapshots after the start snapshot'
+else:
+  changes_df, changes_report = changelog.changes(start_snapshot_id, end_snapshot_id)
+  report.update(changes_report)
+  #XXX: Named after the commit time of the end snapshot, so that the intervals sort in the order of the changes.
+  interval_end = changes_report['end_committed_at'].strftime('%Y%m%d%H%M%S%f')[:-3]
+  report['interval_end'] = interval_end
+
+  changes_df = changes_df \
+    .withColumn('_start_snapshot_id', lit(start_snapshot_id).cast('bigint')) \
+    .withColumn('_end_snapshot_id', lit(end_snapshot_id).cast('bigint')) \
+    .withColumn('interval_end', lit(interval_end)) \
+    .persist()
+  try:
+    report['rows'] = {row['operation']: row['count'] for row in changes_df.groupBy('operation').count().collect()}
+    #XXX: One task per operation, so that every interval has a few large files per operation instead of one per input split.
+    changes_df.repartition('operation') \
+      .write.mode('overwrite') \
+      .option('maxRecordsPerFile', MAX_RECORDS_PER_FILE) \
+      .partitionBy('interval_end', 'operation') \
+      .parquet(CHANGELOG_S3_PATH)
+  finally:
+    changes_df.unpersist()
+  changelog_intervals.add(table_ident, start_snapshot_id, end_snapshot_id, interval_end, sum(report['rows'].values()))
+
+report['elapsed_sec'] = time.monotonic() - start_time
+print(json.dumps(report, default=str))
+
+job.commit()
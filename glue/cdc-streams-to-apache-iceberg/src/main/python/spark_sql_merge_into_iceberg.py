@@ -2,9 +2,14 @@
 # -*- encoding: utf-8 -*-
 # vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
 
+import functools
+import json
 import os
 import sys
+import threading
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 from awsglue.transforms import *
 from awsglue.utils import getResolvedOptions
@@ -15,19 +20,48 @@ from awsglue import DynamicFrame
 from pyspark.context import SparkContext
 from pyspark.conf import SparkConf
 from pyspark.sql import DataFrame, Row
-from pyspark.sql.window import Window
+from pyspark.sql.utils import AnalysisException
+from pyspark.sql.types import (
+  DateType,
+  StringType,
+  StructField,
+  StructType,
+  TimestampType
+)
 from pyspark.sql.functions import (
+  broadcast,
+  coalesce,
   col,
-  desc,
-  row_number,
-  to_timestamp
+  count,
+  lit,
+  to_timestamp,
+  when
+)
+
+from streaming_batch_helpers import (
+  isEmptyDataFrame,
+  countByOperation,
+  buildMergePruningPredicate,
+  buildCombinedMergeQuery,
+  dedupLatest,
+  getOptionalResolvedOptions,
+  loadPayloadSchema,
+  createParsedSourceDataFrame,
+  processExplicitSchemaBatch
+)
+from adaptive_window import AdaptiveWindowController, parseWindowSizeSec, runAdaptiveForEachBatch
+from iceberg_table_helpers import (
+  TableMetadataCache,
+  IcebergTableMaintenance,
+  IcebergWriteMode,
+  IcebergCommitMonitor
 )
+from streaming_progress import BatchProfiler
+
 
 args = getResolvedOptions(sys.argv, ['JOB_NAME',
   'catalog',
   'database_name',
-  'table_name',
-  'primary_key',
   'kinesis_stream_arn',
   'starting_position_of_kinesis_iterator',
   'iceberg_s3_path',
@@ -36,17 +70,104 @@ args = getResolvedOptions(sys.argv, ['JOB_NAME',
   'window_size'
 ])
 
+args.update(getOptionalResolvedOptions(sys.argv, {
+  'table_name': '',
+  'primary_key': '',
+  'table_mapping_path': '',
+  'multi_table_parallelism': '4',
+  'metadata_cache_ttl_sec': '300',
+  'merge_mode': 'combined',
+  'merge_pruning_key_range': 'true',
+  'merge_pruning_partition_columns': '',
+  'merge_pruning_max_values': '1000',
+  'adaptive_window': 'false',
+  'adaptive_min_window_sec': '30',
+  'adaptive_max_window_sec': '300',
+  'adaptive_min_records_per_trigger': '10000',
+  'adaptive_max_records_per_trigger': '1000000',
+  'adaptive_target_utilization': '0.8',
+  'adaptive_min_batch_rows': '1000',
+  'maintenance_interval_batches': '0',
+  'maintenance_target_file_size_bytes': '134217728',
+  'maintenance_min_small_files': '20',
+  'maintenance_max_manifests': '50',
+  'maintenance_snapshot_retention_hours': '24',
+  'maintenance_retain_last_snapshots': '10',
+  'maintenance_orphan_file_retention_hours': '72',
+  'maintenance_orphan_files_every_n_runs': '24',
+  'schema_mode': 'infer',
+  'dead_letter_s3_path': '',
+  'dedup_watermark_delay': '',
+  'write_mode': 'copy-on-write',
+  'maintenance_max_delete_files': '10',
+  'lock_acquire_interval_ms': '',
+  'lock_acquire_timeout_ms': '',
+  'commit_retry_num_retries': '',
+  'commit_retry_min_wait_ms': '',
+  'commit_retry_max_wait_ms': '',
+  'commit_retry_total_timeout_ms': '',
+  'commit_monitor': 'false',
+  'checkpoint_min_batches_to_retain': '',
+  'checkpoint_location': '',
+  'enrichment_path': '',
+  'enrichment_ttl_sec': '3600',
+  'enrichment_max_rows': '1000000',
+  'batch_profile': 'false',
+  'batch_profile_cloudwatch_namespace': ''
+}))
+
 CATALOG = args['catalog']
 ICEBERG_S3_PATH = args['iceberg_s3_path']
 DATABASE = args['database_name']
 TABLE_NAME = args['table_name']
 PRIMARY_KEY = args['primary_key']
+#XXX: A JSON file of the tables to merge the CDC records of many source tables into, instead of `table_name`
+TABLE_MAPPING_PATH = args['table_mapping_path']
+MULTI_TABLE_PARALLELISM = int(args['multi_table_parallelism'])
+if not TABLE_MAPPING_PATH and not (TABLE_NAME and PRIMARY_KEY):
+  raise ValueError("--table_name and --primary_key are required without --table_mapping_path")
 DYNAMODB_LOCK_TABLE = args['lock_table_name']
 KINESIS_STREAM_ARN = args['kinesis_stream_arn']
 #XXX: starting_position_of_kinesis_iterator: ['LATEST', 'TRIM_HORIZON']
 STARTING_POSITION_OF_KINESIS_ITERATOR = args.get('starting_position_of_kinesis_iterator', 'LATEST')
 AWS_REGION = args['aws_region']
 WINDOW_SIZE = args.get('window_size', '100 seconds')
+#XXX: 'true' logs the time, Spark jobs and rows of each phase of every micro-batch as a `batch_profile` JSON line
+BATCH_PROFILE = args['batch_profile'].lower() == 'true'
+METADATA_CACHE_TTL_SEC = int(args['metadata_cache_ttl_sec'])
+#XXX: merge_mode: ['combined', 'separate']
+MERGE_MODE = args['merge_mode']
+MERGE_PRUNING_KEY_RANGE = args['merge_pruning_key_range'].lower() == 'true'
+#XXX: Only list partition columns whose values never change for a primary key,
+# otherwise an update moving a row to another partition is inserted as a new row.
+MERGE_PRUNING_PARTITION_COLUMNS = [c.strip() for c in args['merge_pruning_partition_columns'].split(',') if c.strip()]
+MERGE_PRUNING_MAX_VALUES = int(args['merge_pruning_max_values'])
+ADAPTIVE_WINDOW = args['adaptive_window'].lower() == 'true'
+MAINTENANCE_INTERVAL_BATCHES = int(args['maintenance_interval_batches'])
+#XXX: schema_mode: ['infer', 'explicit']
+SCHEMA_MODE = args['schema_mode']
+DEAD_LETTER_S3_PATH = args['dead_letter_s3_path'] or os.path.join(args["TempDir"], args["JOB_NAME"], "dead_letter/")
+#XXX: e.g., '10 minutes'; cross-batch de-duplication needs schema_mode 'explicit'
+DEDUP_WATERMARK_DELAY = args['dedup_watermark_delay']
+#XXX: write_mode: ['copy-on-write', 'merge-on-read']
+WRITE_MODE = args['write_mode']
+#XXX: e.g., 's3://bucket/conf/enrichment.json'; the dimension tables to enrich the records with before merging them
+ENRICHMENT_PATH = args['enrichment_path']
+
+#XXX: Empty values keep the defaults of Iceberg, i.e. the DynamoDB lock is tried every 5 seconds for up to 3 minutes,
+# and a commit that conflicts with another writer is retried 4 times, waiting from 100 ms up to 60 seconds in between.
+LOCK_ACQUIRE_PROPERTIES = {
+  'lock.acquire-interval-ms': args['lock_acquire_interval_ms'],
+  'lock.acquire-timeout-ms': args['lock_acquire_timeout_ms']
+}
+COMMIT_RETRY_PROPERTIES = {
+  'commit.retry.num-retries': args['commit_retry_num_retries'],
+  'commit.retry.min-wait-ms': args['commit_retry_min_wait_ms'],
+  'commit.retry.max-wait-ms': args['commit_retry_max_wait_ms'],
+  'commit.retry.total-timeout-ms': args['commit_retry_total_timeout_ms']
+}
+#XXX: 'true' logs the commits and commit contention of every micro-batch as an `iceberg_commit_contention` JSON line
+COMMIT_MONITOR = args['commit_monitor'].lower() == 'true'
 
 def setSparkIcebergConf() -> SparkConf:
   conf_list = [
@@ -59,6 +180,11 @@ def setSparkIcebergConf() -> SparkConf:
     ("spark.sql.extensions", "org.apache.iceberg.spark.extensions.IcebergSparkSessionExtensions"),
     ("spark.sql.iceberg.handle-timestamp-without-timezone", "true")
   ]
+  conf_list += [(f"spark.sql.catalog.{CATALOG}.{k}", v) for k, v in LOCK_ACQUIRE_PROPERTIES.items() if v]
+  if TABLE_MAPPING_PATH:
+    #XXX: Share the executors between the MERGE jobs that the threads of a multi-table micro-batch submit at once,
+    # each in the scheduler pool of its table (see runInSchedulerPool).
+    conf_list.append(("spark.scheduler.mode", "FAIR"))
   spark_conf = SparkConf().setAll(conf_list)
   return spark_conf
 
@@ -70,85 +196,484 @@ spark = glueContext.spark_session
 job = Job(glueContext)
 job.init(args['JOB_NAME'], args)
 
-kds_df = glueContext.create_data_frame.from_options(
-  connection_type="kinesis",
-  connection_options={
-    "typeOfData": "kinesis",
-    "streamARN": KINESIS_STREAM_ARN,
-    "classification": "json",
-    "startingPosition": f"{STARTING_POSITION_OF_KINESIS_ITERATOR}",
-    "inferSchema": "true",
-  },
-  transformation_ctx="kds_df",
-)
+kds_options = {
+  "typeOfData": "kinesis",
+  "streamARN": KINESIS_STREAM_ARN,
+  "classification": "json",
+  "startingPosition": f"{STARTING_POSITION_OF_KINESIS_ITERATOR}",
+  "inferSchema": "true",
+}
 
-def processBatch(data_frame, batch_id):
-  if data_frame.count() > 0:
-    stream_data_dynf = DynamicFrame.fromDF(
-      data_frame, glueContext, "from_data_frame"
-    )
+def createSourceDataFrame(max_records_per_trigger=None):
+  connection_options = {**kds_options, "maxFetchRecordsPerShard": str(max_records_per_trigger)} \
+    if max_records_per_trigger else kds_options
+  return glueContext.create_data_frame.from_options(
+    connection_type="kinesis",
+    connection_options=connection_options,
+    transformation_ctx="kds_df",
+  )
 
-    tables_df = spark.sql(f"SHOW TABLES IN {CATALOG}.{DATABASE}")
-    table_list = tables_df.select('tableName').rdd.flatMap(lambda x: x).collect()
-    if f"{TABLE_NAME}" not in table_list:
-      print(f"Table {TABLE_NAME} doesn't exist in {CATALOG}.{DATABASE}.")
-    else:
-      _df = spark.sql(f"SELECT * FROM {CATALOG}.{DATABASE}.{TABLE_NAME} LIMIT 0")
+#XXX: The options of the Spark Kinesis source, which reads the records as they are for --schema_mode explicit
+raw_reader_options = {
+  "streamName": KINESIS_STREAM_ARN.split('/')[-1],
+  "endpointUrl": f"https://kinesis.{AWS_REGION}.amazonaws.com",
+  "startingPosition": f"{STARTING_POSITION_OF_KINESIS_ITERATOR}"
+}
+
+class CdcTableTarget:
+  '''An Iceberg table that the CDC records of a source table are merged into, with its own metadata cache,
+  write mode and table maintenance
+
+  `commit_lock` makes the threads of this job commit to the table one at a time, i.e. its MERGE and
+  its maintenance never race each other, while other tables are written concurrently.
+  '''
 
-      # Apply De-duplication logic on input data to pick up the latest record based on timestamp and operation
-      stream_data_df = stream_data_dynf.toDF()
-      cdc_df = stream_data_df.select(col('data.*'),
-        col('metadata.operation').alias('_op'),
-        col('metadata.timestamp').alias('_op_timestamp'))
-      cdc_df = cdc_df.withColumn('_op_timestamp', to_timestamp(col('_op_timestamp')))  
-      cdc_df.printSchema() # debug
+  def __init__(self, database, table_name, primary_key, merge_pruning_partition_columns=None,
+      source_schema=None, source_table=None):
+    self.database = database
+    self.table_name = table_name
+    self.primary_key = primary_key
+    self.merge_pruning_partition_columns = MERGE_PRUNING_PARTITION_COLUMNS \
+      if merge_pruning_partition_columns is None else merge_pruning_partition_columns
+    #XXX: The `schema-name` and `table-name` of the CDC metadata; None matches any schema.
+    self.source_schema = source_schema
+    self.source_table = source_table
+    self.table_ident = f"{CATALOG}.{database}.{table_name}"
+    self.view_name = f"{database}_{table_name}"
+    self.metadata = TableMetadataCache(spark, CATALOG, database, table_name, METADATA_CACHE_TTL_SEC)
+    self.write_mode = IcebergWriteMode(spark, CATALOG, database, table_name, WRITE_MODE)
+    self.commit_monitor = IcebergCommitMonitor(spark, self.table_ident, COMMIT_RETRY_PROPERTIES,
+      enabled=COMMIT_MONITOR)
+    self.maintenance = IcebergTableMaintenance(spark, CATALOG, database, table_name, MAINTENANCE_INTERVAL_BATCHES,
+      target_file_size_bytes=int(args['maintenance_target_file_size_bytes']),
+      min_small_files=int(args['maintenance_min_small_files']),
+      max_manifests=int(args['maintenance_max_manifests']),
+      max_delete_files=int(args['maintenance_max_delete_files']),
+      snapshot_retention_hours=int(args['maintenance_snapshot_retention_hours']),
+      retain_last_snapshots=int(args['maintenance_retain_last_snapshots']),
+      orphan_file_retention_hours=int(args['maintenance_orphan_file_retention_hours']),
+      orphan_files_every_n_runs=int(args['maintenance_orphan_files_every_n_runs']))
+    self.commit_lock = threading.Lock()
 
-      window = Window.partitionBy(PRIMARY_KEY).orderBy(desc("_op_timestamp"))
-      deduped_cdc_df = cdc_df.withColumn("_row", row_number().over(window)) \
-        .filter(col("_row") == 1).drop("_row") \
-        .select(_df.schema.names)
+  def matches(self, source_schema, source_table) -> bool:
+    return source_table == self.source_table and self.source_schema in (None, source_schema)
 
-      deduped_cdc_df = deduped_cdc_df.withColumn('trans_datetime', to_timestamp(col('trans_datetime')))
+  def sourceFilter(self):
+    source_filter = col('metadata.`table-name`') == self.source_table
+    return source_filter & (col('metadata.`schema-name`') == self.source_schema) if self.source_schema else source_filter
 
-      upserted_df = deduped_cdc_df.filter(col('_op') != 'delete')
-      if upserted_df.count() > 0:
-        upserted_df.createOrReplaceTempView(f"{TABLE_NAME}_upsert")
-        # print(f"Table '{TABLE_NAME}' is upserting...")
+def loadTableTargets(mapping_path) -> list:
+  '''Read the tables from the mapping file, e.g.
+  {"tables": [{"source_schema": "cdc_iceberg_demo_db", "source_table": "retail_trans",
+    "database_name": "cdc_iceberg_demo_db", "table_name": "retail_trans_iceberg", "primary_key": "trans_id",
+    "merge_pruning_partition_columns": ["device"]}]}
+  '''
+  #XXX: wholeTextFiles reads a single JSON document from Amazon S3 or a local path alike.
+  mapping = json.loads(spark.sparkContext.wholeTextFiles(mapping_path).collect()[0][1])
+  targets = []
+  for entry in mapping['tables']:
+    target = CdcTableTarget(entry.get('database_name', DATABASE), entry['table_name'], entry['primary_key'],
+      merge_pruning_partition_columns=entry.get('merge_pruning_partition_columns'),
+      source_schema=entry.get('source_schema'),
+      source_table=entry.get('source_table', entry['table_name']))
+    overlapping = [e.table_ident for e in targets if e.matches(target.source_schema, target.source_table) or target.matches(e.source_schema, e.source_table)]
+    if overlapping:
+      raise ValueError(f"The source table {target.source_schema}.{target.source_table} of {target.table_ident} is already mapped to {overlapping[0]}")
+    targets.append(target)
+  return targets
 
+if TABLE_MAPPING_PATH:
+  table_targets = loadTableTargets(TABLE_MAPPING_PATH)
+else:
+  table_targets = [CdcTableTarget(DATABASE, TABLE_NAME, PRIMARY_KEY, source_table=TABLE_NAME)]
+
+class DimensionEnrichment:
+  '''Add the columns of small dimension tables to the records of a micro-batch, e.g. the product of a `sku`
+
+  Each dimension table is read once, cached on the executors and reloaded at most once every `ttl_sec` seconds.
+  It is joined with a broadcast hint, so that the records of a micro-batch are joined where they are instead of
+  being shuffled; only the cached dimension rows are sent to the executors. A dimension table that fails to reload
+  is used as it was cached until the next try, so that the stream keeps running.
+  '''
+
+  def __init__(self, spark, dimensions: list, ttl_sec, max_rows):
+    self.spark = spark
+    #XXX: e.g. [{"table": "job_catalog.cdc_iceberg_demo_db.products", "join_key": "sku", "columns": ["product_name", "category"]}]
+    self.dimensions = dimensions
+    self.ttl_sec = ttl_sec
+    self.max_rows = max_rows
+    self.columns = set([c for e in dimensions for c in e['columns']])
+    self.marker_columns = [f"_dim_{i}_matched" for i in range(len(dimensions))]
+    self._cache = {}
+    self._lock = threading.Lock()
+
+  def _load(self, index, dimension):
+    start_time = time.monotonic()
+    dimension_key = dimension.get('dimension_key', dimension['join_key'])
+    #XXX: Keep one row per key, so that the join never multiplies the records of a micro-batch.
+    dimension_df = self.spark.table(dimension['table']) \
+      .select(col(dimension_key).alias(f"_dim_{index}_key"), *[col(c).alias(f"_dim_{index}_{c}") for c in dimension['columns']]) \
+      .dropDuplicates([f"_dim_{index}_key"]) \
+      .withColumn(f"_dim_{index}_matched", lit(True)) \
+      .persist()
+    rows = dimension_df.count()
+    if rows > self.max_rows:
+      dimension_df.unpersist()
+      raise ValueError(f"{dimension['table']} has {rows} rows, more than --enrichment_max_rows {self.max_rows} to broadcast")
+    print(json.dumps({
+      'event': 'dimension_table_refresh',
+      'table': dimension['table'],
+      'rows': rows,
+      'elapsed_sec': time.monotonic() - start_time
+    }))
+    return {'data_frame': dimension_df, 'rows': rows, 'loaded_at': time.monotonic()}
+
+  def refresh(self):
+    with self._lock:
+      for index, dimension in enumerate(self.dimensions):
+        cached = self._cache.get(index)
+        if cached is not None and (time.monotonic() - cached['loaded_at']) < self.ttl_sec:
+          continue
         try:
-          spark.sql(f"""MERGE INTO {CATALOG}.{DATABASE}.{TABLE_NAME} t
-            USING {TABLE_NAME}_upsert s ON s.{PRIMARY_KEY} = t.{PRIMARY_KEY}
-            WHEN MATCHED THEN UPDATE SET *
-            WHEN NOT MATCHED THEN INSERT *
-            """)
-        except Exception as ex:
+          self._cache[index] = self._load(index, dimension)
+        except Exception:
+          if cached is None:
+            raise
           traceback.print_exc()
-          raise ex
+          #XXX: Try again after another TTL instead of on every micro-batch.
+          cached['loaded_at'] = time.monotonic()
+          continue
+        if cached is not None:
+          cached['data_frame'].unpersist()
+
+  def enrich(self, data_frame, target_schema: StructType):
+    '''Left-join the dimension tables whose join key is a column of `data_frame`, replacing or adding
+    their columns that are in `target_schema`, cast to its types, and a `_dim_<i>_matched` column per dimension
+
+    A record whose key has no row in a dimension table keeps its own values of the dimension columns, if it has them.
+    '''
+    self.refresh()
+    enriched_df = data_frame
+    for index, dimension in enumerate(self.dimensions):
+      columns = [c for c in dimension['columns'] if c in target_schema.names]
+      if not columns or dimension['join_key'] not in enriched_df.columns:
+        continue
+      dimension_df = self._cache[index]['data_frame'].select(f"_dim_{index}_key", *[f"_dim_{index}_{c}" for c in columns], f"_dim_{index}_matched")
+      joined_df = enriched_df.join(broadcast(dimension_df), col(dimension['join_key']) == col(f"_dim_{index}_key"), 'left')
+      dimension_columns = []
+      for c in columns:
+        dimension_column = col(f"_dim_{index}_{c}").cast(target_schema[c].dataType)
+        #XXX: Without a match, the dimension value is NULL, and it would overwrite the value of the table in the MERGE.
+        if c in enriched_df.columns:
+          dimension_column = coalesce(dimension_column, col(c).cast(target_schema[c].dataType))
+        dimension_columns.append(dimension_column.alias(c))
+      enriched_df = joined_df.select(*[c for c in enriched_df.columns if c not in columns], *dimension_columns, f"_dim_{index}_matched")
+    return enriched_df
+
+  def report(self, batch_id, table, enriched_df):
+    '''Log the records of a micro-batch that found a row in each dimension table'''
+    start_time = time.monotonic()
+    markers = [(index, f"_dim_{index}_matched") for index in range(len(self.dimensions)) if f"_dim_{index}_matched" in enriched_df.columns]
+    counts = enriched_df.agg(count(lit(1)).alias('rows'), *[count(col(c)).alias(c) for _, c in markers]).collect()[0]
+    print(json.dumps({
+      'event': 'dimension_enrichment',
+      'batch_id': batch_id,
+      'table': table,
+      'rows': counts['rows'],
+      'dimensions': [{
+        'table': self.dimensions[index]['table'],
+        'join_key': self.dimensions[index]['join_key'],
+        'cached_rows': self._cache[index]['rows'],
+        'cache_age_sec': time.monotonic() - self._cache[index]['loaded_at'],
+        'matched_rows': counts[c],
+        'unmatched_rows': counts['rows'] - counts[c]
+      } for index, c in markers],
+      'elapsed_sec': time.monotonic() - start_time
+    }))
+
+def loadDimensionEnrichment(enrichment_path):
+  '''Read the dimension tables from the enrichment file, e.g.
+  {"dimensions": [{"table": "job_catalog.cdc_iceberg_demo_db.products", "join_key": "sku",
+    "dimension_key": "sku", "columns": ["product_name", "category"]}]}
+  '''
+  enrichment = json.loads(spark.sparkContext.wholeTextFiles(enrichment_path).collect()[0][1])
+  return DimensionEnrichment(spark, enrichment['dimensions'],
+    ttl_sec=int(args['enrichment_ttl_sec']),
+    max_rows=int(args['enrichment_max_rows']))
+
+dimension_enrichment = loadDimensionEnrichment(ENRICHMENT_PATH) if ENRICHMENT_PATH else None
+
+batch_profiler = BatchProfiler(spark, args['JOB_NAME'],
+  cloudwatch_namespace=args['batch_profile_cloudwatch_namespace'],
+  region_name=AWS_REGION)
+
+def buildMergeCondition(source_df, primary_key, partition_columns) -> str:
+  merge_condition = f"s.{primary_key} = t.{primary_key}"
+  pruning_predicate = buildMergePruningPredicate(source_df, primary_key,
+    partition_columns,
+    key_range=MERGE_PRUNING_KEY_RANGE,
+    max_values=MERGE_PRUNING_MAX_VALUES)
+  return f"{merge_condition} AND {pruning_predicate}" if pruning_predicate else merge_condition
+
+def toCdcDataFrame(stream_data_df, table_columns):
+  '''Flatten the CDC records into the columns of the table, their operation and its timestamp'''
+  data_fields = set(stream_data_df.schema['data'].dataType.names)
+  #XXX: A column that no record of the micro-batch carries is not in the inferred schema.
+  return stream_data_df.select(
+    *[col(f"data.`{c}`").alias(c) if c in data_fields else lit(None).alias(c) for c in table_columns],
+    col('metadata.operation').alias('_op'),
+    to_timestamp(col('metadata.timestamp')).alias('_op_timestamp'))
+
+def mergeBatch(stream_data_df, target, batch_id):
+  table_schema = target.metadata.schema()
+  table_columns = table_schema.names
+
+  # Apply De-duplication logic on input data to pick up the latest record based on timestamp and operation
+  cdc_df = toCdcDataFrame(stream_data_df, table_columns)
+  #XXX: Of the changes of a key that share the same timestamp, an insert comes first and a delete comes last.
+  deduped_cdc_df = dedupLatest(cdc_df, target.primary_key, '_op_timestamp', table_columns + ['_op'],
+    tiebreak_columns=[when(col('_op') == 'insert', 0).when(col('_op') == 'update', 1).otherwise(2)])
 
-      deleted_df = deduped_cdc_df.filter(col('_op') == 'delete')
-      if deleted_df.count() > 0:
-        deleted_df.createOrReplaceTempView(f"{TABLE_NAME}_delete")
-        # print(f"Table '{TABLE_NAME}' is deleting...")
+  #XXX: The records carry timestamps and dates as strings, so convert them to the types of the table columns.
+  for field in table_schema.fields:
+    if isinstance(field.dataType, (DateType, TimestampType)):
+      deduped_cdc_df = deduped_cdc_df.withColumn(field.name, col(field.name).cast(field.dataType))
 
+  if dimension_enrichment is not None:
+    #XXX: Enrich the deduplicated records, so that each key is joined once however often it changed in the micro-batch.
+    deduped_cdc_df = dimension_enrichment.enrich(deduped_cdc_df, table_schema)
+
+  #XXX: Persist the deduplicated frame so that computing the merge condition, counting
+  # and the MERGE statements do not re-run the de-duplication over the micro-batch.
+  persisted_cdc_df = deduped_cdc_df.persist()
+  try:
+    with batch_profiler.phase('dedup'):
+      batch_profiler.countRows('output_rows', persisted_cdc_df)
+    if dimension_enrichment is not None:
+      dimension_enrichment.report(batch_id, target.table_ident, persisted_cdc_df)
+      deduped_cdc_df = persisted_cdc_df.drop(*dimension_enrichment.marker_columns)
+
+    with batch_profiler.phase('merge'):
+      mergeDedupedBatch(deduped_cdc_df, target, table_columns)
+  finally:
+    persisted_cdc_df.unpersist()
+
+def mergeDedupedBatch(deduped_cdc_df, target, table_columns):
+  '''Apply the latest change of each key to the table, with one MERGE or with separate upserts and deletes'''
+  merge_condition = buildMergeCondition(deduped_cdc_df, target.primary_key, target.merge_pruning_partition_columns)
+
+  if MERGE_MODE == 'combined':
+    #XXX: A single MERGE makes one Iceberg commit per micro-batch, scans the target table once
+    # and acquires the DynamoDB commit lock once, instead of doing it for upserts and deletes separately.
+    deduped_cdc_df.createOrReplaceTempView(f"{target.view_name}_cdc")
+    # print(f"Table '{target.table_name}' is merging...")
+
+    try:
+      spark.sql(buildCombinedMergeQuery(target.table_ident,
+        f"{target.view_name}_cdc", merge_condition, table_columns))
+    except Exception as ex:
+      traceback.print_exc()
+      raise ex
+  else:
+    op_counts = countByOperation(deduped_cdc_df)
+    deleted_count = op_counts.get('delete', 0)
+    upserted_count = sum(op_counts.values()) - deleted_count
+
+    if upserted_count > 0:
+      upserted_df = deduped_cdc_df.filter(col('_op') != 'delete').drop('_op')
+      upserted_df.createOrReplaceTempView(f"{target.view_name}_upsert")
+      # print(f"Table '{target.table_name}' is upserting...")
+
+      try:
+        spark.sql(f"""MERGE INTO {target.table_ident} t
+          USING {target.view_name}_upsert s ON {merge_condition}
+          WHEN MATCHED THEN UPDATE SET *
+          WHEN NOT MATCHED THEN INSERT *
+          """)
+      except Exception as ex:
+        traceback.print_exc()
+        raise ex
+
+    if deleted_count > 0:
+      deleted_df = deduped_cdc_df.filter(col('_op') == 'delete').drop('_op')
+      deleted_df.createOrReplaceTempView(f"{target.view_name}_delete")
+      # print(f"Table '{target.table_name}' is deleting...")
+
+      try:
+        spark.sql(f"""MERGE INTO {target.table_ident} t
+          USING {target.view_name}_delete s ON {merge_condition}
+          WHEN MATCHED THEN DELETE
+          """)
+      except Exception as ex:
+        traceback.print_exc()
+        raise ex
+
+def applyTableBatch(target, stream_data_df, batch_id):
+  '''Merge the CDC records of a table and report what it committed, holding the commit lock of the table'''
+  if not target.metadata.exists():
+    print(f"Table {target.table_name} doesn't exist in {CATALOG}.{target.database}.")
+    return None
+
+  commit_report = None
+  with target.commit_lock:
+    target.write_mode.configure()
+    #XXX: Only the contention report and the commit report of merge-on-read writes read the snapshots of the micro-batch,
+    # so without them the monitor only sets the commit retries, like in the INSERT OVERWRITE jobs.
+    report_commits = target.commit_monitor.enabled or target.write_mode.isMergeOnRead()
+    if report_commits:
+      target.commit_monitor.start()
+    else:
+      target.commit_monitor.configure()
+    try:
+      mergeBatch(stream_data_df, target, batch_id)
+    except AnalysisException as ex:
+      #XXX: The cached table schema might be stale (e.g., the table has been altered),
+      # so reload it from the catalog and retry the batch once.
+      target.metadata.invalidate()
+      if not target.metadata.exists():
+        #XXX: The table has been dropped, so there is no schema to retry with; raise the original error.
+        raise ex
+      mergeBatch(stream_data_df, target, batch_id)
+    if report_commits:
+      target.commit_monitor.stop()
+      with batch_profiler.phase('commit_report'):
+        #XXX: Read the snapshots of the micro-batch once, for both the commit report and the contention report.
+        snapshot_rows = target.commit_monitor.readSnapshots()
+        commit_report = target.write_mode.reportCommits(batch_id, snapshot_rows)
+        if commit_report:
+          target.maintenance.addDeleteFiles(commit_report['added_delete_files'])
+        if target.commit_monitor.enabled:
+          batch_profiler.record('commit_sec', target.commit_monitor.report(batch_id, snapshot_rows)['commit_sec'])
+  return commit_report
+
+def maintainTable(target, batch_id):
+  #XXX: Run the table maintenance between micro-batches, so that it never conflicts with the writes of this job.
+  if target.maintenance.isDue(batch_id) and target.metadata.exists():
+    with target.commit_lock:
+      target.maintenance.run()
+
+def processBatch(data_frame, batch_id):
+  target = table_targets[0]
+  if not isEmptyDataFrame(data_frame):
+    stream_data_dynf = DynamicFrame.fromDF(
+      data_frame, glueContext, "from_data_frame"
+    )
+    applyTableBatch(target, stream_data_dynf.toDF(), batch_id)
+
+  with batch_profiler.phase('maintenance'):
+    maintainTable(target, batch_id)
+
+def runInSchedulerPool(pool, func, *func_args):
+  '''Run the Spark jobs that a thread of a multi-table micro-batch submits in the FAIR scheduler pool of its table'''
+  #XXX: Pools that are not defined in an allocation file are created with weight 1, so the tables get equal shares
+  # of the executors. The pool is a local property of the thread, which PySpark passes on to the JVM
+  # in pinned thread mode, the default since Spark 3.2 (AWS Glue 4.0).
+  sc.setLocalProperty("spark.scheduler.pool", pool)
+  try:
+    return func(*func_args)
+  finally:
+    sc.setLocalProperty("spark.scheduler.pool", None)
+
+def processMultiTableBatch(data_frame, batch_id):
+  '''Route the CDC records of a micro-batch by the `schema-name` and `table-name` of their metadata,
+  and merge them into the tables of the mapping file concurrently'''
+  if not isEmptyDataFrame(data_frame):
+    start_time = time.monotonic()
+    stream_data_df = DynamicFrame.fromDF(data_frame, glueContext, "from_data_frame").toDF()
+    #XXX: Persist the micro-batch, so that the stream is read once instead of once per table.
+    stream_data_df.persist()
+    try:
+      source_tables = [(row['schema_name'], row['table_name']) for row in stream_data_df.select(
+        col('metadata.`schema-name`').alias('schema_name'),
+        col('metadata.`table-name`').alias('table_name')).distinct().collect()]
+      table_batches = [(target, stream_data_df.filter(target.sourceFilter())) for target in table_targets
+        if any([target.matches(*e) for e in source_tables])]
+      unmapped_tables = [f"{schema_name}.{table_name}" for schema_name, table_name in source_tables
+        if not any([target.matches(schema_name, table_name) for target in table_targets])]
+
+      #XXX: The phases of each table run on the threads of the pool, so only the merge of all tables is profiled.
+      with batch_profiler.phase('merge'), ThreadPoolExecutor(max_workers=MULTI_TABLE_PARALLELISM) as executor:
+        futures = [(target, executor.submit(runInSchedulerPool, target.table_ident, applyTableBatch, target, table_df, batch_id))
+          for target, table_df in table_batches]
+      failed_tables = []
+      for target, future in futures:
         try:
-          spark.sql(f"""MERGE INTO {CATALOG}.{DATABASE}.{TABLE_NAME} t
-            USING {TABLE_NAME}_delete s ON s.{PRIMARY_KEY} = t.{PRIMARY_KEY}
-            WHEN MATCHED THEN DELETE
-            """)
-        except Exception as ex:
+          future.result()
+        except Exception:
           traceback.print_exc()
-          raise ex
+          failed_tables.append(target.table_ident)
 
+      print(json.dumps({
+        'event': 'cdc_multi_table_batch',
+        'batch_id': batch_id,
+        'tables': len(table_batches),
+        'failed_tables': failed_tables,
+        'unmapped_source_tables': unmapped_tables,
+        'elapsed_sec': time.monotonic() - start_time
+      }))
+      if failed_tables:
+        #XXX: Fail the micro-batch so that it is replayed from the checkpoint; merging the latest change
+        # of every key again leaves the tables that were already merged as they are.
+        raise RuntimeError(f"Failed to merge the micro-batch {batch_id} into {', '.join(failed_tables)}")
+    finally:
+      stream_data_df.unpersist()
 
-checkpointPath = os.path.join(args["TempDir"], args["JOB_NAME"], "checkpoint/")
+  with batch_profiler.phase('maintenance'), ThreadPoolExecutor(max_workers=MULTI_TABLE_PARALLELISM) as executor:
+    for future in [executor.submit(runInSchedulerPool, target.table_ident, maintainTable, target, batch_id) for target in table_targets]:
+      future.result()
 
-glueContext.forEachBatch(
-  frame=kds_df,
-  batch_function=processBatch,
-  options={
-    "windowSize": WINDOW_SIZE,
-    "checkpointLocation": checkpointPath,
-  }
-)
+
+#XXX: e.g., a checkpoint written by the checkpoint tool, to restart the job from other offsets
+checkpointPath = args['checkpoint_location'] or os.path.join(args["TempDir"], args["JOB_NAME"], "checkpoint/")
+
+#XXX: The checkpoint keeps the offsets and commits of the last `checkpoint_min_batches_to_retain` micro-batches
+# (Spark default: 100); fewer of them make the checkpoint smaller and faster to list when the job restarts.
+if args['checkpoint_min_batches_to_retain']:
+  spark.conf.set("spark.sql.streaming.minBatchesToRetain", args['checkpoint_min_batches_to_retain'])
+
+if DEDUP_WATERMARK_DELAY and SCHEMA_MODE != 'explicit':
+  raise ValueError("--dedup_watermark_delay requires --schema_mode explicit")
+if TABLE_MAPPING_PATH and SCHEMA_MODE == 'explicit':
+  raise ValueError("--table_mapping_path requires --schema_mode infer, since the tables have different payload schemas")
+
+if SCHEMA_MODE == 'explicit':
+  #XXX: Derive the payload schema once from the table instead of inferring it on every micro-batch.
+  payload_schema = StructType([
+    StructField('data', loadPayloadSchema(spark, table_targets[0].table_ident), True),
+    StructField('metadata', StructType([
+      StructField('timestamp', StringType(), True),
+      StructField('operation', StringType(), True)
+    ]), True)
+  ])
+  create_source_data_frame = functools.partial(createParsedSourceDataFrame, spark, 'kinesis', raw_reader_options, payload_schema,
+    dedup_key=col(f'_parsed.data.{table_targets[0].primary_key}'),
+    dedup_event_time=to_timestamp(col('_parsed.metadata.timestamp')),
+    dedup_watermark_delay=DEDUP_WATERMARK_DELAY)
+  batch_function = functools.partial(processExplicitSchemaBatch, process_batch=processBatch, dead_letter_s3_path=DEAD_LETTER_S3_PATH)
+else:
+  create_source_data_frame = createSourceDataFrame
+  batch_function = processMultiTableBatch if TABLE_MAPPING_PATH else processBatch
+
+if BATCH_PROFILE:
+  batch_function = batch_profiler.profile(batch_function)
+
+if ADAPTIVE_WINDOW:
+  controller = AdaptiveWindowController(parseWindowSizeSec(WINDOW_SIZE),
+    int(args['adaptive_min_window_sec']),
+    int(args['adaptive_max_window_sec']),
+    int(args['adaptive_min_records_per_trigger']),
+    int(args['adaptive_max_records_per_trigger']),
+    target_utilization=float(args['adaptive_target_utilization']),
+    min_batch_rows=int(args['adaptive_min_batch_rows']))
+  runAdaptiveForEachBatch(create_source_data_frame, batch_function, checkpointPath, controller)
+else:
+  glueContext.forEachBatch(
+    frame=create_source_data_frame(),
+    batch_function=batch_function,
+    options={
+      "windowSize": WINDOW_SIZE,
+      "checkpointLocation": checkpointPath,
+    }
+  )
 
 job.commit()
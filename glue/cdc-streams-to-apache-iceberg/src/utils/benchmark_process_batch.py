@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import argparse
+import os
+import sys
+import time
+
+from pyspark.sql import SparkSession
+from pyspark.sql.window import Window
+from pyspark.sql.functions import (
+  col,
+  concat,
+  date_format,
+  desc,
+  expr,
+  floor,
+  lit,
+  rand,
+  row_number,
+  struct,
+  to_timestamp,
+  when
+)
+
+#XXX: The "after" variant runs the helpers that the job imports, so that the benchmark measures the code that ships.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../../streaming-etl/common/src/main/python'))
+from streaming_batch_helpers import countByOperation, dedupLatest, isEmptyDataFrame
+
+TABLE_COLUMNS = ['trans_id', 'customer_id', 'event', 'sku', 'amount', 'device', 'trans_datetime']
+
+
+def gen_cdc_df(spark, num_records, num_keys, seed=47):
+  '''Generate a micro-batch shaped like the CDC records of gen_fake_cdc_data.py'''
+  op = rand(seed)
+  return spark.range(num_records).select(
+    struct(
+      (floor(rand(seed + 1) * num_keys) + 1).cast('int').alias('trans_id'),
+      (floor(rand(seed + 2) * 876543210987) + 123456789012).cast('string').alias('customer_id'),
+      expr("element_at(array('visit', 'view', 'list', 'like', 'cart', 'purchase'), cast(id % 6 as int) + 1)").alias('event'),
+      concat(lit('AB'), (col('id') % 10000).cast('string'), lit('CDEF')).alias('sku'),
+      (floor(rand(seed + 3) * 10) + 1).cast('int').alias('amount'),
+      expr("element_at(array('pc', 'mobile', 'tablet'), cast(id % 3 as int) + 1)").alias('device'),
+      date_format(expr('current_timestamp() - make_interval(0, 0, 0, 0, 0, 0, id % 3600)'), "yyyy-MM-dd'T'HH:mm:ss'Z'").alias('trans_datetime')
+    ).alias('data'),
+    struct(
+      date_format(expr('current_timestamp() - make_interval(0, 0, 0, 0, 0, 0, id % 600)'), "yyyy-MM-dd'T'HH:mm:ss.SSSSSS'Z'").alias('timestamp'),
+      when(op < 0.5, 'insert').when(op < 0.8, 'update').otherwise('delete').alias('operation')
+    ).alias('metadata')
+  )
+
+
+def to_cdc_df(stream_data_df):
+  cdc_df = stream_data_df.select(col('data.*'),
+    col('metadata.operation').alias('_op'),
+    col('metadata.timestamp').alias('_op_timestamp'))
+  return cdc_df.withColumn('_op_timestamp', to_timestamp(col('_op_timestamp')))
+
+
+def dedup(cdc_df, columns):
+  window = Window.partitionBy('trans_id').orderBy(desc("_op_timestamp"))
+  deduped_cdc_df = cdc_df.withColumn("_row", row_number().over(window)) \
+    .filter(col("_row") == 1).drop("_row") \
+    .select(columns)
+  return deduped_cdc_df.withColumn('trans_datetime', to_timestamp(col('trans_datetime')))
+
+
+def write_noop(data_frame):
+  #XXX: stands in for the MERGE INTO statement, which has the same cost in both variants
+  data_frame.write.format('noop').mode('overwrite').save()
+
+
+def process_batch_before(data_frame):
+  if data_frame.count() > 0:
+    deduped_cdc_df = dedup(to_cdc_df(data_frame), TABLE_COLUMNS)
+
+    upserted_df = deduped_cdc_df.filter(col('_op') != 'delete')
+    if upserted_df.count() > 0:
+      write_noop(upserted_df)
+
+    deleted_df = deduped_cdc_df.filter(col('_op') == 'delete')
+    if deleted_df.count() > 0:
+      write_noop(deleted_df)
+
+
+def process_batch_after(data_frame):
+  if not isEmptyDataFrame(data_frame):
+    deduped_cdc_df = dedupLatest(to_cdc_df(data_frame), 'trans_id', '_op_timestamp', TABLE_COLUMNS + ['_op'],
+      tiebreak_columns=[when(col('_op') == 'insert', 0).when(col('_op') == 'update', 1).otherwise(2)]) \
+      .withColumn('trans_datetime', to_timestamp(col('trans_datetime')))
+    deduped_cdc_df.persist()
+    try:
+      op_counts = countByOperation(deduped_cdc_df)
+      deleted_count = op_counts.get('delete', 0)
+      upserted_count = sum(op_counts.values()) - deleted_count
+
+      if upserted_count > 0:
+        write_noop(deduped_cdc_df.filter(col('_op') != 'delete').drop('_op'))
+
+      if deleted_count > 0:
+        write_noop(deduped_cdc_df.filter(col('_op') == 'delete').drop('_op'))
+    finally:
+      deduped_cdc_df.unpersist()
+
+
+def run(spark, name, batch_function, data_frame, batch_id):
+  sc = spark.sparkContext
+  status_tracker = sc.statusTracker()
+
+  job_group = f"{name}-{batch_id}"
+  sc.setJobGroup(job_group, name)
+  start_time = time.perf_counter()
+  batch_function(data_frame)
+  elapsed_time = time.perf_counter() - start_time
+
+  job_ids = status_tracker.getJobIdsForGroup(job_group)
+  stage_ids = [stage_id for job_id in job_ids for stage_id in status_tracker.getJobInfo(job_id).stageIds]
+  stage_infos = [status_tracker.getStageInfo(stage_id) for stage_id in stage_ids]
+  executed_stages = [e for e in stage_infos if e is not None and e.numCompletedTasks > 0]
+  return {
+    'jobs': len(job_ids),
+    'stages': len(stage_ids),
+    'executed_stages': len(executed_stages),
+    'elapsed_sec': elapsed_time
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser()
+
+  parser.add_argument('--num-records', default=100000, type=int,
+    help='The number of CDC records per micro-batch (default: 100000)')
+  parser.add_argument('--num-keys', default=20000, type=int,
+    help='The number of distinct primary keys per micro-batch (default: 20000)')
+  parser.add_argument('--num-batches', default=3, type=int,
+    help='The number of micro-batches to run for each variant (default: 3)')
+  parser.add_argument('--shuffle-partitions', default=8, type=int,
+    help='spark.sql.shuffle.partitions (default: 8)')
+
+  options = parser.parse_args()
+
+  spark = SparkSession.builder \
+    .master('local[*]') \
+    .appName('benchmark_process_batch') \
+    .config('spark.sql.shuffle.partitions', options.shuffle_partitions) \
+    .config('spark.ui.enabled', 'false') \
+    .getOrCreate()
+
+  print('variant\tbatch_id\tjobs\tstages\texecuted_stages\telapsed_sec')
+  for name, batch_function in [('before', process_batch_before), ('after', process_batch_after)]:
+    for batch_id in range(options.num_batches):
+      data_frame = gen_cdc_df(spark, options.num_records, options.num_keys, seed=47 + batch_id)
+      stats = run(spark, name, batch_function, data_frame, batch_id)
+      print(f"{name}\t{batch_id}\t{stats['jobs']}\t{stats['stages']}\t{stats['executed_stages']}\t{stats['elapsed_sec']:.3f}")
+
+  spark.stop()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import argparse
+from datetime import datetime, timezone
+import json
+import os
+import time
+from urllib.parse import urlparse
+import uuid
+
+#XXX: The version header of the offset and commit logs of Spark 3.x (AWS Glue 3.0 and 4.0)
+LOG_VERSION = 'v1'
+
+
+class LocalStorage:
+  '''Read and write the files of a checkpoint on the local file system, e.g. the checkpoints of the local benchmark'''
+
+  def __init__(self, path):
+    self.root = path
+
+  def list(self, directory) -> list:
+    path = os.path.join(self.root, directory)
+    return sorted(os.listdir(path)) if os.path.isdir(path) else []
+
+  def exists(self, name) -> bool:
+    return os.path.exists(os.path.join(self.root, name))
+
+  def read(self, name) -> str:
+    with open(os.path.join(self.root, name)) as f:
+      return f.read()
+
+  def write(self, name, content):
+    path = os.path.join(self.root, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+      f.write(content)
+
+  def delete(self, names):
+    for name in names:
+      os.remove(os.path.join(self.root, name))
+
+
+class S3Storage:
+  '''Read and write the files of a checkpoint on Amazon S3'''
+
+  def __init__(self, path, region_name=None):
+    import boto3
+
+    url = urlparse(path)
+    self.bucket = url.netloc
+    self.prefix = url.path.strip('/')
+    self.s3_client = boto3.client('s3', region_name=region_name)
+
+  def _key(self, name) -> str:
+    return f"{self.prefix}/{name}" if self.prefix else name
+
+  def list(self, directory) -> list:
+    prefix = f"{self._key(directory)}/"
+    names = []
+    paginator = self.s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix, Delimiter='/'):
+      names += [e['Key'][len(prefix):] for e in page.get('Contents', [])]
+    return sorted(names)
+
+  def exists(self, name) -> bool:
+    res = self.s3_client.list_objects_v2(Bucket=self.bucket, Prefix=self._key(name), MaxKeys=1)
+    return res.get('KeyCount', 0) > 0
+
+  def read(self, name) -> str:
+    res = self.s3_client.get_object(Bucket=self.bucket, Key=self._key(name))
+    return res['Body'].read().decode('utf-8')
+
+  def write(self, name, content):
+    self.s3_client.put_object(Bucket=self.bucket, Key=self._key(name), Body=content.encode('utf-8'))
+
+  def delete(self, names):
+    keys = [{'Key': self._key(e)} for e in names]
+    for i in range(0, len(keys), 1000):
+      self.s3_client.delete_objects(Bucket=self.bucket, Delete={'Objects': keys[i:i + 1000], 'Quiet': True})
+
+
+def openStorage(path, region_name=None):
+  return S3Storage(path, region_name) if path.startswith('s3://') or path.startswith('s3a://') else LocalStorage(path)
+
+
+def listBatchIds(storage, directory) -> list:
+  #XXX: Skip the checksum (.N.crc) and temporary files that Hadoop writes next to the log files.
+  return sorted([int(e) for e in storage.list(directory) if e.isdigit()])
+
+
+def readOffsets(storage, batch_id):
+  '''Parse offsets/<batch_id>: the version, the batch metadata, and one offset per source ("-" if the source had none)'''
+  lines = storage.read(f"offsets/{batch_id}").splitlines()
+  if not lines or lines[0] != LOG_VERSION:
+    raise ValueError(f"offsets/{batch_id}: unsupported offset log version {lines[0] if lines else None}")
+  metadata = json.loads(lines[1]) if len(lines) > 1 else {}
+  sources = [None if e == '-' else json.loads(e) for e in lines[2:]]
+  return metadata, sources
+
+
+def sourceType(offset) -> str:
+  if not isinstance(offset, dict):
+    return 'unknown'
+  if 'metadata' in offset and 'streamName' in offset['metadata']:
+    return 'kinesis'
+  if offset and all([isinstance(v, dict) and all([isinstance(p, int) for p in v.values()]) for v in offset.values()]):
+    return 'kafka'
+  return 'unknown'
+
+
+def partitionOffsets(source_index, offset) -> list:
+  '''One record per Kafka partition or Kinesis shard of the offset of a source'''
+  source_type = sourceType(offset)
+  if source_type == 'kafka':
+    return [{'source': source_index, 'type': 'kafka', 'topic': topic, 'partition': int(partition), 'offset': position}
+      for topic, partitions in sorted(offset.items())
+      for partition, position in sorted(partitions.items(), key=lambda e: int(e[0]))]
+  if source_type == 'kinesis':
+    return [{'source': source_index, 'type': 'kinesis', 'stream': offset['metadata']['streamName'], 'shard_id': shard_id,
+      'iterator_type': shard.get('iteratorType'), 'iterator_position': shard.get('iteratorPosition')}
+      for shard_id, shard in sorted(offset.items()) if shard_id != 'metadata']
+  return [{'source': source_index, 'type': source_type, 'offset': offset}]
+
+
+def inspectCheckpoint(options):
+  storage = openStorage(options.checkpoint, options.region_name)
+  offset_batch_ids = listBatchIds(storage, 'offsets')
+  commit_batch_ids = listBatchIds(storage, 'commits')
+  if not offset_batch_ids:
+    raise SystemExit(f"{options.checkpoint}: no offsets, the query has not started a micro-batch yet")
+
+  last_committed = commit_batch_ids[-1] if commit_batch_ids else None
+  summary = {
+    'event': 'checkpoint_summary',
+    'checkpoint': options.checkpoint,
+    'query_id': json.loads(storage.read('metadata')).get('id') if storage.exists('metadata') else None,
+    'last_committed_batch_id': last_committed,
+    'last_planned_batch_id': offset_batch_ids[-1],
+    'retained_offsets': len(offset_batch_ids),
+    'retained_commits': len(commit_batch_ids),
+    'has_state': storage.exists('state/')
+  }
+  print(json.dumps(summary))
+
+  if last_committed is not None:
+    metadata, sources = readOffsets(storage, last_committed)
+    for source_index, offset in enumerate(sources):
+      for record in partitionOffsets(source_index, offset):
+        print(json.dumps({'event': 'committed_offset', 'batch_id': last_committed,
+          'batch_timestamp': datetime.fromtimestamp(metadata.get('batchTimestampMs', 0) / 1000, timezone.utc).isoformat(),
+          **record}))
+
+  #XXX: A planned micro-batch without a commit is run again with the same offsets when the query restarts.
+  if last_committed is None or offset_batch_ids[-1] > last_committed:
+    _, sources = readOffsets(storage, offset_batch_ids[-1])
+    for source_index, offset in enumerate(sources):
+      for record in partitionOffsets(source_index, offset):
+        print(json.dumps({'event': 'pending_offset', 'batch_id': offset_batch_ids[-1], **record}))
+
+
+def pruneCheckpoint(options):
+  storage = openStorage(options.checkpoint, options.region_name)
+  commit_batch_ids = listBatchIds(storage, 'commits')
+  if len(commit_batch_ids) <= options.keep:
+    print(json.dumps({'event': 'checkpoint_prune', 'checkpoint': options.checkpoint, 'deleted_batches': 0}))
+    return
+
+  #XXX: Keep the last `--keep` committed micro-batches, and every planned micro-batch after them,
+  # the same files that Spark keeps with `spark.sql.streaming.minBatchesToRetain`.
+  threshold = commit_batch_ids[-options.keep]
+  names = []
+  deleted_batch_ids = set()
+  for directory in ('offsets', 'commits'):
+    batch_ids = [e for e in listBatchIds(storage, directory) if e < threshold]
+    deleted_batch_ids |= set(batch_ids)
+    checksums = set(storage.list(directory))
+    names += [f"{directory}/{e}" for e in batch_ids]
+    names += [f"{directory}/.{e}.crc" for e in batch_ids if f".{e}.crc" in checksums]
+
+  if not options.dry_run:
+    storage.delete(names)
+  print(json.dumps({'event': 'checkpoint_prune', 'checkpoint': options.checkpoint, 'dry_run': options.dry_run,
+    'deleted_batches': len(deleted_batch_ids),
+    'deleted_files': len(names), 'first_retained_batch_id': threshold}))
+
+
+def parseTimestampMillis(value) -> int:
+  if value.isdigit():
+    return int(value)
+  return int(datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp() * 1000)
+
+
+def kafkaOffsetsForTimestamp(partitions, timestamp_ms, bootstrap_servers) -> dict:
+  '''The earliest offset of every partition whose record timestamp is at or after `timestamp_ms`'''
+  try:
+    from kafka import KafkaConsumer, TopicPartition
+  except ImportError:
+    raise SystemExit('--kafka-timestamp needs kafka-python (pip install kafka-python), or give --kafka-offsets instead')
+
+  consumer = KafkaConsumer(bootstrap_servers=bootstrap_servers.split(','), enable_auto_commit=False)
+  try:
+    topic_partitions = [TopicPartition(topic, partition) for topic, partition in partitions]
+    found = consumer.offsets_for_times({e: timestamp_ms for e in topic_partitions})
+    #XXX: Partitions without records after the timestamp start from their end, like Spark's `startingOffsetsByTimestamp`.
+    end_offsets = consumer.end_offsets(topic_partitions)
+    return {(e.topic, e.partition): found[e].offset if found.get(e) else end_offsets[e] for e in topic_partitions}
+  finally:
+    consumer.close()
+
+
+def reseedKafkaOffset(offset, options) -> dict:
+  positions = {(topic, int(partition)): position for topic, partitions in offset.items() for partition, position in partitions.items()}
+  if options.kafka_timestamp:
+    if not options.bootstrap_servers:
+      raise SystemExit('--kafka-timestamp needs --bootstrap-servers')
+    positions.update(kafkaOffsetsForTimestamp(sorted(positions.keys()), parseTimestampMillis(options.kafka_timestamp), options.bootstrap_servers))
+  for topic, partitions in json.loads(options.kafka_offsets or '{}').items():
+    for partition, position in partitions.items():
+      if int(position) < 0:
+        raise SystemExit('--kafka-offsets takes actual offsets; -1 (latest) and -2 (earliest) only work as startingOffsets of a new query')
+      positions[(topic, int(partition))] = int(position)
+
+  reseeded = {}
+  for (topic, partition), position in sorted(positions.items()):
+    reseeded.setdefault(topic, {})[str(partition)] = position
+  return reseeded
+
+
+def reseedKinesisOffset(offset, options) -> dict:
+  reseeded = {'metadata': {**offset['metadata'], 'batchId': '0'}}
+  sequence_numbers = json.loads(options.kinesis_sequence_numbers or '{}')
+  timestamp_ms = parseTimestampMillis(options.kinesis_timestamp) if options.kinesis_timestamp else None
+  for shard_id, shard in offset.items():
+    if shard_id == 'metadata':
+      continue
+    if shard_id in sequence_numbers:
+      reseeded[shard_id] = {**shard, 'iteratorType': 'AT_SEQUENCE_NUMBER', 'iteratorPosition': str(sequence_numbers[shard_id])}
+    elif timestamp_ms is not None:
+      reseeded[shard_id] = {**shard, 'iteratorType': 'AT_TIMESTAMP', 'iteratorPosition': str(timestamp_ms)}
+    else:
+      reseeded[shard_id] = shard
+  unknown_shards = set(sequence_numbers.keys()) - set(offset.keys())
+  if unknown_shards:
+    raise SystemExit(f"--kinesis-sequence-numbers: shards not in the checkpoint: {', '.join(sorted(unknown_shards))}")
+  return reseeded
+
+
+def reseedCheckpoint(options):
+  source = openStorage(options.checkpoint, options.region_name)
+  target = openStorage(options.output, options.region_name)
+  if options.output.rstrip('/') == options.checkpoint.rstrip('/'):
+    raise SystemExit('--output must not be the checkpoint to reseed from')
+  if target.list('offsets') or target.list('commits'):
+    raise SystemExit(f"{options.output} already has offsets; reseed into a new location")
+  if source.exists('state/'):
+    #XXX: The state of a stateful query (e.g. `dropDuplicates` with a watermark) belongs to the offsets it was built from,
+    # and the restarted query fails to load it for a micro-batch that never ran.
+    raise SystemExit(f"{options.checkpoint} has operator state; only the checkpoints of stateless queries can be reseeded")
+
+  commit_batch_ids = listBatchIds(source, 'commits')
+  if not commit_batch_ids:
+    raise SystemExit(f"{options.checkpoint}: no committed micro-batch to take the sources and partitions from")
+  metadata, sources = readOffsets(source, commit_batch_ids[-1])
+
+  reseeded = []
+  for offset in sources:
+    source_type = sourceType(offset)
+    if source_type == 'kafka':
+      reseeded.append(reseedKafkaOffset(offset, options))
+    elif source_type == 'kinesis':
+      reseeded.append(reseedKinesisOffset(offset, options))
+    else:
+      raise SystemExit(f"unsupported source offset: {json.dumps(offset)}")
+
+  #XXX: Batch 0 is written as committed, so the restarted query plans batch 1 from these offsets.
+  batch_metadata = {**metadata, 'batchTimestampMs': int(time.time() * 1000)}
+  offsets_content = '\n'.join([LOG_VERSION, json.dumps(batch_metadata)] + [json.dumps(e) for e in reseeded])
+  commits_content = '\n'.join([LOG_VERSION, json.dumps({'nextBatchWatermarkMs': metadata.get('batchWatermarkMs', 0)})])
+  query_metadata = source.read('metadata') if source.exists('metadata') else json.dumps({'id': str(uuid.uuid4())})
+
+  if not options.dry_run:
+    target.write('metadata', query_metadata)
+    target.write('offsets/0', offsets_content)
+    target.write('commits/0', commits_content)
+  for source_index, offset in enumerate(reseeded):
+    for record in partitionOffsets(source_index, offset):
+      print(json.dumps({'event': 'reseeded_offset', 'checkpoint': options.output, 'dry_run': options.dry_run, **record}))
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Inspect, prune and reseed the checkpoints of the Spark streaming jobs.')
+  parser.add_argument('--region-name', action='store', default=None,
+    help='aws region name of the S3 checkpoints (default: the region of the AWS profile)')
+  subparsers = parser.add_subparsers(dest='command', required=True)
+
+  inspect_parser = subparsers.add_parser('inspect', help='Print the committed offsets of every Kafka partition or Kinesis shard')
+  inspect_parser.add_argument('--checkpoint', required=True, help='The checkpoint location, e.g. s3://bucket/temp/job-name/checkpoint/')
+
+  prune_parser = subparsers.add_parser('prune', help='Delete the offset and commit logs of old micro-batches of a stopped job')
+  prune_parser.add_argument('--checkpoint', required=True, help='The checkpoint location of the stopped job')
+  prune_parser.add_argument('--keep', default=10, type=int, help='The committed micro-batches to keep (default: 10)')
+  prune_parser.add_argument('--dry-run', action='store_true')
+
+  reseed_parser = subparsers.add_parser('reseed', help='Write a new checkpoint that starts from the given offsets or timestamps')
+  reseed_parser.add_argument('--checkpoint', required=True, help='The checkpoint to take the sources, partitions and settings from')
+  reseed_parser.add_argument('--output', required=True, help='The new checkpoint location, to be given to the job as --checkpoint_location')
+  reseed_parser.add_argument('--kafka-offsets', help='e.g. \'{"topic": {"0": 1200, "1": 980}}\'; partitions not given keep their committed offsets')
+  reseed_parser.add_argument('--kafka-timestamp', help='e.g. 2023-04-01T00:00:00Z or epoch milliseconds; every partition starts from its first record at or after it')
+  reseed_parser.add_argument('--bootstrap-servers', help='The Kafka bootstrap servers to look up the offsets of --kafka-timestamp')
+  reseed_parser.add_argument('--kinesis-sequence-numbers', help='e.g. \'{"shardId-000000000000": "4960..."}\'; shards not given keep their committed positions')
+  reseed_parser.add_argument('--kinesis-timestamp', help='e.g. 2023-04-01T00:00:00Z or epoch milliseconds; every shard starts AT_TIMESTAMP')
+  reseed_parser.add_argument('--dry-run', action='store_true')
+
+  options = parser.parse_args()
+  if options.command == 'inspect':
+    inspectCheckpoint(options)
+  elif options.command == 'prune':
+    if options.keep < 1:
+      parser.error('--keep must be 1 or more')
+    pruneCheckpoint(options)
+  else:
+    if not any([options.kafka_offsets, options.kafka_timestamp, options.kinesis_sequence_numbers, options.kinesis_timestamp]):
+      parser.error('reseed needs --kafka-offsets, --kafka-timestamp, --kinesis-sequence-numbers or --kinesis-timestamp')
+    reseedCheckpoint(options)
+
+
+if __name__ == '__main__':
+  main()
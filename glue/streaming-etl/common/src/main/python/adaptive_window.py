@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+'''Adaptive trigger interval and source limit for the AWS Glue streaming ETL jobs
+
+Ship this file with the job as `--extra-py-files`, e.g. `s3://<glue-assets>/scripts/adaptive_window.py`.
+'''
+
+import json
+import math
+import time
+
+#XXX: The default `maxFetchRecordsPerShard` of the Kinesis source in AWS Glue, used when the job sets no source limit
+DEFAULT_RECORDS_PER_TRIGGER = 100000
+
+WINDOW_SIZE_UNIT_SEC = {'second': 1, 'minute': 60, 'hour': 3600}
+
+
+class AdaptiveWindowController:
+  '''Adjust the trigger interval and the per-trigger source limit of a streaming query from its progress
+
+  The window grows when micro-batches use more than `target_utilization` of it, or when they carry
+  fewer than `min_batch_rows` rows and are not worth a commit on their own, and shrinks back otherwise.
+  The source limit starts from `records_per_trigger`, i.e. the limit the source is configured with,
+  grows while the source lags behind and there is spare time in the window,
+  and shrinks when micro-batches overrun the window.
+  '''
+
+  def __init__(self, window_sec, min_window_sec, max_window_sec,
+      min_records_per_trigger, max_records_per_trigger,
+      target_utilization=0.8, min_batch_rows=1000,
+      change_threshold=0.25, min_restart_interval_sec=300, records_per_trigger=None):
+    self.min_window_sec = min_window_sec
+    self.max_window_sec = max_window_sec
+    self.min_records_per_trigger = min_records_per_trigger
+    self.max_records_per_trigger = max_records_per_trigger
+    self.target_utilization = target_utilization
+    self.min_batch_rows = min_batch_rows
+    self.change_threshold = change_threshold
+    self.min_restart_interval_sec = min_restart_interval_sec
+
+    self.window_sec = self._clamp(window_sec, min_window_sec, max_window_sec)
+    self.records_per_trigger = self._clamp(records_per_trigger or DEFAULT_RECORDS_PER_TRIGGER,
+      min_records_per_trigger, max_records_per_trigger)
+    self._last_restart_at = time.monotonic()
+
+  @staticmethod
+  def _clamp(value, lower, upper):
+    return int(sorted([lower, value, upper])[1])
+
+  @staticmethod
+  def _fetch_limit_shards(source) -> int:
+    #XXX: The Kinesis source applies its limit to each shard, and keeps an offset per shard, e.g.
+    # {"metadata": {...}, "shardId-000000000000": {...}}; the Kafka source applies its limit to the whole micro-batch.
+    end_offset = source.get('endOffset')
+    if isinstance(end_offset, str):
+      try:
+        end_offset = json.loads(end_offset)
+      except ValueError:
+        return 1
+    shards = [key for key in end_offset if key.startswith('shardId-')] if isinstance(end_offset, dict) else []
+    return len(shards) or 1
+
+  def _source_lag(self, progress):
+    #XXX: The Kafka source reports how many offsets it is behind the latest ones (Spark 3.2+), and the Kinesis source
+    # how many milliseconds; otherwise a micro-batch that read up to the source limit is taken as a sign of lag,
+    # since the input rate only outpaces the processing rate once the micro-batches already overrun the window.
+    sources = progress.get('sources', [])
+    metrics = [source.get('metrics') or {} for source in sources]
+    for metric_name in ('maxOffsetsBehindLatest', 'avgMsBehindLatest'):
+      behind = [float(metric[metric_name]) for metric in metrics if metric_name in metric]
+      if behind:
+        return math.fsum(behind)
+    num_input_rows = progress.get('numInputRows', 0)
+    fetch_limit = self.records_per_trigger * sum(self._fetch_limit_shards(source) for source in sources)
+    return num_input_rows if fetch_limit and num_input_rows >= fetch_limit else 0
+
+  def observe(self, progress) -> bool:
+    '''Take the progress of a finished micro-batch and return True if the query should be restarted with new settings'''
+    duration_sec = progress.get('durationMs', {}).get('triggerExecution', 0) / 1000
+    num_input_rows = progress.get('numInputRows', 0)
+    source_lag = self._source_lag(progress)
+    utilization = duration_sec / self.window_sec
+
+    desired_window_sec = duration_sec / self.target_utilization
+    if num_input_rows < self.min_batch_rows and desired_window_sec < self.window_sec * 2:
+      desired_window_sec = self.window_sec * 2
+    next_window_sec = self._clamp(desired_window_sec, self.min_window_sec, self.max_window_sec)
+
+    next_records_per_trigger = self.records_per_trigger
+    if utilization > 1.0:
+      next_records_per_trigger = self.records_per_trigger // 2
+    elif source_lag > 0 and utilization < self.target_utilization:
+      next_records_per_trigger = self.records_per_trigger * 2
+    next_records_per_trigger = self._clamp(next_records_per_trigger,
+      self.min_records_per_trigger, self.max_records_per_trigger)
+
+    changed = math.fabs(next_window_sec - self.window_sec) >= self.window_sec * self.change_threshold \
+      or next_records_per_trigger != self.records_per_trigger
+    restart = changed and (time.monotonic() - self._last_restart_at) >= self.min_restart_interval_sec
+
+    print(json.dumps({
+      'event': 'adaptive_window_decision',
+      'batch_id': progress.get('batchId'),
+      'duration_sec': duration_sec,
+      'num_input_rows': num_input_rows,
+      'source_lag': source_lag,
+      'utilization': utilization,
+      'window_sec': self.window_sec,
+      'next_window_sec': next_window_sec if restart else self.window_sec,
+      'records_per_trigger': self.records_per_trigger,
+      'next_records_per_trigger': next_records_per_trigger if restart else self.records_per_trigger,
+      'restart': restart
+    }))
+
+    if restart:
+      self.window_sec = next_window_sec
+      self.records_per_trigger = next_records_per_trigger
+      self._last_restart_at = time.monotonic()
+    return restart
+
+def parseWindowSizeSec(window_size: str) -> int:
+  '''Parse a window size such as "100 seconds", "5 minutes" or "1 hour" into seconds'''
+  value, unit = window_size.split()
+  unit_sec = WINDOW_SIZE_UNIT_SEC.get(unit.lower().rstrip('s'))
+  if unit_sec is None:
+    raise ValueError(f"Unsupported unit of window size: {window_size}")
+  return int(value) * unit_sec
+
+def runAdaptiveForEachBatch(create_source_data_frame, batch_function, checkpoint_location, controller, poll_interval_sec=10):
+  '''Run `batch_function` over the stream like glueContext.forEachBatch, restarting the query from
+  its checkpoint whenever the controller changes the trigger interval or the source limit'''
+  while True:
+    query = create_source_data_frame(controller.records_per_trigger).writeStream \
+      .foreachBatch(batch_function) \
+      .trigger(processingTime=f"{controller.window_sec} seconds") \
+      .option("checkpointLocation", checkpoint_location) \
+      .start()
+
+    restart, last_batch_id = False, None
+    while not restart and not query.awaitTermination(poll_interval_sec):
+      progress = query.lastProgress
+      if not progress or progress['batchId'] == last_batch_id:
+        continue
+      last_batch_id = progress['batchId']
+      restart = controller.observe(progress)
+
+    if not restart:
+      return
+    #XXX: Stop between micro-batches, since stopping interrupts the one in flight and it is replayed after the restart.
+    # The checkpoint keeps the committed offsets, so the restarted query resumes where this one stopped.
+    while query.isActive and query.status['isTriggerActive']:
+      time.sleep(1)
+    query.stop()
@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+'''Iceberg table helpers shared by the AWS Glue streaming ETL jobs
+
+Ship this file with the job as `--extra-py-files`, e.g. `s3://<glue-assets>/scripts/iceberg_table_helpers.py`.
+'''
+
+import datetime
+import json
+import time
+import traceback
+
+from pyspark.sql.functions import col, expr, lit
+from pyspark.sql.types import StructType
+
+
+class TableMetadataCache:
+  '''Driver-side cache of the target table's existence and schema.
+
+  Looking them up costs two Glue Data Catalog round trips, so they are
+  refreshed at most once every `ttl_sec` seconds instead of on every micro-batch.
+  '''
+
+  def __init__(self, spark, catalog, database, table_name, ttl_sec):
+    self.spark = spark
+    self.catalog = catalog
+    self.database = database
+    self.table_name = table_name
+    self.ttl_sec = ttl_sec
+    self._schema = None
+    self._loaded_at = None
+
+  def _refresh_if_expired(self):
+    if self._loaded_at is not None and (time.monotonic() - self._loaded_at) < self.ttl_sec:
+      return
+
+    tables_df = self.spark.sql(f"SHOW TABLES IN {self.catalog}.{self.database}")
+    table_list = tables_df.select('tableName').rdd.flatMap(lambda x: x).collect()
+    if f"{self.table_name}" not in table_list:
+      self._schema = None
+    else:
+      _df = self.spark.sql(f"SELECT * FROM {self.catalog}.{self.database}.{self.table_name} LIMIT 0")
+      self._schema = _df.schema
+    self._loaded_at = time.monotonic()
+
+  def exists(self) -> bool:
+    self._refresh_if_expired()
+    return self._schema is not None
+
+  def schema(self) -> StructType:
+    self._refresh_if_expired()
+    return self._schema
+
+  def columns(self) -> list:
+    self._refresh_if_expired()
+    return self._schema.names if self._schema is not None else None
+
+  def invalidate(self):
+    self._loaded_at = None
+
+
+class IcebergTableMaintenance:
+  '''Compact small files, rewrite manifests, expire snapshots and remove orphan files of a streaming table
+
+  It is run from the batch function between two micro-batches, so its commits never race with the
+  commits of this job. Data files are only rewritten when enough small files have piled up, and
+  manifests only when there are too many of them; both thresholds are read from the metadata tables.
+  '''
+
+  def __init__(self, spark, catalog, database, table_name, interval_batches,
+      target_file_size_bytes=134217728, min_small_files=20, max_manifests=50, max_delete_files=10,
+      snapshot_retention_hours=24, retain_last_snapshots=10,
+      orphan_file_retention_hours=72, orphan_files_every_n_runs=24):
+    self.spark = spark
+    self.catalog = catalog
+    self.table = f"{database}.{table_name}"
+    self.interval_batches = interval_batches
+    self.target_file_size_bytes = target_file_size_bytes
+    self.min_small_files = min_small_files
+    self.max_manifests = max_manifests
+    self.max_delete_files = max_delete_files
+    self.snapshot_retention_hours = snapshot_retention_hours
+    self.retain_last_snapshots = retain_last_snapshots
+    self.orphan_file_retention_hours = orphan_file_retention_hours
+    self.orphan_files_every_n_runs = orphan_files_every_n_runs
+    self._runs = 0
+    self._pending_delete_files = 0
+
+  def isDue(self, batch_id) -> bool:
+    return self.interval_batches > 0 and batch_id > 0 and batch_id % self.interval_batches == 0
+
+  def addDeleteFiles(self, count):
+    self._pending_delete_files += count
+
+  def _older_than(self, hours) -> str:
+    #XXX: AWS Glue runs Spark with the UTC session time zone.
+    timestamp = datetime.datetime.utcnow() - datetime.timedelta(hours=hours)
+    return f"TIMESTAMP '{timestamp.strftime('%Y-%m-%d %H:%M:%S')}'"
+
+  def _call(self, procedure, arguments):
+    start_time = time.monotonic()
+    try:
+      rows = self.spark.sql(f"CALL {self.catalog}.system.{procedure}({arguments})").collect()
+      result = rows[0].asDict() if rows else {}
+    except Exception as ex:
+      #XXX: A failed maintenance step should not stop the stream; it is tried again on the next run.
+      traceback.print_exc()
+      result = {'error': str(ex)}
+    result['elapsed_sec'] = round(time.monotonic() - start_time, 3)
+    return result
+
+  def run(self):
+    self._runs += 1
+    table_ident = f"{self.catalog}.{self.table}"
+    #XXX: Iceberg rewrites the data files smaller than 75% of the target file size by default.
+    small_file_size_bytes = int(self.target_file_size_bytes * 0.75)
+    files = self.spark.sql(f"""SELECT count(*) AS file_count,
+      count_if(content = 0 AND file_size_in_bytes < {small_file_size_bytes}) AS small_file_count
+      FROM {table_ident}.files""").collect()[0]
+    manifest_count = self.spark.sql(f"SELECT count(*) AS manifest_count FROM {table_ident}.manifests").collect()[0]['manifest_count']
+
+    report = {
+      'event': 'iceberg_table_maintenance',
+      'table': table_ident,
+      'file_count': files['file_count'],
+      'small_file_count': files['small_file_count'],
+      'manifest_count': manifest_count,
+      'pending_delete_files': self._pending_delete_files
+    }
+    apply_deletes = self._pending_delete_files > 0 and self._pending_delete_files >= self.max_delete_files
+    if files['small_file_count'] >= self.min_small_files or apply_deletes:
+      rewrite_options = {
+        'target-file-size-bytes': self.target_file_size_bytes,
+        'min-input-files': self.min_small_files,
+        'partial-progress.enabled': 'true'
+      }
+      if apply_deletes:
+        #XXX: Also rewrite the data files that merge-on-read writes have added delete files for, whatever their size,
+        # so that reads stop applying those deletes (the option needs Iceberg 1.0, i.e. AWS Glue 4.0, like the delete files).
+        rewrite_options['delete-file-threshold'] = 1
+      options = ', '.join([f"'{k}', '{v}'" for k, v in rewrite_options.items()])
+      report['rewrite_data_files'] = self._call('rewrite_data_files', f"table => '{self.table}', options => map({options})")
+      if apply_deletes and 'error' not in report['rewrite_data_files']:
+        self._pending_delete_files = 0
+    if manifest_count >= self.max_manifests:
+      report['rewrite_manifests'] = self._call('rewrite_manifests', f"table => '{self.table}'")
+    report['expire_snapshots'] = self._call('expire_snapshots', f"""table => '{self.table}',
+      older_than => {self._older_than(self.snapshot_retention_hours)},
+      retain_last => {self.retain_last_snapshots}""")
+    #XXX: Listing the whole table location is expensive, so orphan files are removed less often.
+    # Their retention has to be longer than any write can take, otherwise in-flight files are deleted.
+    if (self._runs - 1) % self.orphan_files_every_n_runs == 0:
+      report['remove_orphan_files'] = self._call('remove_orphan_files', f"""table => '{self.table}',
+        older_than => {self._older_than(self.orphan_file_retention_hours)}""")
+    print(json.dumps(report, default=str))
+
+
+class IcebergWriteMode:
+  '''Switch the row-level writes of a table between copy-on-write and merge-on-read, and report what each micro-batch committed
+
+  With merge-on-read, MERGE writes delete files next to the new data files instead of rewriting every data file
+  that holds an updated row, so frequent upserts get cheaper while reads pay for applying the deletes until
+  the table maintenance rewrites the data files.
+  '''
+
+  MODE_PROPERTIES = ['write.delete.mode', 'write.update.mode', 'write.merge.mode']
+  SUMMARY_KEYS = ['added-data-files', 'deleted-data-files', 'added-delete-files',
+    'added-position-delete-files', 'added-equality-delete-files']
+
+  def __init__(self, spark, catalog, database, table_name, mode):
+    self.spark = spark
+    self.table_ident = f"{catalog}.{database}.{table_name}"
+    self.mode = mode
+    self.effective_mode = None
+    self.app_id = spark.sparkContext.applicationId
+
+  def configure(self):
+    if self.effective_mode is not None:
+      return
+    rows = self.spark.sql(f"SHOW TBLPROPERTIES {self.table_ident}").collect()
+    properties = {row['key']: row['value'] for row in rows}
+    if self.mode == 'merge-on-read':
+      #XXX: Delete files need the format version 2 of Iceberg tables.
+      wanted = {'format-version': '2', **{k: self.mode for k in self.MODE_PROPERTIES}}
+    else:
+      #XXX: Copy-on-write is the default, so only the properties left over from merge-on-read are changed.
+      wanted = {k: self.mode for k in self.MODE_PROPERTIES if k in properties}
+    changed = {k: v for k, v in wanted.items() if properties.get(k) != v}
+    if changed:
+      table_properties = ', '.join([f"'{k}' = '{v}'" for k, v in changed.items()])
+      self.spark.sql(f"ALTER TABLE {self.table_ident} SET TBLPROPERTIES ({table_properties})")
+
+    #XXX: Iceberg plans merge-on-read row-level writes from Spark 3.2 (AWS Glue 4.0);
+    # on Spark 3.1 (AWS Glue 3.0) MERGE ignores the properties and keeps rewriting data files.
+    spark_version = tuple([int(e) for e in self.spark.version.split('.')[:2]])
+    self.effective_mode = self.mode if spark_version >= (3, 2) else 'copy-on-write'
+    print(json.dumps({
+      'event': 'iceberg_write_mode',
+      'table': self.table_ident,
+      'write_mode': self.mode,
+      'effective_write_mode': self.effective_mode,
+      'changed_properties': changed,
+      'spark_version': self.spark.version
+    }))
+
+  def isMergeOnRead(self) -> bool:
+    return self.effective_mode == 'merge-on-read'
+
+  def reportCommits(self, batch_id, snapshot_rows) -> dict:
+    '''Sum the snapshot summaries of the commits this job made among `snapshot_rows`, i.e. by this micro-batch
+
+    `snapshot_rows` are the rows of the `snapshots` metadata table committed since the micro-batch started, oldest first.
+    Only merge-on-read writes add delete files, so with copy-on-write nothing is reported and None is returned;
+    the caller does not need to read the snapshots then.
+    '''
+    if not self.isMergeOnRead():
+      return None
+
+    #XXX: Other writers can commit to the table at the same time, so only the snapshots of this Spark application are counted.
+    summaries = [row['summary'] for row in snapshot_rows if (row['summary'] or {}).get('spark.app.id') == self.app_id]
+
+    report = {
+      'event': 'iceberg_batch_commit',
+      'table': self.table_ident,
+      'batch_id': batch_id,
+      'write_mode': self.effective_mode,
+      'snapshots': len(summaries)
+    }
+    for key in self.SUMMARY_KEYS:
+      report[key.replace('-', '_')] = sum([int(summary.get(key, 0)) for summary in summaries])
+    report['total_delete_files'] = int(summaries[-1].get('total-delete-files', 0)) if summaries else None
+    print(json.dumps(report))
+    return report
+
+
+class IcebergCommitMonitor:
+  '''Set the commit retries of a table, and report the commits of each micro-batch and the contention they met
+
+  A commit takes the DynamoDB lock of the table to swap its metadata, and when another writer has committed
+  in the meantime, it is retried on top of the new metadata after an exponential backoff.
+  Iceberg 0.13 and 1.0 (AWS Glue 3.0 and 4.0) do not report these attempts, so they are bounded
+  by the snapshots other writers committed while the micro-batch was writing, each of which can fail
+  one attempt at most. `commit_sec` is the time from the last snapshot of the micro-batch to the end of
+  its writes, i.e. the lock wait, metadata write and catalog update of the attempt that succeeded.
+  Unless it is `enabled`, the monitor only sets the commit retries, and the commits are not reported.
+  '''
+
+  RETRY_PROPERTIES = ['commit.retry.num-retries', 'commit.retry.min-wait-ms',
+    'commit.retry.max-wait-ms', 'commit.retry.total-timeout-ms']
+  DEFAULT_NUM_RETRIES = 4
+
+  def __init__(self, spark, table_ident, retry_properties: dict, enabled=False):
+    self.spark = spark
+    self.table_ident = table_ident
+    self.retry_properties = {k: v for k, v in retry_properties.items() if v}
+    self.enabled = enabled
+    #XXX: Spark writes add the application id to the snapshot summary, which tells the commits of this job from the others.
+    self.app_id = spark.sparkContext.applicationId
+    self._properties = None
+    self._committed_after = None
+    self._start_time = None
+    self._end_time = None
+    self._write_sec = None
+
+  def configure(self):
+    if self._properties is not None:
+      return
+    rows = self.spark.sql(f"SHOW TBLPROPERTIES {self.table_ident}").collect()
+    properties = {row['key']: row['value'] for row in rows}
+    changed = {k: v for k, v in self.retry_properties.items() if properties.get(k) != v}
+    if changed:
+      table_properties = ', '.join([f"'{k}' = '{v}'" for k, v in changed.items()])
+      self.spark.sql(f"ALTER TABLE {self.table_ident} SET TBLPROPERTIES ({table_properties})")
+    self._properties = {**properties, **changed}
+
+  def start(self):
+    '''Mark the start of the writes of a micro-batch, and return the commit time of the latest snapshot before them'''
+    self.configure()
+    self._committed_after = self.spark.sql(f"SELECT max(committed_at) AS committed_at FROM {self.table_ident}.snapshots") \
+      .collect()[0]['committed_at']
+    self._start_time = time.monotonic()
+    return self._committed_after
+
+  def stop(self):
+    '''Mark the end of the writes of a micro-batch, right after them, so that reading its snapshots is not timed'''
+    self._end_time = time.time()
+    self._write_sec = time.monotonic() - self._start_time
+
+  def readSnapshots(self) -> list:
+    '''Read the snapshots committed since start(), oldest first, once for every report of the micro-batch'''
+    snapshots_df = self.spark.table(f"{self.table_ident}.snapshots")
+    if self._committed_after is not None:
+      snapshots_df = snapshots_df.filter(col('committed_at') > self._committed_after)
+    return snapshots_df.orderBy('committed_at').select('committed_at', 'summary').collect()
+
+  def report(self, batch_id, snapshot_rows=None) -> dict:
+    if snapshot_rows is None:
+      snapshot_rows = self.readSnapshots()
+    snapshots = [(row['committed_at'], (row['summary'] or {}).get('spark.app.id')) for row in snapshot_rows]
+    commit_times = [committed_at for committed_at, app_id in snapshots if app_id == self.app_id]
+    #XXX: Only the commits of other writers before the last commit of this micro-batch can have failed one of its attempts.
+    conflicting_commits = len([committed_at for committed_at, app_id in snapshots
+      if app_id != self.app_id and commit_times and committed_at < commit_times[-1]])
+    num_retries = int(self._properties.get('commit.retry.num-retries', self.DEFAULT_NUM_RETRIES))
+    max_retries = min(conflicting_commits, num_retries * len(commit_times))
+
+    report = {
+      'event': 'iceberg_commit_contention',
+      'table': self.table_ident,
+      'batch_id': batch_id,
+      'commits': len(commit_times),
+      'concurrent_commits': len(snapshots) - len(commit_times),
+      'max_conflict_retries': max_retries,
+      'max_commit_attempts': len(commit_times) + max_retries,
+      'write_sec': self._write_sec,
+      'commit_sec': max(self._end_time - commit_times[-1].timestamp(), 0.0) if commit_times else None,
+      'retry_properties': {k: self._properties[k] for k in self.RETRY_PROPERTIES if k in self._properties}
+    }
+    print(json.dumps(report))
+    return report
+
+
+class IcebergIdempotentWriter:
+  '''Skip the micro-batches a restarted job replays, by the batch ids in the snapshot summaries of the table
+
+  When a job stops after a micro-batch has committed to the table but before the checkpoint has, `forEachBatch`
+  runs that micro-batch again on restart. Each write adds the writer id and the batch id to the summary of its
+  snapshot, and a micro-batch is skipped when a snapshot of the same writer already has its batch id or a later one.
+  The writer id is the checkpoint location, because a new checkpoint numbers its micro-batches from 0 again.
+  The snapshots are only looked up on the first micro-batch of a job run, and only the ones still in the table
+  metadata, so the snapshot expiration has to keep the last snapshot of the job (see `maintenance_retain_last_snapshots`).
+  '''
+
+  WRITER_ID_PROPERTY = 'streaming.writer-id'
+  BATCH_ID_PROPERTY = 'streaming.batch-id'
+
+  def __init__(self, spark, table_ident, writer_id):
+    self.spark = spark
+    self.table_ident = table_ident
+    self.writer_id = writer_id
+    self.last_batch_id = None
+    self._is_loaded = False
+
+  def _load(self):
+    summary = col('summary')
+    rows = self.spark.table(f"{self.table_ident}.snapshots") \
+      .filter(summary.getItem(self.WRITER_ID_PROPERTY) == self.writer_id) \
+      .select(summary.getItem(self.BATCH_ID_PROPERTY).cast('bigint').alias('batch_id')) \
+      .agg(expr('max(batch_id) AS batch_id')) \
+      .collect()
+    self.last_batch_id = rows[0]['batch_id']
+    self._is_loaded = True
+
+  def isCommitted(self, batch_id) -> bool:
+    if not self._is_loaded:
+      self._load()
+    return self.last_batch_id is not None and batch_id <= self.last_batch_id
+
+  def writer(self, data_frame, batch_id):
+    '''A DataFrameWriterV2 of the table, which records `batch_id` in the summary of the snapshot it commits'''
+    return data_frame.writeTo(self.table_ident) \
+      .option(f"snapshot-property.{self.WRITER_ID_PROPERTY}", self.writer_id) \
+      .option(f"snapshot-property.{self.BATCH_ID_PROPERTY}", str(batch_id))
+
+  def overwrite(self, data_frame, batch_id):
+    '''Overwrite the table with `data_frame` like an INSERT OVERWRITE statement without a PARTITION clause
+
+    That replaces only the partitions `data_frame` writes when `spark.sql.sources.partitionOverwriteMode`
+    is `dynamic`, and the whole table otherwise (Spark's default, `static`).
+    '''
+    writer = self.writer(data_frame, batch_id)
+    if self.spark.conf.get('spark.sql.sources.partitionOverwriteMode', 'static').lower() == 'dynamic':
+      writer.overwritePartitions()
+    else:
+      writer.overwrite(lit(True))
+    self.markCommitted(batch_id)
+
+  def markCommitted(self, batch_id):
+    self.last_batch_id = batch_id if self.last_batch_id is None else max(self.last_batch_id, batch_id)
+
+  def reportSkipped(self, batch_id):
+    print(json.dumps({
+      'event': 'idempotent_batch_skipped',
+      'table': self.table_ident,
+      'writer_id': self.writer_id,
+      'batch_id': batch_id,
+      'last_committed_batch_id': self.last_batch_id
+    }))
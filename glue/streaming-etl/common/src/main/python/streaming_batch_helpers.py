@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+'''Batch-processing helpers shared by the AWS Glue streaming ETL jobs
+
+Ship this file with the job as `--extra-py-files`, e.g. `s3://<glue-assets>/scripts/streaming_batch_helpers.py`.
+'''
+
+import datetime
+import decimal
+import math
+import os
+
+from pyspark.sql.types import (
+  DateType,
+  StringType,
+  StructField,
+  StructType,
+  TimestampType
+)
+from pyspark.sql.functions import (
+  coalesce,
+  col,
+  current_timestamp,
+  expr,
+  from_json,
+  struct
+)
+
+
+def getOptionalResolvedOptions(argv, defaults: dict) -> dict:
+  '''Resolve optional job arguments, falling back to `defaults` for the ones not given.'''
+  #XXX: awsglue is only importable in the Glue job, and the other helpers are also used locally without it.
+  from awsglue.utils import getResolvedOptions
+  options = [k for k in defaults if f'--{k}' in argv]
+  resolved = getResolvedOptions(argv, options) if options else {}
+  return {k: resolved.get(k, v) for k, v in defaults.items()}
+
+def isEmptyDataFrame(data_frame) -> bool:
+  #XXX: DataFrame.isEmpty() is available since Spark 3.3, so fetch at most one row
+  # instead of counting the whole micro-batch.
+  return len(data_frame.head(1)) == 0
+
+def countByOperation(data_frame, op_column='_op') -> dict:
+  '''Count rows per CDC operation with a single aggregation, e.g. {'insert': 3, 'delete': 1}'''
+  return {row[op_column]: row['count'] for row in data_frame.groupBy(op_column).count().collect()}
+
+def toSqlLiteral(value) -> str:
+  if value is None:
+    return 'NULL'
+  if isinstance(value, bool):
+    return 'TRUE' if value else 'FALSE'
+  #XXX: str() renders non-finite floats as nan and inf, which Spark SQL would read as column names.
+  if isinstance(value, float) and math.isnan(value):
+    return "double('NaN')"
+  if isinstance(value, float) and math.isinf(value):
+    return "double('Infinity')" if value > 0 else "double('-Infinity')"
+  if isinstance(value, (int, float, decimal.Decimal)):
+    return str(value)
+  if isinstance(value, datetime.datetime):
+    return f"TIMESTAMP '{value.strftime('%Y-%m-%d %H:%M:%S.%f')}'"
+  if isinstance(value, datetime.date):
+    return f"DATE '{value.isoformat()}'"
+  return "'{}'".format(str(value).replace('\\', '\\\\').replace("'", "\\'"))
+
+def buildMergePruningPredicate(source_df, primary_key, partition_columns, key_range=True, max_values=1000, alias='t') -> str:
+  '''Build predicates on the target table from the key range and partition values present in the source
+
+  They are added to the MERGE ON clause so that Iceberg can skip the data files that cannot match any source row.
+  '''
+  agg_exprs = [f"min({primary_key}) AS _min_key", f"max({primary_key}) AS _max_key"] if key_range else []
+  for i, c in enumerate(partition_columns):
+    agg_exprs += [f"collect_set({c}) AS _values_{i}", f"max({c} IS NULL) AS _has_null_{i}"]
+  if not agg_exprs:
+    return ''
+
+  row = source_df.selectExpr(*agg_exprs).collect()[0]
+
+  predicates = []
+  if key_range and row['_min_key'] is not None:
+    predicates.append(f"{alias}.{primary_key} BETWEEN {toSqlLiteral(row['_min_key'])} AND {toSqlLiteral(row['_max_key'])}")
+  for i, c in enumerate(partition_columns):
+    values, has_null = row[f'_values_{i}'], row[f'_has_null_{i}']
+    if len(values) > max_values:
+      continue
+    value_predicates = [f"{alias}.{c} IN ({', '.join([toSqlLiteral(v) for v in values])})"] if values else []
+    value_predicates += [f"{alias}.{c} IS NULL"] if has_null else []
+    if value_predicates:
+      predicates.append(f"({' OR '.join(value_predicates)})")
+  return ' AND '.join(predicates)
+
+def buildCombinedMergeQuery(target_table, source_view, merge_condition, columns, op_column='_op', delete_op='delete') -> str:
+  '''Build a MERGE statement that applies upserts and deletes of a CDC batch in a single commit'''
+  update_set = ', '.join([f"t.{c} = s.{c}" for c in columns])
+  insert_columns = ', '.join(columns)
+  insert_values = ', '.join([f"s.{c}" for c in columns])
+
+  return f"""MERGE INTO {target_table} t
+    USING {source_view} s ON {merge_condition}
+    WHEN MATCHED AND s.{op_column} = '{delete_op}' THEN DELETE
+    WHEN MATCHED THEN UPDATE SET {update_set}
+    WHEN NOT MATCHED AND s.{op_column} != '{delete_op}' THEN INSERT ({insert_columns}) VALUES ({insert_values})
+    """
+
+def dedupLatest(data_frame, primary_key, order_column, columns, tiebreak_columns=None):
+  '''Keep the latest row of each primary key, i.e. the row with the max `order_column`
+
+  Unlike ranking the rows of each key over a window, max_by() is partially aggregated before the shuffle,
+  so duplicates are collapsed before they are exchanged and no rows are sorted by time.
+  Rows with the same `order_column` are ordered by `tiebreak_columns` (names or Columns), and only by them,
+  so the value columns are never compared, which also fails for map columns.
+  '''
+  ordering = struct(col(order_column), *[col(c) if isinstance(c, str) else c for c in (tiebreak_columns or [])])
+  value_columns = [c for c in columns if c != primary_key]
+  return data_frame.withColumn('_ordering', ordering) \
+    .groupBy(primary_key) \
+    .agg(expr(f"max_by(struct({', '.join([f'`{c}`' for c in value_columns])}), _ordering)").alias('_latest')) \
+    .select(primary_key, '_latest.*') \
+    .select(columns)
+
+def toPayloadSchema(table_schema) -> StructType:
+  #XXX: Timestamp and date columns are read as strings, because the batch function converts them itself.
+  return StructType([StructField(f.name, StringType() if isinstance(f.dataType, (DateType, TimestampType)) else f.dataType, True)
+    for f in table_schema.fields])
+
+def parsePayloads(raw_df, payload_schema):
+  schema_with_corrupt_record = StructType(payload_schema.fields + [StructField('_corrupt_record', StringType(), True)])
+  return raw_df.select(col('_payload'),
+    from_json(col('_payload'), schema_with_corrupt_record,
+      {'mode': 'PERMISSIVE', 'columnNameOfCorruptRecord': '_corrupt_record'}).alias('_parsed'))
+
+def dropDuplicateEvents(parsed_df, event_key, event_time, watermark_delay):
+  '''Drop the records whose key and event time were already seen, also in earlier micro-batches
+
+  The state store only keeps the events newer than the watermark, i.e. `watermark_delay` behind
+  the latest event time seen so far, and records older than the watermark are dropped as late.
+  Malformed records are keyed by their payload, so that they still reach the dead-letter path.
+  '''
+  return parsed_df \
+    .withColumn('_event_key', coalesce(event_key.cast('string'), col('_payload'))) \
+    .withColumn('_event_time', coalesce(event_time, current_timestamp())) \
+    .withWatermark('_event_time', watermark_delay) \
+    .dropDuplicates(['_event_key', '_event_time']) \
+    .drop('_event_key', '_event_time')
+
+#XXX: The option that caps the records of a micro-batch, and the column of the record payload, of each source
+RAW_SOURCE_FORMATS = {
+  'kinesis': ('maxFetchRecordsPerShard', 'data'),
+  'kafka': ('maxOffsetsPerTrigger', 'value')
+}
+
+def createRawSourceDataFrame(spark, source_format, reader_options: dict, max_records_per_trigger=None):
+  '''Read the Kinesis or Kafka records as they are, so that the batch function parses them against a fixed schema'''
+  limit_option, payload_column = RAW_SOURCE_FORMATS[source_format]
+  if max_records_per_trigger:
+    reader_options = {**reader_options, limit_option: str(max_records_per_trigger)}
+  return spark.readStream.format(source_format).options(**reader_options).load() \
+    .selectExpr(f"CAST({payload_column} AS STRING) AS _payload")
+
+def loadPayloadSchema(spark, table_ident) -> StructType:
+  '''Derive the payload schema once from the table instead of inferring it on every micro-batch'''
+  return toPayloadSchema(spark.table(table_ident).schema)
+
+def createParsedSourceDataFrame(spark, source_format, reader_options: dict, payload_schema, max_records_per_trigger=None,
+    dedup_key=None, dedup_event_time=None, dedup_watermark_delay=None):
+  '''Read the records with createRawSourceDataFrame and parse their payloads, dropping duplicate events with `dedup_watermark_delay`'''
+  raw_df = createRawSourceDataFrame(spark, source_format, reader_options, max_records_per_trigger)
+  parsed_df = parsePayloads(raw_df, payload_schema)
+  if dedup_watermark_delay:
+    parsed_df = dropDuplicateEvents(parsed_df, dedup_key, dedup_event_time, dedup_watermark_delay)
+  return parsed_df
+
+def processExplicitSchemaBatch(parsed_df, batch_id, process_batch, dead_letter_s3_path):
+  '''Write the malformed records of a parsed micro-batch to the dead-letter path, and pass the others to `process_batch`'''
+  parsed_df.persist()
+  try:
+    is_malformed = col('_parsed').isNull() | col('_parsed._corrupt_record').isNotNull()
+    malformed_df = parsed_df.filter(is_malformed).select('_payload')
+    if not isEmptyDataFrame(malformed_df):
+      #XXX: Overwrite the directory of the micro-batch, so that a replayed batch does not duplicate its dead letters.
+      malformed_df.write.mode('overwrite').text(os.path.join(dead_letter_s3_path, f"batch_id={batch_id}"))
+    process_batch(parsed_df.filter(~is_malformed).select('_parsed.*').drop('_corrupt_record'), batch_id)
+  finally:
+    parsed_df.unpersist()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+'''Progress reporting helpers shared by the AWS Glue streaming ETL jobs
+
+Ship this file with the job as `--extra-py-files`, e.g. `s3://<glue-assets>/scripts/streaming_progress.py`.
+'''
+
+import boto3
+import json
+import threading
+import time
+import traceback
+import uuid
+from contextlib import contextmanager
+
+
+class KafkaOffsetReporter:
+  '''Log the offsets that each micro-batch consumed from every Kafka partition, and the lag it left behind
+
+  They are taken from the progress of the streaming query, which is complete only once a micro-batch has finished,
+  so they are logged by polling the progress the query keeps of its recent micro-batches, either while waiting
+  for the query (`reportRecent`) or when the next micro-batch starts (`wrap`). The latest offsets of the partitions,
+  and so the lag, are in the progress from Spark 3.2 (AWS Glue 4.0) on.
+  '''
+
+  def __init__(self, spark):
+    self.spark = spark
+    self._last_batch_ids = {}
+
+  @staticmethod
+  def _offsets(offsets) -> dict:
+    #XXX: The offsets of the Kafka source are {topic: {partition: offset}}.
+    if isinstance(offsets, str):
+      try:
+        offsets = json.loads(offsets)
+      except ValueError:
+        return {}
+    return offsets if isinstance(offsets, dict) else {}
+
+  def report(self, progress):
+    #XXX: Progress without `addBatch` is posted while the query idles, and ran no micro-batch.
+    if not progress or 'addBatch' not in progress.get('durationMs', {}):
+      return
+    if self._last_batch_ids.get(progress['runId'], -1) >= progress['batchId']:
+      return
+    self._last_batch_ids[progress['runId']] = progress['batchId']
+
+    for source in progress.get('sources', []):
+      start_offsets = self._offsets(source.get('startOffset'))
+      latest_offsets = self._offsets(source.get('latestOffset'))
+      partitions = []
+      for topic, end_offsets in self._offsets(source.get('endOffset')).items():
+        if not isinstance(end_offsets, dict):
+          continue
+        for partition, end_offset in sorted(end_offsets.items(), key=lambda e: int(e[0])):
+          start_offset = start_offsets.get(topic, {}).get(partition)
+          latest_offset = latest_offsets.get(topic, {}).get(partition)
+          partitions.append({
+            'topic': topic,
+            'partition': int(partition),
+            'end_offset': end_offset,
+            'consumed': end_offset - start_offset if start_offset is not None else None,
+            'lag': latest_offset - end_offset if latest_offset is not None else None
+          })
+      if not partitions:
+        continue
+      lags = [e['lag'] for e in partitions if e['lag'] is not None]
+      print(json.dumps({
+        'event': 'kafka_source_progress',
+        'batch_id': progress['batchId'],
+        'rows': source.get('numInputRows'),
+        'consumed': sum([e['consumed'] for e in partitions if e['consumed'] is not None]),
+        'total_lag': sum(lags) if lags else None,
+        'max_lag': max(lags) if lags else None,
+        'partitions': partitions
+      }))
+
+  def reportRecent(self, query):
+    #XXX: lastProgress only holds the latest progress, which idle progress replaces and which would miss the
+    # micro-batches that finish between two polls; recentProgress keeps the last
+    # `spark.sql.streaming.numRecentProgressUpdates` (default: 100), and report() skips those already logged.
+    for progress in query.recentProgress:
+      self.report(progress)
+
+  def reportFinished(self):
+    for query in self.spark.streams.active:
+      self.reportRecent(query)
+
+  def wrap(self, batch_function):
+    def reportingBatchFunction(data_frame, batch_id):
+      self.reportFinished()
+      batch_function(data_frame, batch_id)
+    return reportingBatchFunction
+
+
+class BatchProfiler:
+  '''Time the phases of each micro-batch, and record the Spark jobs and stages that each phase ran
+
+  `profile` wraps a batch function, caches and counts its input in a `read` phase, and logs a `batch_profile`
+  JSON line per micro-batch; with a CloudWatch namespace, the phase times and rows are also put as metrics.
+  Each `phase` runs in a Spark job group of its own, so that the status tracker tells its jobs and stages apart.
+  Phases only count on the thread of the batch function, i.e. not inside nested phases or worker threads,
+  and do nothing for batch functions that are not profiled.
+  '''
+
+  def __init__(self, spark, job_name, cloudwatch_namespace=None, region_name=None):
+    self.sc = spark.sparkContext
+    self.status_tracker = self.sc.statusTracker()
+    self.job_name = job_name
+    self.cloudwatch_namespace = cloudwatch_namespace
+    self.region_name = region_name
+    self._cloudwatch_client = None
+    self._batch = None
+    self._thread = None
+    self._in_phase = False
+
+  def _onBatchThread(self) -> bool:
+    return self._batch is not None and threading.current_thread() is self._thread
+
+  def record(self, key, value):
+    if self._onBatchThread():
+      self._batch['metrics'][key] = value
+
+  def countRows(self, key, data_frame):
+    '''Count the rows of `data_frame` only while profiling, since it costs a Spark job'''
+    if self._onBatchThread():
+      self.record(key, data_frame.count())
+
+  @contextmanager
+  def phase(self, name):
+    if not self._onBatchThread() or self._in_phase:
+      yield
+      return
+    group_id = f"{self._batch['profile_id']}-{len(self._batch['phases'])}-{name}"
+    previous_group_id = self.sc.getLocalProperty('spark.jobGroup.id')
+    self.sc.setLocalProperty('spark.jobGroup.id', group_id)
+    self._in_phase = True
+    start_time = time.monotonic()
+    try:
+      yield
+    finally:
+      elapsed_sec = time.monotonic() - start_time
+      self._in_phase = False
+      self.sc.setLocalProperty('spark.jobGroup.id', previous_group_id)
+      self._batch['phases'].append({'phase': name, 'elapsed_sec': elapsed_sec, **self._sparkWork(group_id)})
+
+  def _sparkWork(self, group_id) -> dict:
+    job_ids = sorted(self.status_tracker.getJobIdsForGroup(group_id))
+    job_infos = [e for e in [self.status_tracker.getJobInfo(job_id) for job_id in job_ids] if e is not None]
+    stage_ids = sorted(set([stage_id for e in job_infos for stage_id in e.stageIds]))
+    stage_infos = [e for e in [self.status_tracker.getStageInfo(stage_id) for stage_id in stage_ids] if e is not None]
+    #XXX: Stages whose output was already computed, e.g. the shuffle of a cached frame, are skipped and run no tasks.
+    executed_stages = [e for e in stage_infos if e.numCompletedTasks + e.numFailedTasks > 0]
+    return {
+      'job_ids': job_ids,
+      'stage_ids': [e.stageId for e in executed_stages],
+      'skipped_stages': len(stage_ids) - len(executed_stages),
+      'tasks': sum([e.numCompletedTasks for e in executed_stages]),
+      'failed_tasks': sum([e.numFailedTasks for e in executed_stages])
+    }
+
+  def profile(self, batch_function):
+    def profiledBatchFunction(data_frame, batch_id):
+      self._batch = {'batch_id': batch_id, 'profile_id': f"batch-{batch_id}-{uuid.uuid4().hex[:8]}", 'phases': [], 'metrics': {}}
+      self._thread = threading.current_thread()
+      start_time = time.monotonic()
+      error = None
+      #XXX: Cache the micro-batch, so that reading it from the source is timed apart from the phases that use it.
+      input_df = data_frame.persist()
+      try:
+        with self.phase('read'):
+          self.countRows('input_rows', input_df)
+        batch_function(input_df, batch_id)
+      except Exception as ex:
+        error = str(ex)
+        raise
+      finally:
+        input_df.unpersist()
+        batch, self._batch, self._thread = self._batch, None, None
+        self._report(batch, time.monotonic() - start_time, error)
+    return profiledBatchFunction
+
+  def _report(self, batch, elapsed_sec, error):
+    report = {
+      'event': 'batch_profile',
+      'job_name': self.job_name,
+      'batch_id': batch['batch_id'],
+      'elapsed_sec': elapsed_sec,
+      'phases': batch['phases'],
+      **batch['metrics']
+    }
+    if error is not None:
+      report['error'] = error
+    print(json.dumps(report, default=str))
+    if self.cloudwatch_namespace:
+      self._putMetrics(report)
+
+  def _putMetrics(self, report):
+    dimensions = [{'Name': 'JobName', 'Value': self.job_name}]
+    metric_data = [{'MetricName': 'BatchSeconds', 'Dimensions': dimensions, 'Value': report['elapsed_sec'], 'Unit': 'Seconds'}]
+    metric_data += [{'MetricName': 'PhaseSeconds', 'Dimensions': dimensions + [{'Name': 'Phase', 'Value': e['phase']}],
+      'Value': e['elapsed_sec'], 'Unit': 'Seconds'} for e in report['phases']]
+    metric_data += [{'MetricName': ''.join([w.capitalize() for w in k.split('_')]), 'Dimensions': dimensions,
+      'Value': v, 'Unit': 'Count'} for k, v in report.items() if k.endswith('_rows') and isinstance(v, int)]
+    try:
+      if self._cloudwatch_client is None:
+        self._cloudwatch_client = boto3.client('cloudwatch', region_name=self.region_name)
+      self._cloudwatch_client.put_metric_data(Namespace=self.cloudwatch_namespace, MetricData=metric_data)
+    except Exception:
+      #XXX: Metrics are best effort; they must not fail the micro-batch.
+      traceback.print_exc()
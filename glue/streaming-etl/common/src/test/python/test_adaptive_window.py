@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'main', 'python'))
+
+from adaptive_window import AdaptiveWindowController
+
+KAFKA_END_OFFSET = {'orders': {'0': 120000, '1': 118000}}
+KINESIS_END_OFFSET = {
+  'metadata': {'streamName': 'orders', 'batchId': '7'},
+  'shardId-000000000000': {'iteratorType': 'AFTER_SEQUENCE_NUMBER', 'iteratorPosition': '4960'},
+  'shardId-000000000001': {'iteratorType': 'AFTER_SEQUENCE_NUMBER', 'iteratorPosition': '4961'}
+}
+
+
+def buildProgress(batch_id, duration_sec, num_input_rows, end_offset, metrics=None):
+  '''A StreamingQueryProgress of `query.lastProgress`, with only the fields the controller reads'''
+  return {
+    'batchId': batch_id,
+    'numInputRows': num_input_rows,
+    #XXX: Without a lag metric, these rates only say that the micro-batch kept up with the input.
+    'inputRowsPerSecond': num_input_rows / duration_sec,
+    'processedRowsPerSecond': num_input_rows / duration_sec,
+    'durationMs': {'triggerExecution': int(duration_sec * 1000)},
+    'sources': [{'endOffset': end_offset, 'metrics': metrics or {}}]
+  }
+
+
+class AdaptiveWindowControllerTest(unittest.TestCase):
+
+  def newController(self):
+    return AdaptiveWindowController(100, 30, 300, 10000, 1000000,
+      target_utilization=0.8, min_restart_interval_sec=0, records_per_trigger=100000)
+
+  def shrinkByOverrun(self, controller, end_offset):
+    self.assertTrue(controller.observe(buildProgress(0, 150, 100000, end_offset)))
+    self.assertEqual(controller.records_per_trigger, 50000)
+
+  def test_kafka_limit_grows_back_when_batches_read_up_to_the_limit(self):
+    controller = self.newController()
+    self.shrinkByOverrun(controller, KAFKA_END_OFFSET)
+    self.assertTrue(controller.observe(buildProgress(1, 40, 50000, KAFKA_END_OFFSET)))
+    self.assertEqual(controller.records_per_trigger, 100000)
+
+  def test_kinesis_limit_grows_back_when_every_shard_reads_up_to_the_limit(self):
+    controller = self.newController()
+    self.shrinkByOverrun(controller, KINESIS_END_OFFSET)
+    #XXX: `maxFetchRecordsPerShard` caps each of the 2 shards, so 50000 rows are only half of the limit.
+    controller.observe(buildProgress(1, 40, 50000, KINESIS_END_OFFSET))
+    self.assertEqual(controller.records_per_trigger, 50000)
+    self.assertTrue(controller.observe(buildProgress(2, 20, 100000, KINESIS_END_OFFSET)))
+    self.assertEqual(controller.records_per_trigger, 100000)
+
+  def test_kinesis_limit_grows_back_from_ms_behind_latest(self):
+    controller = self.newController()
+    self.shrinkByOverrun(controller, KINESIS_END_OFFSET)
+    controller.observe(buildProgress(1, 40, 20000, KINESIS_END_OFFSET, {'avgMsBehindLatest': '45000.0'}))
+    self.assertEqual(controller.records_per_trigger, 100000)
+
+  def test_limit_holds_when_the_source_has_caught_up(self):
+    controller = self.newController()
+    self.shrinkByOverrun(controller, KAFKA_END_OFFSET)
+    controller.observe(buildProgress(1, 40, 20000, KAFKA_END_OFFSET))
+    controller.observe(buildProgress(2, 40, 50000, KAFKA_END_OFFSET, {'maxOffsetsBehindLatest': '0'}))
+    self.assertEqual(controller.records_per_trigger, 50000)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -29,6 +29,7 @@ class GlueStreamingJobStack(Stack):
       "--job-bookmark-option": "job-bookmark-disable",
       "--job-language": "python",
       "--TempDir": f"s3://{glue_assets_s3_bucket_name}/temporary/",
+      "--extra-py-files": f"s3://{glue_assets_s3_bucket_name}/scripts/streaming_batch_helpers.py,s3://{glue_assets_s3_bucket_name}/scripts/adaptive_window.py,s3://{glue_assets_s3_bucket_name}/scripts/iceberg_table_helpers.py,s3://{glue_assets_s3_bucket_name}/scripts/streaming_progress.py",
       "--kafka_connection_name": msk_connection_name,
       "--kafka_bootstrap_servers": kafka_bootstrap_servers,
     }
@@ -20,6 +20,9 @@ from pyspark.sql.functions import (
   to_timestamp
 )
 
+from streaming_batch_helpers import getOptionalResolvedOptions
+from streaming_progress import KafkaOffsetReporter
+
 
 args = getResolvedOptions(sys.argv, ['JOB_NAME',
   'catalog',
@@ -36,6 +39,24 @@ args = getResolvedOptions(sys.argv, ['JOB_NAME',
   'window_size'
 ])
 
+args.update(getOptionalResolvedOptions(sys.argv, {
+  'lock_acquire_interval_ms': '',
+  'lock_acquire_timeout_ms': '',
+  'commit_retry_num_retries': '',
+  'commit_retry_min_wait_ms': '',
+  'commit_retry_max_wait_ms': '',
+  'commit_retry_total_timeout_ms': '',
+  'max_offsets_per_trigger': '',
+  'min_partitions': '',
+  'fetch_max_bytes': '',
+  'max_partition_fetch_bytes': '',
+  'consumer_cache_capacity': '',
+  'consumer_cache_timeout': '',
+  'fail_on_data_loss': '',
+  'checkpoint_min_batches_to_retain': '',
+  'checkpoint_location': ''
+}))
+
 CATALOG = args['catalog']
 
 ICEBERG_S3_PATH = args['iceberg_s3_path']
@@ -56,6 +77,33 @@ STARTING_OFFSETS_OF_KAFKA_TOPIC = args.get('starting_offsets_of_kafka_topic', 'l
 AWS_REGION = args['aws_region']
 WINDOW_SIZE = args.get('window_size', '100 seconds')
 
+#XXX: Empty values keep the defaults of Iceberg, i.e. the DynamoDB lock is tried every 5 seconds for up to 3 minutes,
+# and a commit that conflicts with another writer is retried 4 times, waiting from 100 ms up to 60 seconds in between.
+LOCK_ACQUIRE_PROPERTIES = {
+  'lock.acquire-interval-ms': args['lock_acquire_interval_ms'],
+  'lock.acquire-timeout-ms': args['lock_acquire_timeout_ms']
+}
+COMMIT_RETRY_PROPERTIES = {
+  'commit.retry.num-retries': args['commit_retry_num_retries'],
+  'commit.retry.min-wait-ms': args['commit_retry_min_wait_ms'],
+  'commit.retry.max-wait-ms': args['commit_retry_max_wait_ms'],
+  'commit.retry.total-timeout-ms': args['commit_retry_total_timeout_ms']
+}
+
+#XXX: Empty values keep the defaults of the Kafka source, i.e. no limit of offsets per micro-batch,
+# a Spark partition per Kafka partition, 64 cached consumers per executor and failing when offsets are gone.
+KAFKA_SOURCE_OPTIONS = {k: v for k, v in {
+  'maxOffsetsPerTrigger': args['max_offsets_per_trigger'],
+  'minPartitions': args['min_partitions'],
+  'failOnDataLoss': args['fail_on_data_loss'],
+  'kafka.fetch.max.bytes': args['fetch_max_bytes'],
+  'kafka.max.partition.fetch.bytes': args['max_partition_fetch_bytes']
+}.items() if v}
+KAFKA_CONSUMER_POOL_CONF = {k: v for k, v in {
+  'spark.kafka.consumer.cache.capacity': args['consumer_cache_capacity'],
+  'spark.kafka.consumer.cache.timeout': args['consumer_cache_timeout']
+}.items() if v}
+
 def setSparkIcebergConf() -> SparkConf:
   conf_list = [
     (f"spark.sql.catalog.{CATALOG}", "org.apache.iceberg.spark.SparkCatalog"),
@@ -67,6 +115,8 @@ def setSparkIcebergConf() -> SparkConf:
     ("spark.sql.extensions", "org.apache.iceberg.spark.extensions.IcebergSparkSessionExtensions"),
     ("spark.sql.iceberg.handle-timestamp-without-timezone", "true")
   ]
+  conf_list += [(f"spark.sql.catalog.{CATALOG}.{k}", v) for k, v in LOCK_ACQUIRE_PROPERTIES.items() if v]
+  conf_list += list(KAFKA_CONSUMER_POOL_CONF.items())
   spark_conf = SparkConf().setAll(conf_list)
   return spark_conf
 
@@ -81,7 +131,8 @@ job.init(args['JOB_NAME'], args)
 options_read = {
   "kafka.bootstrap.servers": KAFKA_BOOTSTRAP_SERVERS,
   "subscribe": KAFKA_TOPIC_NAME,
-  "startingOffsets": STARTING_OFFSETS_OF_KAFKA_TOPIC
+  "startingOffsets": STARTING_OFFSETS_OF_KAFKA_TOPIC,
+  **KAFKA_SOURCE_OPTIONS
 }
 
 schema = StructType([
@@ -98,7 +149,26 @@ stream_data_df = streaming_data \
     .withColumn('m_time', to_timestamp(col('m_time'), 'yyyy-MM-dd HH:mm:ss'))
 
 table_id = f"{CATALOG}.{DATABASE}.{TABLE_NAME}"
-checkpointPath = os.path.join(args["TempDir"], args["JOB_NAME"], "checkpoint/")
+#XXX: e.g., a checkpoint written by the checkpoint tool, to restart the job from other offsets
+checkpointPath = args['checkpoint_location'] or os.path.join(args["TempDir"], args["JOB_NAME"], "checkpoint/")
+
+#XXX: The checkpoint keeps the offsets and commits of the last `checkpoint_min_batches_to_retain` micro-batches
+# (Spark default: 100); fewer of them make the checkpoint smaller and faster to list when the job restarts.
+if args['checkpoint_min_batches_to_retain']:
+  spark.conf.set("spark.sql.streaming.minBatchesToRetain", args['checkpoint_min_batches_to_retain'])
+
+def setCommitRetryProperties(table_ident, retry_properties: dict):
+  #XXX: Commit retries are table properties, so they are set on the table once before streaming, not on every write.
+  retry_properties = {k: v for k, v in retry_properties.items() if v}
+  if not retry_properties:
+    return
+  properties = {row['key']: row['value'] for row in spark.sql(f"SHOW TBLPROPERTIES {table_ident}").collect()}
+  changed = {k: v for k, v in retry_properties.items() if properties.get(k) != v}
+  if changed:
+    table_properties = ', '.join([f"'{k}' = '{v}'" for k, v in changed.items()])
+    spark.sql(f"ALTER TABLE {table_ident} SET TBLPROPERTIES ({table_properties})")
+
+setCommitRetryProperties(table_id, COMMIT_RETRY_PROPERTIES)
 
 #XXX: Writing against partitioned table
 # https://iceberg.apache.org/docs/0.14.0/spark-structured-streaming/#writing-against-partitioned-table
@@ -112,4 +182,9 @@ query = stream_data_df.writeStream \
     .option("checkpointLocation", checkpointPath) \
     .start()
 
-query.awaitTermination()
+offset_reporter = KafkaOffsetReporter(spark)
+#XXX: Wait for the query in steps, so that the offsets of every micro-batch are logged soon after it finishes.
+# PySpark has no StreamingQueryListener before Spark 3.4, so the progress is polled instead.
+while not query.awaitTermination(10):
+  offset_reporter.reportRecent(query)
+offset_reporter.reportRecent(query)
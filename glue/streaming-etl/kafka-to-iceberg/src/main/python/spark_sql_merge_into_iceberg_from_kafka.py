@@ -2,6 +2,8 @@
 # -*- encoding: utf-8 -*-
 # vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
 
+import boto3
+import functools
 import os
 import sys
 import traceback
@@ -15,14 +17,30 @@ from awsglue import DynamicFrame
 from pyspark.context import SparkContext
 from pyspark.conf import SparkConf
 from pyspark.sql import DataFrame, Row
-from pyspark.sql.window import Window
+from pyspark.sql.utils import AnalysisException
 from pyspark.sql.functions import (
   col,
-  desc,
-  row_number,
   to_timestamp
 )
 
+from streaming_batch_helpers import (
+  isEmptyDataFrame,
+  buildMergePruningPredicate,
+  dedupLatest,
+  getOptionalResolvedOptions,
+  loadPayloadSchema,
+  createParsedSourceDataFrame,
+  processExplicitSchemaBatch
+)
+from adaptive_window import AdaptiveWindowController, parseWindowSizeSec, runAdaptiveForEachBatch
+from iceberg_table_helpers import (
+  TableMetadataCache,
+  IcebergTableMaintenance,
+  IcebergWriteMode,
+  IcebergCommitMonitor
+)
+from streaming_progress import KafkaOffsetReporter, BatchProfiler
+
 args = getResolvedOptions(sys.argv, ['JOB_NAME',
   'catalog',
   'database_name',
@@ -37,6 +55,51 @@ args = getResolvedOptions(sys.argv, ['JOB_NAME',
   'window_size'
 ])
 
+args.update(getOptionalResolvedOptions(sys.argv, {
+  'metadata_cache_ttl_sec': '300',
+  'merge_pruning_key_range': 'true',
+  'merge_pruning_partition_columns': '',
+  'merge_pruning_max_values': '1000',
+  'adaptive_window': 'false',
+  'adaptive_min_window_sec': '30',
+  'adaptive_max_window_sec': '300',
+  'adaptive_min_records_per_trigger': '10000',
+  'adaptive_max_records_per_trigger': '1000000',
+  'adaptive_target_utilization': '0.8',
+  'adaptive_min_batch_rows': '1000',
+  'maintenance_interval_batches': '0',
+  'maintenance_target_file_size_bytes': '134217728',
+  'maintenance_min_small_files': '20',
+  'maintenance_max_manifests': '50',
+  'maintenance_snapshot_retention_hours': '24',
+  'maintenance_retain_last_snapshots': '10',
+  'maintenance_orphan_file_retention_hours': '72',
+  'maintenance_orphan_files_every_n_runs': '24',
+  'schema_mode': 'infer',
+  'dead_letter_s3_path': '',
+  'dedup_watermark_delay': '',
+  'write_mode': 'copy-on-write',
+  'maintenance_max_delete_files': '10',
+  'lock_acquire_interval_ms': '',
+  'lock_acquire_timeout_ms': '',
+  'commit_retry_num_retries': '',
+  'commit_retry_min_wait_ms': '',
+  'commit_retry_max_wait_ms': '',
+  'commit_retry_total_timeout_ms': '',
+  'commit_monitor': 'false',
+  'max_offsets_per_trigger': '',
+  'min_partitions': '',
+  'fetch_max_bytes': '',
+  'max_partition_fetch_bytes': '',
+  'consumer_cache_capacity': '',
+  'consumer_cache_timeout': '',
+  'fail_on_data_loss': '',
+  'checkpoint_min_batches_to_retain': '',
+  'checkpoint_location': '',
+  'batch_profile': 'false',
+  'batch_profile_cloudwatch_namespace': ''
+}))
+
 CATALOG = args['catalog']
 
 ICEBERG_S3_PATH = args['iceberg_s3_path']
@@ -55,6 +118,52 @@ STARTING_OFFSETS_OF_KAFKA_TOPIC = args.get('starting_offsets_of_kafka_topic', 'l
 
 AWS_REGION = args['aws_region']
 WINDOW_SIZE = args.get('window_size', '100 seconds')
+#XXX: 'true' logs the time, Spark jobs and rows of each phase of every micro-batch as a `batch_profile` JSON line
+BATCH_PROFILE = args['batch_profile'].lower() == 'true'
+METADATA_CACHE_TTL_SEC = int(args['metadata_cache_ttl_sec'])
+MERGE_PRUNING_KEY_RANGE = args['merge_pruning_key_range'].lower() == 'true'
+#XXX: Only list partition columns whose values never change for a primary key,
+# otherwise an update moving a row to another partition is inserted as a new row.
+MERGE_PRUNING_PARTITION_COLUMNS = [c.strip() for c in args['merge_pruning_partition_columns'].split(',') if c.strip()]
+MERGE_PRUNING_MAX_VALUES = int(args['merge_pruning_max_values'])
+ADAPTIVE_WINDOW = args['adaptive_window'].lower() == 'true'
+MAINTENANCE_INTERVAL_BATCHES = int(args['maintenance_interval_batches'])
+#XXX: schema_mode: ['infer', 'explicit']
+SCHEMA_MODE = args['schema_mode']
+DEAD_LETTER_S3_PATH = args['dead_letter_s3_path'] or os.path.join(args["TempDir"], args["JOB_NAME"], "dead_letter/")
+#XXX: e.g., '10 minutes'; cross-batch de-duplication needs schema_mode 'explicit'
+DEDUP_WATERMARK_DELAY = args['dedup_watermark_delay']
+#XXX: write_mode: ['copy-on-write', 'merge-on-read']
+WRITE_MODE = args['write_mode']
+
+#XXX: Empty values keep the defaults of Iceberg, i.e. the DynamoDB lock is tried every 5 seconds for up to 3 minutes,
+# and a commit that conflicts with another writer is retried 4 times, waiting from 100 ms up to 60 seconds in between.
+LOCK_ACQUIRE_PROPERTIES = {
+  'lock.acquire-interval-ms': args['lock_acquire_interval_ms'],
+  'lock.acquire-timeout-ms': args['lock_acquire_timeout_ms']
+}
+COMMIT_RETRY_PROPERTIES = {
+  'commit.retry.num-retries': args['commit_retry_num_retries'],
+  'commit.retry.min-wait-ms': args['commit_retry_min_wait_ms'],
+  'commit.retry.max-wait-ms': args['commit_retry_max_wait_ms'],
+  'commit.retry.total-timeout-ms': args['commit_retry_total_timeout_ms']
+}
+#XXX: 'true' logs the commits and commit contention of every micro-batch as an `iceberg_commit_contention` JSON line
+COMMIT_MONITOR = args['commit_monitor'].lower() == 'true'
+
+#XXX: Empty values keep the defaults of the Kafka source, i.e. no limit of offsets per micro-batch,
+# a Spark partition per Kafka partition, 64 cached consumers per executor and failing when offsets are gone.
+KAFKA_SOURCE_OPTIONS = {k: v for k, v in {
+  'maxOffsetsPerTrigger': args['max_offsets_per_trigger'],
+  'minPartitions': args['min_partitions'],
+  'failOnDataLoss': args['fail_on_data_loss'],
+  'kafka.fetch.max.bytes': args['fetch_max_bytes'],
+  'kafka.max.partition.fetch.bytes': args['max_partition_fetch_bytes']
+}.items() if v}
+KAFKA_CONSUMER_POOL_CONF = {k: v for k, v in {
+  'spark.kafka.consumer.cache.capacity': args['consumer_cache_capacity'],
+  'spark.kafka.consumer.cache.timeout': args['consumer_cache_timeout']
+}.items() if v}
 
 def setSparkIcebergConf() -> SparkConf:
   conf_list = [
@@ -67,6 +176,8 @@ def setSparkIcebergConf() -> SparkConf:
     ("spark.sql.extensions", "org.apache.iceberg.spark.extensions.IcebergSparkSessionExtensions"),
     ("spark.sql.iceberg.handle-timestamp-without-timezone", "true")
   ]
+  conf_list += [(f"spark.sql.catalog.{CATALOG}.{k}", v) for k, v in LOCK_ACQUIRE_PROPERTIES.items() if v]
+  conf_list += list(KAFKA_CONSUMER_POOL_CONF.items())
   spark_conf = SparkConf().setAll(conf_list)
   return spark_conf
 
@@ -83,59 +194,189 @@ kafka_options = {
   "topicName": KAFKA_TOPIC_NAME,
   "startingOffsets": STARTING_OFFSETS_OF_KAFKA_TOPIC,
   "inferSchema": "true",
-  "classification": "json"
+  "classification": "json",
+  **KAFKA_SOURCE_OPTIONS
 }
 
-streaming_data = glueContext.create_data_frame.from_options(
-  connection_type="kafka",
-  connection_options=kafka_options,
-  transformation_ctx="kafka_df"
-)
+def createSourceDataFrame(max_records_per_trigger=None):
+  connection_options = {**kafka_options, "maxOffsetsPerTrigger": str(max_records_per_trigger)} \
+    if max_records_per_trigger else kafka_options
+  return glueContext.create_data_frame.from_options(
+    connection_type="kafka",
+    connection_options=connection_options,
+    transformation_ctx="kafka_df"
+  )
 
-def processBatch(data_frame, batch_id):
-  if data_frame.count() > 0:
-    stream_data_dynf = DynamicFrame.fromDF(
-      data_frame, glueContext, "from_data_frame"
-    )
+def getKafkaBootstrapServers(connection_name) -> tuple:
+  '''Look up the bootstrap servers of the Glue Kafka connection and whether it uses SSL'''
+  glue_client = boto3.client('glue', region_name=AWS_REGION)
+  connection = glue_client.get_connection(Name=connection_name, HidePassword=True)['Connection']
+  properties = connection['ConnectionProperties']
+  return properties['KAFKA_BOOTSTRAP_SERVERS'], properties.get('KAFKA_SSL_ENABLED', 'false').lower() == 'true'
 
-    tables_df = spark.sql(f"SHOW TABLES IN {CATALOG}.{DATABASE}")
-    table_list = tables_df.select('tableName').rdd.flatMap(lambda x: x).collect()
-    if f"{TABLE_NAME}" not in table_list:
-      print(f"Table {TABLE_NAME} doesn't exist in {CATALOG}.{DATABASE}.")
-    else:
-      _df = spark.sql(f"SELECT * FROM {CATALOG}.{DATABASE}.{TABLE_NAME} LIMIT 0")
+def getRawReaderOptions() -> dict:
+  '''The options of the Spark Kafka source, which reads the records as they are for --schema_mode explicit'''
+  bootstrap_servers, ssl_enabled = getKafkaBootstrapServers(KAFKA_CONNECTION_NAME)
+  reader_options = {k: v for k, v in kafka_options.items() if k.startswith('kafka.') or k in KAFKA_SOURCE_OPTIONS}
+  if ssl_enabled:
+    reader_options.setdefault("kafka.security.protocol", "SSL")
+  reader_options.update({
+    "kafka.bootstrap.servers": bootstrap_servers,
+    "subscribe": KAFKA_TOPIC_NAME,
+    "startingOffsets": STARTING_OFFSETS_OF_KAFKA_TOPIC
+  })
+  return reader_options
+
+table_metadata = TableMetadataCache(spark, CATALOG, DATABASE, TABLE_NAME, METADATA_CACHE_TTL_SEC)
+
+table_maintenance = IcebergTableMaintenance(spark, CATALOG, DATABASE, TABLE_NAME, MAINTENANCE_INTERVAL_BATCHES,
+  target_file_size_bytes=int(args['maintenance_target_file_size_bytes']),
+  min_small_files=int(args['maintenance_min_small_files']),
+  max_manifests=int(args['maintenance_max_manifests']),
+  max_delete_files=int(args['maintenance_max_delete_files']),
+  snapshot_retention_hours=int(args['maintenance_snapshot_retention_hours']),
+  retain_last_snapshots=int(args['maintenance_retain_last_snapshots']),
+  orphan_file_retention_hours=int(args['maintenance_orphan_file_retention_hours']),
+  orphan_files_every_n_runs=int(args['maintenance_orphan_files_every_n_runs']))
+
+write_mode = IcebergWriteMode(spark, CATALOG, DATABASE, TABLE_NAME, WRITE_MODE)
+
+commit_monitor = IcebergCommitMonitor(spark, f"{CATALOG}.{DATABASE}.{TABLE_NAME}", COMMIT_RETRY_PROPERTIES,
+  enabled=COMMIT_MONITOR)
+
+def buildMergeCondition(source_df, primary_key) -> str:
+  merge_condition = f"s.{primary_key} = t.{primary_key}"
+  pruning_predicate = buildMergePruningPredicate(source_df, primary_key,
+    MERGE_PRUNING_PARTITION_COLUMNS,
+    key_range=MERGE_PRUNING_KEY_RANGE,
+    max_values=MERGE_PRUNING_MAX_VALUES)
+  return f"{merge_condition} AND {pruning_predicate}" if pruning_predicate else merge_condition
 
-      #XXX: Apply De-duplication logic on input data to pick up the latest record based on timestamp and operation
-      window = Window.partitionBy(PRIMARY_KEY).orderBy(desc("m_time"))
-      stream_data_df = stream_data_dynf.toDF()
-      stream_data_df = stream_data_df.withColumn('m_time', to_timestamp(col('m_time'), 'yyyy-MM-dd HH:mm:ss'))
-      upsert_data_df = stream_data_df.withColumn("row", row_number().over(window)) \
-        .filter(col("row") == 1).drop("row") \
-        .select(_df.schema.names)
+batch_profiler = BatchProfiler(spark, args['JOB_NAME'],
+  cloudwatch_namespace=args['batch_profile_cloudwatch_namespace'],
+  region_name=AWS_REGION)
+
+def mergeBatch(stream_data_dynf, table_columns):
+  #XXX: Apply De-duplication logic on input data to pick up the latest record based on timestamp and operation
+  stream_data_df = stream_data_dynf.toDF()
+  stream_data_df = stream_data_df.withColumn('m_time', to_timestamp(col('m_time'), 'yyyy-MM-dd HH:mm:ss'))
+  upsert_data_df = dedupLatest(stream_data_df, PRIMARY_KEY, 'm_time', table_columns)
+
+  #XXX: Persist the deduplicated frame so that computing the merge condition
+  # and the MERGE statement do not re-run the de-duplication over the micro-batch.
+  upsert_data_df.persist()
+  try:
+    with batch_profiler.phase('dedup'):
+      batch_profiler.countRows('output_rows', upsert_data_df)
+
+    with batch_profiler.phase('merge'):
+      merge_condition = buildMergeCondition(upsert_data_df, PRIMARY_KEY)
 
       upsert_data_df.createOrReplaceTempView(f"{TABLE_NAME}_upsert")
       # print(f"Table '{TABLE_NAME}' is upserting...")
 
       try:
         spark.sql(f"""MERGE INTO {CATALOG}.{DATABASE}.{TABLE_NAME} t
-          USING {TABLE_NAME}_upsert s ON s.{PRIMARY_KEY} = t.{PRIMARY_KEY}
+          USING {TABLE_NAME}_upsert s ON {merge_condition}
           WHEN MATCHED THEN UPDATE SET *
           WHEN NOT MATCHED THEN INSERT *
           """)
       except Exception as ex:
         traceback.print_exc()
         raise ex
+  finally:
+    upsert_data_df.unpersist()
 
+def processBatch(data_frame, batch_id):
+  if not isEmptyDataFrame(data_frame):
+    stream_data_dynf = DynamicFrame.fromDF(
+      data_frame, glueContext, "from_data_frame"
+    )
 
-checkpointPath = os.path.join(args["TempDir"], args["JOB_NAME"], "checkpoint/")
+    if not table_metadata.exists():
+      print(f"Table {TABLE_NAME} doesn't exist in {CATALOG}.{DATABASE}.")
+    else:
+      write_mode.configure()
+      #XXX: Only the contention report and the commit report of merge-on-read writes read the snapshots of the micro-batch,
+      # so without them the monitor only sets the commit retries, like in the INSERT OVERWRITE jobs.
+      report_commits = commit_monitor.enabled or write_mode.isMergeOnRead()
+      if report_commits:
+        commit_monitor.start()
+      else:
+        commit_monitor.configure()
+      try:
+        mergeBatch(stream_data_dynf, table_metadata.columns())
+      except AnalysisException as ex:
+        #XXX: The cached table schema might be stale (e.g., the table has been altered),
+        # so reload it from the catalog and retry the batch once.
+        table_metadata.invalidate()
+        if not table_metadata.exists():
+          #XXX: The table has been dropped, so there is no schema to retry with; raise the original error.
+          raise ex
+        mergeBatch(stream_data_dynf, table_metadata.columns())
+      if report_commits:
+        commit_monitor.stop()
+        with batch_profiler.phase('commit_report'):
+          #XXX: Read the snapshots of the micro-batch once, for both the commit report and the contention report.
+          snapshot_rows = commit_monitor.readSnapshots()
+          commit_report = write_mode.reportCommits(batch_id, snapshot_rows)
+          if commit_report:
+            table_maintenance.addDeleteFiles(commit_report['added_delete_files'])
+          if commit_monitor.enabled:
+            batch_profiler.record('commit_sec', commit_monitor.report(batch_id, snapshot_rows)['commit_sec'])
 
-glueContext.forEachBatch(
-  frame=streaming_data,
-  batch_function=processBatch,
-  options={
-    "windowSize": WINDOW_SIZE,
-    "checkpointLocation": checkpointPath,
-  }
-)
+  #XXX: Run the table maintenance between micro-batches, so that it never conflicts with the writes of this job.
+  if table_maintenance.isDue(batch_id) and table_metadata.exists():
+    with batch_profiler.phase('maintenance'):
+      table_maintenance.run()
+
+
+#XXX: e.g., a checkpoint written by the checkpoint tool, to restart the job from other offsets
+checkpointPath = args['checkpoint_location'] or os.path.join(args["TempDir"], args["JOB_NAME"], "checkpoint/")
+
+#XXX: The checkpoint keeps the offsets and commits of the last `checkpoint_min_batches_to_retain` micro-batches
+# (Spark default: 100); fewer of them make the checkpoint smaller and faster to list when the job restarts.
+if args['checkpoint_min_batches_to_retain']:
+  spark.conf.set("spark.sql.streaming.minBatchesToRetain", args['checkpoint_min_batches_to_retain'])
+
+if DEDUP_WATERMARK_DELAY and SCHEMA_MODE != 'explicit':
+  raise ValueError("--dedup_watermark_delay requires --schema_mode explicit")
+
+if SCHEMA_MODE == 'explicit':
+  #XXX: Derive the payload schema once from the table instead of inferring it on every micro-batch.
+  payload_schema = loadPayloadSchema(spark, f"{CATALOG}.{DATABASE}.{TABLE_NAME}")
+  create_source_data_frame = functools.partial(createParsedSourceDataFrame, spark, 'kafka', getRawReaderOptions(), payload_schema,
+    dedup_key=col(f'_parsed.{PRIMARY_KEY}'),
+    dedup_event_time=to_timestamp(col('_parsed.m_time'), 'yyyy-MM-dd HH:mm:ss'),
+    dedup_watermark_delay=DEDUP_WATERMARK_DELAY)
+  batch_function = functools.partial(processExplicitSchemaBatch, process_batch=processBatch, dead_letter_s3_path=DEAD_LETTER_S3_PATH)
+else:
+  create_source_data_frame, batch_function = createSourceDataFrame, processBatch
+
+offset_reporter = KafkaOffsetReporter(spark)
+batch_function = offset_reporter.wrap(batch_function)
+
+if BATCH_PROFILE:
+  batch_function = batch_profiler.profile(batch_function)
+
+if ADAPTIVE_WINDOW:
+  controller = AdaptiveWindowController(parseWindowSizeSec(WINDOW_SIZE),
+    int(args['adaptive_min_window_sec']),
+    int(args['adaptive_max_window_sec']),
+    int(args['adaptive_min_records_per_trigger']),
+    int(args['adaptive_max_records_per_trigger']),
+    target_utilization=float(args['adaptive_target_utilization']),
+    min_batch_rows=int(args['adaptive_min_batch_rows']),
+    records_per_trigger=int(args['max_offsets_per_trigger']) if args['max_offsets_per_trigger'] else None)
+  runAdaptiveForEachBatch(create_source_data_frame, batch_function, checkpointPath, controller)
+else:
+  glueContext.forEachBatch(
+    frame=create_source_data_frame(),
+    batch_function=batch_function,
+    options={
+      "windowSize": WINDOW_SIZE,
+      "checkpointLocation": checkpointPath,
+    }
+  )
 
 job.commit()
@@ -0,0 +1,15 @@
+-- The target table of cdc-streams-to-apache-iceberg,
+-- created in the local Hadoop catalog that replaces the Glue Data Catalog.
+CREATE DATABASE IF NOT EXISTS job_catalog.cdc_iceberg_demo_db;
+
+CREATE TABLE IF NOT EXISTS job_catalog.cdc_iceberg_demo_db.retail_trans_iceberg (
+  trans_id int,
+  customer_id string,
+  event string,
+  sku string,
+  amount int,
+  device string,
+  trans_datetime timestamp
+)
+USING iceberg
+PARTITIONED BY (event);
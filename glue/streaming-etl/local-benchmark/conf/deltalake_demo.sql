@@ -0,0 +1,2 @@
+-- The database of sink-to-deltalake; the SQL variants create the products table themselves.
+CREATE DATABASE IF NOT EXISTS deltalake_db;
@@ -0,0 +1,11 @@
+-- The target table of sink-to-iceberg, kafka-to-iceberg and msk-serverless-to-iceberg,
+-- created in the local Hadoop catalog that replaces the Glue Data Catalog.
+CREATE DATABASE IF NOT EXISTS job_catalog.iceberg_demo_db;
+
+CREATE TABLE IF NOT EXISTS job_catalog.iceberg_demo_db.iceberg_demo_table (
+  name string,
+  age int,
+  m_time timestamp
+)
+USING iceberg
+PARTITIONED BY (name);
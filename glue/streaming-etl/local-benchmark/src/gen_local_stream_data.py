@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import argparse
+import datetime
+import functools
+import math
+import json
+import os
+import random
+import time
+import uuid
+
+NAMES = 'Arica,Burton,Cory,Fernando,Gonzalo,Kenton,Linsey,Micheal,Ricky,Takisha'.split(',')
+CAR_BRANDS = ['Audi', 'BMW', 'Chevrolet', 'Daihatsu', 'Fiat', 'Hyundai', 'Kia', 'Nissan', 'Peugeot', 'Volkswagen']
+
+
+#XXX: The record shapes below follow the gen_fake_*.py scripts of each project,
+# with the primary key drawn from `num_keys` values so that micro-batches carry updates.
+def iceberg_record(rnd, key, event_time):
+  return {
+    "name": f"{NAMES[key % len(NAMES)]}{key}",
+    "age": rnd.randint(18, 70),
+    "m_time": event_time.strftime("%Y-%m-%d %H:%M:%S")
+  }
+
+
+def deltalake_record(rnd, key, event_time):
+  return {
+    "product_id": f"{key:05}",
+    "product_name": rnd.choice(CAR_BRANDS),
+    "price": rnd.randint(1000, 12345),
+    "category": rnd.choice(CAR_BRANDS),
+    "updated_at": event_time.strftime("%Y-%m-%d %H:%M:%S")
+  }
+
+
+def hudi_record(rnd, key, event_time):
+  return {
+    "name": f"Person{key}",
+    "date": event_time.strftime("%Y-%m-%d %H:%M:%S"),
+    "year": event_time.strftime("%Y"),
+    "month": event_time.strftime("%m"),
+    "day": event_time.strftime("%d"),
+    "column_to_update_integer": rnd.randint(1, 1000000000),
+    "column_to_update_string": rnd.choice(['White', 'Red', 'Yellow', 'Silver'])
+  }
+
+
+def s3_record(rnd, key, event_time):
+  return {
+    "ventilatorid": key,
+    "eventtime": event_time.strftime("%Y-%m-%d %H:%M:%S"),
+    "serialnumber": str(uuid.UUID(int=rnd.getrandbits(128))),
+    "pressurecontrol": rnd.randint(3, 40),
+    "o2stats": rnd.randint(90, 100),
+    "minutevolume": rnd.randint(2, 10),
+    "manufacturer": rnd.choice(['3M', 'GE', 'Vyaire', 'Getinge'])
+  }
+
+
+def cdc_record(rnd, key, event_time, operation_weights=(5, 3, 2)):
+  return {
+    "data": {
+      "trans_id": key,
+      "customer_id": str(rnd.randint(123456789012, 999999999999)),
+      "event": rnd.choice(['visit', 'view', 'list', 'like', 'cart', 'purchase']),
+      "sku": f"AB{rnd.randint(0, 9999):04}CDEF",
+      "amount": rnd.randint(1, 10),
+      "device": rnd.choice(['pc', 'mobile', 'tablet']),
+      "trans_datetime": event_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+    },
+    "metadata": {
+      "timestamp": event_time.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+      "operation": rnd.choices(['insert', 'update', 'delete'], weights=operation_weights)[0]
+    }
+  }
+
+
+RECORD_SHAPES = {
+  'iceberg': iceberg_record,
+  'deltalake': deltalake_record,
+  'hudi': hudi_record,
+  's3': s3_record,
+  'cdc': cdc_record
+}
+
+#XXX: The weights of the insert, update and delete operations of the cdc shape in each workload.
+# Only the cdc shape carries operations, so only it can express a delete-heavy workload.
+WORKLOAD_OPERATION_WEIGHTS = {
+  'mixed': (5, 3, 2),
+  'insert_only': (1, 0, 0),
+  'upsert_heavy': (1, 8, 1),
+  'delete_heavy': (2, 3, 5)
+}
+
+
+def write_records(path, records, mtime):
+  with open(path, 'w') as f:
+    for record in records:
+      f.write(f"{json.dumps(record)}\n")
+  #XXX: The file source of Spark takes the files in modification time order,
+  # so space them one second apart to keep the preload files first.
+  os.utime(path, (mtime, mtime))
+
+
+def main():
+  parser = argparse.ArgumentParser()
+
+  parser.add_argument('--shape', choices=list(RECORD_SHAPES), default='iceberg',
+    help='The record shape of the streaming job to benchmark (default: iceberg)')
+  parser.add_argument('--output-path', required=True,
+    help='The directory to write the JSON Lines files into')
+  parser.add_argument('--num-files', default=10, type=int,
+    help='The number of files; each micro-batch reads `--max-files-per-trigger` of them (default: 10)')
+  parser.add_argument('--records-per-file', default=10000, type=int,
+    help='The number of records per file (default: 10000)')
+  parser.add_argument('--num-keys', default=1000, type=int,
+    help='The number of distinct primary keys (default: 1000)')
+  parser.add_argument('--workload', choices=list(WORKLOAD_OPERATION_WEIGHTS), default='mixed',
+    help='insert_only: every record has a new key; upsert_heavy and delete_heavy: keys are drawn from `--num-keys` values,'
+      ' with mostly updates or mostly deletes for the cdc shape (default: mixed)')
+  parser.add_argument('--preload-keys', default=0, type=int,
+    help='Write files inserting keys 1..N before the workload files, so that the workload runs against a table of N rows (default: 0)')
+  parser.add_argument('--part', choices=['all', 'preload', 'workload'], default='all',
+    help='Write only the preload files or only the workload files, e.g. to stream them in two runs (default: all)')
+  parser.add_argument('--key-offset', default=0, type=int,
+    help='Add this to every primary key, so that concurrent writers can get disjoint keys (default: 0)')
+  parser.add_argument('--seed', default=47, type=int,
+    help='The random seed, so that every variant reads the same records (default: 47)')
+
+  options = parser.parse_args()
+  if options.workload == 'delete_heavy' and options.shape != 'cdc':
+    parser.error('--workload delete_heavy needs --shape cdc, the only shape with delete operations')
+
+  rnd = random.Random(options.seed)
+  make_record = RECORD_SHAPES[options.shape]
+  preload_record = make_record
+  if options.shape == 'cdc':
+    make_record = functools.partial(cdc_record, operation_weights=WORKLOAD_OPERATION_WEIGHTS[options.workload])
+    preload_record = functools.partial(cdc_record, operation_weights=WORKLOAD_OPERATION_WEIGHTS['insert_only'])
+  start_time = datetime.datetime(2023, 1, 1)
+  #XXX: Preloaded rows are older than every workload record, so that the workload always wins the ordering.
+  preload_time = start_time - datetime.timedelta(days=1)
+
+  preload_files = math.ceil(options.preload_keys / options.records_per_file)
+  mtime = int(time.time()) - preload_files - options.num_files
+
+  os.makedirs(options.output_path, exist_ok=True)
+  for i in range(preload_files if options.part != 'workload' else 0):
+    keys = range(i * options.records_per_file + 1, min((i + 1) * options.records_per_file, options.preload_keys) + 1)
+    records = [preload_record(rnd, options.key_offset + key, preload_time) for key in keys]
+    write_records(os.path.join(options.output_path, f"preload-{i:05}.json"), records, mtime + i)
+
+  for i in range(options.num_files if options.part != 'preload' else 0):
+    records = []
+    for j in range(options.records_per_file):
+      seq = i * options.records_per_file + j
+      event_time = start_time + datetime.timedelta(seconds=seq)
+      key = options.preload_keys + seq + 1 if options.workload == 'insert_only' else rnd.randint(1, options.num_keys)
+      records.append(make_record(rnd, options.key_offset + key, event_time))
+    write_records(os.path.join(options.output_path, f"part-{i:05}.json"), records, mtime + preload_files + i)
+
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+from run_write_strategy_benchmark import BENCHMARK_DIR, SRC_DIR, copy_input, resolve_path
+
+#XXX: Writers get primary keys this far apart, so that they write disjoint partitions of the same table.
+KEY_RANGE_PER_WRITER = 10000000
+
+#XXX: INSERT OVERWRITE without a PARTITION clause replaces the whole table unless the session overwrites
+# partitions dynamically, so without it the writers would replace each other's rows. MERGE ignores it.
+DYNAMIC_OVERWRITE_CONF = 'spark.sql.sources.partitionOverwriteMode=dynamic'
+
+
+def percentile(values, q):
+  if not values:
+    return None
+  values = sorted(values)
+  return values[min(int(round(q * (len(values) - 1))), len(values) - 1)]
+
+
+def generate_input(output_path, variant, writer, options, num_files=None):
+  '''Write the input files of a writer once, with primary keys that no other writer has'''
+  if os.path.isdir(output_path):
+    return output_path
+  subprocess.run([sys.executable, os.path.join(SRC_DIR, 'gen_local_stream_data.py'),
+    '--shape', variant['shape'],
+    '--workload', options.workload,
+    '--output-path', output_path,
+    '--key-offset', str(writer * KEY_RANGE_PER_WRITER),
+    '--num-keys', str(options.num_keys),
+    '--num-files', str(num_files or options.num_files),
+    '--records-per-file', str(options.records_per_file),
+    '--seed', str(options.seed + writer)
+  ], check=True)
+  return output_path
+
+
+def build_command(variant, name, input_path, work_dir, warehouse, report_path, suite, options, setup_sql=False):
+  command = [sys.executable, os.path.join(SRC_DIR, 'run_local_benchmark.py'),
+    '--script', resolve_path(variant['script']),
+    '--name', name,
+    '--input-path', input_path,
+    '--max-files-per-trigger', str(options.max_files_per_trigger),
+    '--work-dir', work_dir,
+    '--warehouse', warehouse,
+    '--report-path', report_path,
+    '--driver-memory', options.driver_memory,
+    '--shuffle-partitions', str(options.shuffle_partitions),
+    '--master', options.master
+  ]
+  for jar in variant.get('jars', []):
+    command += ['--jars', os.path.join(options.jars_dir, suite['jars'][jar])]
+  for conf in variant.get('conf', []) + [DYNAMIC_OVERWRITE_CONF]:
+    command += ['--conf', conf]
+  if setup_sql and variant.get('setup_sql'):
+    command += ['--setup-sql', resolve_path(variant['setup_sql'])]
+  return command + ['--', '--JOB_NAME', variant['name'], '--commit_monitor', 'true'] + variant['job_args'] + options.job_args
+
+
+def read_contention(log_path) -> list:
+  '''The `iceberg_commit_contention` lines the job printed for its micro-batches'''
+  reports = []
+  with open(log_path) as f:
+    for line in f:
+      if '"iceberg_commit_contention"' not in line:
+        continue
+      try:
+        reports.append(json.loads(line[line.index('{'):]))
+      except ValueError:
+        continue
+  return reports
+
+
+def run_writers(variant, run_dir, warehouse, writers, suite, options) -> dict:
+  '''Start the writers at once on the same table, and sum up their throughput and commit contention'''
+  processes = []
+  for writer in range(writers):
+    writer_dir = os.path.join(run_dir, f"writer-{writer}")
+    input_path = os.path.join(writer_dir, 'input')
+    copy_input(generate_input(os.path.join(options.output_dir, 'data', f"writer-{writer}"), variant, writer, options), input_path)
+    report_path = os.path.join(writer_dir, 'report.json')
+    command = build_command(variant, f"writer-{writer}", input_path, writer_dir, warehouse, report_path, suite, options)
+    log = open(f"{report_path}.log", 'w')
+    processes.append((writer, report_path, log, subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)))
+
+  start_time = time.monotonic()
+  results = []
+  for writer, report_path, log, process in processes:
+    returncode = process.wait()
+    log.close()
+    result = {'writer': writer, 'contention': read_contention(f"{report_path}.log")}
+    if returncode != 0:
+      result['error'] = f"exit code {returncode}, see {report_path}.log"
+    else:
+      with open(report_path) as f:
+        result['report'] = json.load(f)
+    results.append(result)
+  elapsed_sec = time.monotonic() - start_time
+
+  reports = [e['report'] for e in results if 'report' in e]
+  contention = [c for e in results for c in e['contention']]
+  batch_latencies = [b['elapsed_sec'] for r in reports for b in r['per_batch']]
+  commit_secs = [c['commit_sec'] for c in contention if c.get('commit_sec') is not None]
+  rows = sum([r['rows'] for r in reports])
+  #XXX: The writers stream at the same time, so the slowest one bounds the throughput of the table.
+  streaming_sec = max([r['wall_clock_sec'] or 0 for r in reports], default=0)
+  return {
+    'writers': writers,
+    'failed_writers': len([e for e in results if 'error' in e]),
+    'rows': rows,
+    'rows_per_sec': rows / streaming_sec if streaming_sec else None,
+    'rows_per_sec_per_writer': [r['rows_per_sec'] for r in reports],
+    'batch_latency_p50_sec': percentile(batch_latencies, 0.5),
+    'batch_latency_p95_sec': percentile(batch_latencies, 0.95),
+    'commits': sum([c['commits'] for c in contention]),
+    'concurrent_commits': sum([c['concurrent_commits'] for c in contention]),
+    'max_conflict_retries': sum([c['max_conflict_retries'] for c in contention]),
+    'commit_sec_p50': percentile(commit_secs, 0.5),
+    'commit_sec_p95': percentile(commit_secs, 0.95),
+    'elapsed_sec': elapsed_sec,
+    'per_writer': results
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description='Run several copies of an Iceberg streaming job on the same table at once, and compare their throughput and commit contention.',
+    epilog='Extra job arguments after `--` are passed to every writer, e.g. -- --commit_retry_num_retries 10 --commit_retry_min_wait_ms 50')
+
+  parser.add_argument('--suite', default=os.path.join(BENCHMARK_DIR, 'conf', 'write_strategy_suite.json'),
+    help='The suite to take the variant from (default: conf/write_strategy_suite.json)')
+  parser.add_argument('--variant', default='iceberg-insert-overwrite',
+    help='The Iceberg variant of the suite to run (default: iceberg-insert-overwrite)')
+  parser.add_argument('--writers', action='append', type=int, default=[],
+    help='The numbers of concurrent writers to compare (default: 1 and 4)')
+  parser.add_argument('--workload', default='insert_only', choices=['insert_only', 'upsert_heavy'],
+    help='The workload of every writer (default: insert_only)')
+  parser.add_argument('--num-files', default=20, type=int,
+    help='The input files per writer (default: 20)')
+  parser.add_argument('--records-per-file', default=1000, type=int,
+    help='The records per input file (default: 1000)')
+  parser.add_argument('--num-keys', default=1000, type=int,
+    help='The primary keys per writer of the upsert workload (default: 1000)')
+  parser.add_argument('--max-files-per-trigger', default=1, type=int,
+    help='The input files per micro-batch (default: 1)')
+  parser.add_argument('--seed', default=47, type=int,
+    help='The random seed of the first writer (default: 47)')
+  parser.add_argument('--jars-dir', default='./jars',
+    help='The directory with the jar files named in the suite (default: ./jars)')
+  parser.add_argument('--output-dir', default='./commit-contention-benchmark',
+    help='The directory for inputs, tables, logs and results (default: ./commit-contention-benchmark)')
+  parser.add_argument('--master', default='local[2]',
+    help='The Spark master of every writer (default: local[2])')
+  parser.add_argument('--driver-memory', default='2g',
+    help='The Spark driver memory of every writer (default: 2g)')
+  parser.add_argument('--shuffle-partitions', default=4, type=int,
+    help='spark.sql.shuffle.partitions (default: 4)')
+  parser.add_argument('job_args', nargs=argparse.REMAINDER,
+    help='Extra job arguments of every writer')
+
+  options = parser.parse_args()
+  options.job_args = [e for e in options.job_args if e != '--']
+  options.writers = options.writers or [1, 4]
+  with open(options.suite) as f:
+    suite = json.load(f)
+  variant = next(iter([e for e in suite['variants'] if e['name'] == options.variant]), None)
+  if variant is None or 'iceberg' not in variant.get('jars', []):
+    parser.error(f"--variant must be an Iceberg variant of {options.suite}")
+  options.jars_dir = os.path.abspath(options.jars_dir)
+  options.output_dir = os.path.abspath(options.output_dir)
+
+  results = []
+  for writers in options.writers:
+    run_dir = os.path.join(options.output_dir, 'runs', f"{writers}-writers")
+    if os.path.isdir(run_dir):
+      shutil.rmtree(run_dir)
+    warehouse = os.path.join(run_dir, 'warehouse')
+    os.makedirs(warehouse)
+
+    #XXX: Create the table with a single writer first, because concurrent CREATE TABLE statements fail
+    # in the Hadoop catalog, and so that every writer starts with a warm table.
+    setup_dir = os.path.join(run_dir, 'setup')
+    setup_input = os.path.join(setup_dir, 'input')
+    copy_input(generate_input(os.path.join(options.output_dir, 'data', 'setup'), variant, max(options.writers), options, num_files=1), setup_input)
+    with open(os.path.join(setup_dir, 'report.json.log'), 'w') as log:
+      subprocess.run(build_command(variant, 'setup', setup_input, setup_dir, warehouse,
+        os.path.join(setup_dir, 'report.json'), suite, options, setup_sql=True), stdout=log, stderr=subprocess.STDOUT, check=True)
+
+    result = run_writers(variant, run_dir, warehouse, writers, suite, options)
+    results.append(result)
+    print(json.dumps({'event': 'commit_contention_benchmark_run', 'variant': variant['name'],
+      **{k: v for k, v in result.items() if k != 'per_writer'}}))
+
+  os.makedirs(options.output_dir, exist_ok=True)
+  with open(os.path.join(options.output_dir, 'results.json'), 'w') as f:
+    json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+  main()
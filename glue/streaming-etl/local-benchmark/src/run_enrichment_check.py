@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import argparse
+import json
+import sys
+import threading
+import time
+import traceback
+
+from run_merge_correctness_check import load_functions
+from run_write_strategy_benchmark import resolve_path
+
+#XXX: The jobs with a `DimensionEnrichment` class, relative to this project
+SCRIPTS = {
+  'cdc_streams_iceberg': '../../cdc-streams-to-apache-iceberg/src/main/python/spark_sql_merge_into_iceberg.py',
+  'deltalake_merge': '../sink-to-deltalake/src/main/python/spark_deltalake_writes_with_sql_merge_into.py'
+}
+
+DIMENSION_VIEW = 'enrichment_check_products'
+DIMENSION_ROWS = [('sku-a', 'Product A', 'toys'), ('sku-b', 'Product B', 'books')]
+DIMENSIONS = [{'table': DIMENSION_VIEW, 'join_key': 'sku', 'columns': ['product_name', 'category']}]
+TARGET_SCHEMA = 'id INT, sku STRING, product_name STRING, category STRING, amount INT'
+
+#XXX: `expected` is the enriched records in the columns of TARGET_SCHEMA, sorted by id;
+# `sku-x` has no row in the dimension table.
+CASES = [
+  {
+    'name': 'record_carries_dimension_column',
+    'schema': 'id INT, sku STRING, product_name STRING, amount INT',
+    'records': [(1, 'sku-a', 'old a', 10), (2, 'sku-x', 'old x', 20), (3, 'sku-b', None, 30)],
+    'expected': [(1, 'sku-a', 'Product A', 'toys', 10), (2, 'sku-x', 'old x', None, 20), (3, 'sku-b', 'Product B', 'books', 30)]
+  },
+  {
+    'name': 'record_without_dimension_columns',
+    'schema': 'id INT, sku STRING, amount INT',
+    'records': [(1, 'sku-a', 10), (2, 'sku-x', 20)],
+    'expected': [(1, 'sku-a', 'Product A', 'toys', 10), (2, 'sku-x', None, None, 20)]
+  }
+]
+
+
+def load_enrichment_class(script_path):
+  from pyspark.sql import functions
+  from pyspark.sql.types import StructType
+  namespace = {**vars(functions), 'json': json, 'threading': threading, 'time': time,
+    'traceback': traceback, 'StructType': StructType}
+  return load_functions(script_path, ['DimensionEnrichment'], namespace)[0]
+
+
+def run_case(spark, enrichment_class, case) -> list:
+  '''Enrich the records of a case, and return them in the columns of the target table'''
+  from pyspark.sql.functions import col
+  target_schema = spark.createDataFrame([], TARGET_SCHEMA).schema
+  enrichment = enrichment_class(spark, DIMENSIONS, ttl_sec=3600, max_rows=1000)
+  enriched_df = enrichment.enrich(spark.createDataFrame(case['records'], case['schema']), target_schema)
+  return [tuple(row) for row in enriched_df.select([col(c) for c in target_schema.names]).orderBy('id').collect()]
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description='Check that the dimension enrichment of the MERGE jobs keeps the values of records whose key has no dimension row.')
+
+  parser.add_argument('--master', default='local[2]',
+    help='The Spark master (default: local[2])')
+
+  options = parser.parse_args()
+
+  from pyspark.sql import SparkSession
+  spark = SparkSession.builder.master(options.master) \
+    .config('spark.ui.enabled', 'false') \
+    .config('spark.sql.shuffle.partitions', '2') \
+    .getOrCreate()
+  #XXX: spark.table() also reads temporary views, so the dimension table needs no catalog.
+  spark.createDataFrame(DIMENSION_ROWS, 'sku STRING, product_name STRING, category STRING') \
+    .createOrReplaceTempView(DIMENSION_VIEW)
+
+  failures = 0
+  for script_name, script_path in SCRIPTS.items():
+    enrichment_class = load_enrichment_class(resolve_path(script_path))
+    for case in CASES:
+      rows = run_case(spark, enrichment_class, case)
+      ok = rows == case['expected']
+      failures += 0 if ok else 1
+      print(json.dumps({
+        'event': 'enrichment_check_case',
+        'script': script_name,
+        'case': case['name'],
+        'ok': ok,
+        **({} if ok else {'expected': case['expected'], 'enriched': rows})
+      }))
+
+  print(json.dumps({'event': 'enrichment_check_summary', 'cases': len(SCRIPTS) * len(CASES), 'failures': failures}))
+  sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+  main()
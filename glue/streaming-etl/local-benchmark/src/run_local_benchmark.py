@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import argparse
+import json
+import os
+import runpy
+import sys
+
+SHIM_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'shim')
+#XXX: The modules that the Glue jobs get from `--extra-py-files`
+COMMON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'common', 'src', 'main', 'python')
+
+
+def build_submit_args(options) -> str:
+  submit_args = [
+    '--master', options.master,
+    '--driver-memory', options.driver_memory,
+    '--conf', 'spark.ui.enabled=false',
+    '--conf', f'spark.sql.shuffle.partitions={options.shuffle_partitions}',
+    '--conf', f'spark.sql.warehouse.dir={os.path.join(options.work_dir, "spark-warehouse")}',
+    #XXX: Keep the progress of every micro-batch, not only the last 100, for the report.
+    '--conf', 'spark.sql.streaming.numRecentProgressUpdates=100000'
+  ]
+  for conf in options.conf:
+    submit_args += ['--conf', conf]
+  if options.jars:
+    #XXX: spark-submit puts --jars on the driver class path, so that Spark SQL extensions can be loaded.
+    submit_args += ['--jars', ','.join(options.jars)]
+  return ' '.join(submit_args + ['pyspark-shell'])
+
+
+def resolve_job_args(options) -> list:
+  job_args = [e.format(work_dir=options.work_dir, warehouse=options.warehouse) for e in options.job_args if e != '--']
+  if '--TempDir' not in job_args:
+    job_args += ['--TempDir', os.path.join(options.work_dir, 'temp')]
+  return job_args
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description='Run a Glue streaming ETL script on a local Spark session and report per micro-batch metrics.',
+    epilog='Put the job arguments of the script after `--`. `{work_dir}` and `{warehouse}` in them are replaced with the local paths.')
+
+  parser.add_argument('--script', required=True,
+    help='The Glue streaming ETL script to run')
+  parser.add_argument('--name',
+    help='The name of the variant in the report (default: the script file name)')
+  parser.add_argument('--work-dir', default='./local-benchmark-work',
+    help='The directory for checkpoints and temporary files (default: ./local-benchmark-work)')
+  parser.add_argument('--warehouse',
+    help='The directory the tables are written to, scanned for commits and data files (default: <work-dir>/warehouse)')
+  parser.add_argument('--input-path',
+    help='The directory of JSON Lines files to stream from, e.g. written by gen_local_stream_data.py')
+  parser.add_argument('--max-files-per-trigger', default=1, type=int,
+    help='The number of input files per micro-batch (default: 1)')
+  parser.add_argument('--rate-rows-per-second', type=int,
+    help='Stream from the rate source instead of files')
+  parser.add_argument('--rate-select-expr', action='append', default=[],
+    help='A SQL expression over the `timestamp` and `value` columns of the rate source, e.g. "CAST(value %% 1000 AS STRING) AS name"')
+  parser.add_argument('--duration-sec', default=60, type=int,
+    help='How long to run with the rate source (default: 60)')
+  parser.add_argument('--setup-sql',
+    help='A file of `;`-separated SQL statements to run before streaming, e.g. to create the target table')
+  parser.add_argument('--jars', action='append', default=[],
+    help='Local jar files to load, e.g. the Iceberg, Delta Lake or Hudi Spark bundles')
+  parser.add_argument('--conf', action='append', default=[],
+    help='Extra Spark configuration as key=value')
+  parser.add_argument('--master', default='local[*]',
+    help='The Spark master (default: local[*])')
+  parser.add_argument('--driver-memory', default='4g',
+    help='The Spark driver memory (default: 4g)')
+  parser.add_argument('--shuffle-partitions', default=8, type=int,
+    help='spark.sql.shuffle.partitions (default: 8)')
+  parser.add_argument('--read-table',
+    help='After the run, time a full scan of this table, e.g. job_catalog.iceberg_demo_db.iceberg_demo_table')
+  parser.add_argument('--read-format',
+    help='After the run, time a full scan of the table at --read-path in this format, e.g. hudi')
+  parser.add_argument('--read-path',
+    help='The path of the table to scan with --read-format; `{work_dir}` and `{warehouse}` are replaced')
+  parser.add_argument('--report-path',
+    help='Write the report as a JSON file')
+  parser.add_argument('job_args', nargs=argparse.REMAINDER,
+    help='The job arguments of the script')
+
+  options = parser.parse_args()
+  if not options.input_path and options.rate_rows_per_second is None:
+    parser.error('either --input-path or --rate-rows-per-second is required')
+  if options.read_format and not options.read_path:
+    parser.error('--read-path is required with --read-format')
+  if options.rate_rows_per_second is not None and not options.rate_select_expr:
+    parser.error('--rate-select-expr is required with --rate-rows-per-second')
+
+  options.work_dir = os.path.abspath(options.work_dir)
+  options.warehouse = os.path.abspath(options.warehouse or os.path.join(options.work_dir, 'warehouse'))
+  os.makedirs(options.warehouse, exist_ok=True)
+
+  os.environ['PYSPARK_SUBMIT_ARGS'] = build_submit_args(options)
+  sys.path.insert(0, SHIM_DIR)
+  sys.path.insert(0, COMMON_DIR)
+  os.environ['PYTHONPATH'] = os.pathsep.join(filter(None, [COMMON_DIR, os.environ.get('PYTHONPATH')]))
+  from awsglue import local
+  from pyspark.sql import SparkSession
+
+  harness = local.LocalHarness(options.warehouse,
+    input_path=os.path.abspath(options.input_path) if options.input_path else None,
+    max_files_per_trigger=options.max_files_per_trigger,
+    rate_rows_per_second=options.rate_rows_per_second,
+    rate_select_exprs=options.rate_select_expr,
+    duration_sec=options.duration_sec,
+    setup_sql=options.setup_sql)
+  local.install(harness)
+
+  sys.argv = [options.script] + resolve_job_args(options)
+  runpy.run_path(options.script, run_name='__main__')
+
+  report = {'name': options.name or os.path.basename(options.script), **harness.report()}
+  if options.read_table or options.read_format:
+    spark = SparkSession.builder.getOrCreate()
+    if options.read_table:
+      read_df = spark.table(options.read_table)
+    else:
+      read_df = spark.read.format(options.read_format) \
+        .load(options.read_path.format(work_dir=options.work_dir, warehouse=options.warehouse))
+    report['read_after_write'] = harness.measure_read(read_df)
+  for batch in report['per_batch']:
+    print(json.dumps({'event': 'local_benchmark_batch', 'name': report['name'], **batch}))
+  if 'read_after_write' in report:
+    print(json.dumps({'event': 'local_benchmark_read', 'name': report['name'], **report['read_after_write']}))
+  print(json.dumps({'event': 'local_benchmark_summary', **{k: v for k, v in report.items() if k != 'per_batch'}}))
+
+  if options.report_path:
+    with open(options.report_path, 'w') as f:
+      json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import argparse
+import ast
+import datetime
+import json
+import os
+import shutil
+import sys
+
+from run_local_benchmark import COMMON_DIR
+from run_write_strategy_benchmark import BENCHMARK_DIR, resolve_path
+
+EMPLOYEE_DETAILS_SCRIPT = '../../cdc-parquet-to-apache-iceberg/src/main/python/etl/employee-details-cdc-etl.py'
+
+T0 = datetime.datetime(2023, 1, 1, 0, 0, 0)
+
+#XXX: Every case starts from the rows of INITIAL_ROWS and applies its changes as one micro-batch;
+# `expected` is the table after the batch, as (key, name, amount) sorted by key.
+INITIAL_ROWS = [(1, 'a', 10), (2, 'b', 20), (3, 'c', 30)]
+
+CASES = [
+  {
+    'name': 'delete_then_reinsert',
+    'changes': [(2, None, None, 'delete', 1), (2, 'b2', 21, 'insert', 2)],
+    'expected': [(1, 'a', 10), (2, 'b2', 21), (3, 'c', 30)]
+  },
+  {
+    'name': 'insert_then_delete_new_key',
+    'changes': [(9, 'i', 90, 'insert', 1), (9, None, None, 'delete', 2)],
+    'expected': INITIAL_ROWS
+  },
+  {
+    'name': 'update_missing_key',
+    'changes': [(4, 'd', 40, 'update', 1)],
+    'expected': INITIAL_ROWS + [(4, 'd', 40)]
+  },
+  {
+    'name': 'delete_missing_key',
+    'changes': [(5, None, None, 'delete', 1)],
+    'expected': INITIAL_ROWS
+  },
+  {
+    'name': 'update_and_delete_at_same_time',
+    'changes': [(2, None, None, 'delete', 1), (2, 'b2', 21, 'update', 1)],
+    'expected': [(1, 'a', 10), (3, 'c', 30)]
+  },
+  {
+    'name': 'update_delete_insert',
+    'changes': [(1, 'a1', 11, 'update', 1), (1, 'a2', 12, 'update', 2), (3, None, None, 'delete', 1), (6, 'f', 60, 'insert', 1)],
+    'expected': [(1, 'a2', 12), (2, 'b', 20), (6, 'f', 60)]
+  }
+]
+
+#XXX: The streaming jobs write `insert`/`update`/`delete` in `_op`, employee-details-cdc-etl.py `I`/`U`/`D` in `Op`.
+EMPLOYEE_DETAILS_OPS = {'insert': 'I', 'update': 'U', 'delete': 'D'}
+
+
+def load_functions(script_path, names, namespace) -> list:
+  '''Compile only the named top-level functions or classes of a script that cannot be imported, e.g. a Glue job with module-level code'''
+  with open(script_path) as f:
+    tree = ast.parse(f.read(), script_path)
+  module = ast.Module(body=[n for n in tree.body if isinstance(n, (ast.FunctionDef, ast.ClassDef)) and n.name in names], type_ignores=[])
+  exec(compile(module, script_path, 'exec'), namespace)
+  return [namespace[name] for name in names]
+
+
+class StreamingJobVariant:
+  '''The MERGE statements of the streaming CDC jobs, i.e. spark_sql_merge_into_iceberg.py'''
+
+  name = 'streaming'
+  columns = ['id', 'name', 'amount']
+  op_column, delete_op = '_op', 'delete'
+
+  def __init__(self, spark):
+    from streaming_batch_helpers import buildCombinedMergeQuery, buildMergePruningPredicate, dedupLatest
+    self.spark = spark
+    self.build_combined_merge_query = buildCombinedMergeQuery
+    self.build_merge_pruning_predicate = buildMergePruningPredicate
+    self.dedup_latest = dedupLatest
+
+  def createChanges(self, changes):
+    return self.spark.createDataFrame([(key, name, amount, op, T0 + datetime.timedelta(seconds=sec))
+      for key, name, amount, op, sec in changes],
+      'id INT, name STRING, amount INT, _op STRING, _op_timestamp TIMESTAMP')
+
+  def dedup(self, changes_df):
+    from pyspark.sql.functions import col, when
+    return self.dedup_latest(changes_df, 'id', '_op_timestamp', self.columns + ['_op'],
+      tiebreak_columns=[when(col('_op') == 'insert', 0).when(col('_op') == 'update', 1).otherwise(2)])
+
+  def mergeCondition(self, deduped_df):
+    pruning_predicate = self.build_merge_pruning_predicate(deduped_df, 'id', [])
+    return f"s.id = t.id AND {pruning_predicate}" if pruning_predicate else "s.id = t.id"
+
+  def combined(self, table_ident, deduped_df, merge_condition):
+    deduped_df.createOrReplaceTempView('changes_cdc')
+    self.spark.sql(self.build_combined_merge_query(table_ident, 'changes_cdc', merge_condition, self.columns,
+      op_column=self.op_column, delete_op=self.delete_op))
+
+  def separate(self, table_ident, deduped_df, merge_condition):
+    '''The upsert MERGE followed by the delete MERGE, which the jobs ran before the combined MERGE'''
+    deduped_df.filter(f"{self.op_column} != '{self.delete_op}'").drop(self.op_column).createOrReplaceTempView('changes_upsert')
+    deduped_df.filter(f"{self.op_column} = '{self.delete_op}'").drop(self.op_column).createOrReplaceTempView('changes_delete')
+    self.spark.sql(f"""MERGE INTO {table_ident} t
+      USING changes_upsert s ON {merge_condition}
+      WHEN MATCHED THEN UPDATE SET *
+      WHEN NOT MATCHED THEN INSERT *
+      """)
+    self.spark.sql(f"""MERGE INTO {table_ident} t
+      USING changes_delete s ON {merge_condition}
+      WHEN MATCHED THEN DELETE
+      """)
+
+
+class EmployeeDetailsVariant(StreamingJobVariant):
+  '''The MERGE statements of employee-details-cdc-etl.py, a batch job whose de-duplication is loaded from its source'''
+
+  name = 'employee_details'
+  op_column, delete_op = 'Op', 'D'
+
+  def __init__(self, spark, script_path):
+    from pyspark.sql import functions
+    super().__init__(spark)
+    self.deduplicate_cdc = load_functions(script_path, ['deduplicate_cdc'], dict(vars(functions)))[0]
+
+  def createChanges(self, changes):
+    return self.spark.createDataFrame([(EMPLOYEE_DETAILS_OPS[op], key, name, amount, T0 + datetime.timedelta(seconds=sec))
+      for key, name, amount, op, sec in changes],
+      'Op STRING, id INT, name STRING, amount INT, m_time TIMESTAMP')
+
+  def dedup(self, changes_df):
+    return self.deduplicate_cdc(changes_df, 'id').drop('m_time')
+
+
+def run_case(spark, variant, case, strategy) -> list:
+  '''Apply the changes of a case to a fresh table with the `combined` or `separate` MERGE statements, and return its rows'''
+  table_ident = f"local.merge_check.{variant.name}_{case['name']}_{strategy}"
+  spark.sql(f"DROP TABLE IF EXISTS {table_ident}")
+  spark.sql(f"CREATE TABLE {table_ident} (id INT, name STRING, amount INT) USING iceberg")
+  spark.createDataFrame(INITIAL_ROWS, 'id INT, name STRING, amount INT').writeTo(table_ident).append()
+
+  deduped_df = variant.dedup(variant.createChanges(case['changes']))
+  merge_condition = variant.mergeCondition(deduped_df)
+  getattr(variant, strategy)(table_ident, deduped_df, merge_condition)
+  return [tuple(row) for row in spark.table(table_ident).orderBy('id').collect()]
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description='Check that the combined CDC MERGE leaves an Iceberg table exactly as the separate upsert and delete MERGE statements do.')
+
+  parser.add_argument('--suite', default=os.path.join(BENCHMARK_DIR, 'conf', 'write_strategy_suite.json'),
+    help='The suite to take the name of the Iceberg jar from (default: conf/write_strategy_suite.json)')
+  parser.add_argument('--jars-dir', default='./jars',
+    help='The directory with the Iceberg jar named in the suite (default: ./jars)')
+  parser.add_argument('--work-dir', default='./merge-correctness-check',
+    help='The directory for the Iceberg warehouse (default: ./merge-correctness-check)')
+  parser.add_argument('--employee-details-script', default=EMPLOYEE_DETAILS_SCRIPT,
+    help='The path of employee-details-cdc-etl.py, relative to this project')
+  parser.add_argument('--master', default='local[2]',
+    help='The Spark master (default: local[2])')
+
+  options = parser.parse_args()
+  with open(options.suite) as f:
+    iceberg_jar = os.path.join(os.path.abspath(options.jars_dir), json.load(f)['jars']['iceberg'])
+  if not os.path.isfile(iceberg_jar):
+    parser.error(f"{iceberg_jar} does not exist, download it into --jars-dir")
+  warehouse = os.path.join(os.path.abspath(options.work_dir), 'warehouse')
+  if os.path.isdir(warehouse):
+    shutil.rmtree(warehouse)
+
+  sys.path.insert(0, COMMON_DIR)
+  from pyspark.sql import SparkSession
+  spark = SparkSession.builder.master(options.master) \
+    .config('spark.jars', iceberg_jar) \
+    .config('spark.ui.enabled', 'false') \
+    .config('spark.sql.shuffle.partitions', '2') \
+    .config('spark.sql.extensions', 'org.apache.iceberg.spark.extensions.IcebergSparkSessionExtensions') \
+    .config('spark.sql.catalog.local', 'org.apache.iceberg.spark.SparkCatalog') \
+    .config('spark.sql.catalog.local.type', 'hadoop') \
+    .config('spark.sql.catalog.local.warehouse', warehouse) \
+    .getOrCreate()
+
+  variants = [StreamingJobVariant(spark), EmployeeDetailsVariant(spark, resolve_path(options.employee_details_script))]
+  failures = 0
+  for variant in variants:
+    for case in CASES:
+      combined_rows = run_case(spark, variant, case, 'combined')
+      separate_rows = run_case(spark, variant, case, 'separate')
+      ok = combined_rows == separate_rows == case['expected']
+      failures += 0 if ok else 1
+      print(json.dumps({
+        'event': 'merge_correctness_case',
+        'variant': variant.name,
+        'case': case['name'],
+        'ok': ok,
+        **({} if ok else {'expected': case['expected'], 'combined': combined_rows, 'separate': separate_rows})
+      }))
+
+  print(json.dumps({'event': 'merge_correctness_summary', 'cases': len(variants) * len(CASES), 'failures': failures}))
+  sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCHMARK_DIR = os.path.dirname(SRC_DIR)
+
+#XXX: The columns of the comparison table, as (header, path in the report of run_local_benchmark.py).
+RESULT_COLUMNS = [
+  ('rows', ('rows',)),
+  ('rows/sec', ('rows_per_sec',)),
+  ('p50 batch sec', ('batch_latency_p50_sec',)),
+  ('p95 batch sec', ('batch_latency_p95_sec',)),
+  ('commits/batch', ('commits_per_batch',)),
+  ('data files', ('data_files',)),
+  ('scan sec', ('read_after_write', 'scan_sec')),
+  ('scan files', ('read_after_write', 'files')),
+  ('table rows', ('read_after_write', 'rows'))
+]
+
+
+def resolve_path(path):
+  return path if os.path.isabs(path) else os.path.normpath(os.path.join(BENCHMARK_DIR, path))
+
+
+def generate_input(output_path, shape, workload, part, size, suite):
+  '''Write the preload or workload files once, to be copied into the input of every variant'''
+  if os.path.isdir(output_path):
+    return output_path
+  workload_conf = suite['workload']
+  subprocess.run([sys.executable, os.path.join(SRC_DIR, 'gen_local_stream_data.py'),
+    '--shape', shape,
+    '--workload', workload,
+    '--part', part,
+    '--output-path', output_path,
+    '--preload-keys', str(size['preload_keys']),
+    #XXX: Updates and deletes hit the preloaded rows.
+    '--num-keys', str(max(size['preload_keys'], 1)),
+    '--num-files', str(workload_conf['num_files']),
+    '--records-per-file', str(workload_conf['records_per_file']),
+    '--seed', str(workload_conf.get('seed', 47))
+  ], check=True)
+  return output_path
+
+
+def copy_input(source_path, input_path):
+  #XXX: Copy instead of linking, so that the copies get new modification times
+  # and the file source takes them after the files of the previous run.
+  os.makedirs(input_path, exist_ok=True)
+  for path in sorted(glob.glob(os.path.join(source_path, '*.json'))):
+    shutil.copy(path, input_path)
+
+
+def run_variant(variant, run_name, input_path, work_dir, report_path, suite, options, measure_read):
+  command = [sys.executable, os.path.join(SRC_DIR, 'run_local_benchmark.py'),
+    '--script', resolve_path(variant['script']),
+    '--name', run_name,
+    '--input-path', input_path,
+    '--max-files-per-trigger', str(suite['workload']['max_files_per_trigger']),
+    '--work-dir', work_dir,
+    '--report-path', report_path,
+    '--driver-memory', options.driver_memory,
+    '--shuffle-partitions', str(options.shuffle_partitions)
+  ]
+  for jar in variant.get('jars', []):
+    command += ['--jars', os.path.join(options.jars_dir, suite['jars'][jar])]
+  for conf in variant.get('conf', []):
+    command += ['--conf', conf]
+  if variant.get('setup_sql'):
+    command += ['--setup-sql', resolve_path(variant['setup_sql'])]
+  if measure_read and variant.get('read_table'):
+    command += ['--read-table', variant['read_table']]
+  elif measure_read and variant.get('read_format'):
+    command += ['--read-format', variant['read_format'], '--read-path', variant['read_path']]
+  #XXX: The preload and the workload runs share the job name, and so the checkpoint under TempDir.
+  command += ['--', '--JOB_NAME', variant['name']] + variant['job_args']
+
+  with open(f"{report_path}.log", 'w') as log:
+    completed = subprocess.run(command, stdout=log, stderr=subprocess.STDOUT)
+  if completed.returncode != 0:
+    raise RuntimeError(f"{run_name} failed with exit code {completed.returncode}, see {report_path}.log")
+  with open(report_path) as f:
+    return json.load(f)
+
+
+def lookup(report, path):
+  value = report
+  for key in path:
+    value = value.get(key) if isinstance(value, dict) else None
+  return value
+
+
+def format_markdown_table(results) -> str:
+  headers = ['table size', 'workload', 'variant'] + [e[0] for e in RESULT_COLUMNS]
+  lines = [f"| {' | '.join(headers)} |", f"|{'|'.join(['---'] * len(headers))}|"]
+  for result in results:
+    if 'error' in result:
+      cells = [result['error']] + [''] * (len(RESULT_COLUMNS) - 1)
+    else:
+      values = [lookup(result['report'], path) for _, path in RESULT_COLUMNS]
+      cells = ['' if e is None else (f"{e:.3f}" if isinstance(e, float) else str(e)) for e in values]
+    lines.append(f"| {' | '.join([result['table_size'], result['workload'], result['variant']] + cells)} |")
+  return '\n'.join(lines)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description='Run the streaming write strategies of Iceberg, Delta Lake and Hudi on the same workloads and compare them.')
+
+  parser.add_argument('--suite', default=os.path.join(BENCHMARK_DIR, 'conf', 'write_strategy_suite.json'),
+    help='The suite of variants, table sizes and workload (default: conf/write_strategy_suite.json)')
+  parser.add_argument('--jars-dir', default='./jars',
+    help='The directory with the jar files named in the suite (default: ./jars)')
+  parser.add_argument('--output-dir', default='./write-strategy-benchmark',
+    help='The directory for inputs, tables, logs and results (default: ./write-strategy-benchmark)')
+  parser.add_argument('--variant', action='append', default=[],
+    help='Run only these variants (default: all)')
+  parser.add_argument('--workload', action='append', default=[],
+    choices=['insert_only', 'upsert_heavy', 'delete_heavy'],
+    help='Run only these workloads (default: all that each variant supports)')
+  parser.add_argument('--table-size', action='append', default=[],
+    help='Run only these table sizes (default: all)')
+  parser.add_argument('--driver-memory', default='4g',
+    help='The Spark driver memory (default: 4g)')
+  parser.add_argument('--shuffle-partitions', default=8, type=int,
+    help='spark.sql.shuffle.partitions (default: 8)')
+
+  options = parser.parse_args()
+  with open(options.suite) as f:
+    suite = json.load(f)
+  options.jars_dir = os.path.abspath(options.jars_dir)
+  options.output_dir = os.path.abspath(options.output_dir)
+
+  results = []
+  for size in [e for e in suite['table_sizes'] if not options.table_size or e['name'] in options.table_size]:
+    for variant in [e for e in suite['variants'] if not options.variant or e['name'] in options.variant]:
+      for workload in [e for e in variant['workloads'] if not options.workload or e in options.workload]:
+        run_name = f"{size['name']}/{workload}/{variant['name']}"
+        run_dir = os.path.join(options.output_dir, 'runs', size['name'], workload, variant['name'])
+        if os.path.isdir(run_dir):
+          shutil.rmtree(run_dir)
+        input_path = os.path.join(run_dir, 'input')
+        data_dir = os.path.join(options.output_dir, 'data', size['name'], variant['shape'])
+        result = {'table_size': size['name'], 'workload': workload, 'variant': variant['name']}
+
+        try:
+          #XXX: Load the table first and then restart the job from its checkpoint with the workload files,
+          # so that the report only covers the workload, whatever write strategy the job uses.
+          if size['preload_keys'] > 0:
+            copy_input(generate_input(os.path.join(data_dir, 'preload'), variant['shape'], workload, 'preload', size, suite), input_path)
+            run_variant(variant, f"{run_name}/preload", input_path, run_dir,
+              os.path.join(run_dir, 'preload.json'), suite, options, measure_read=False)
+          copy_input(generate_input(os.path.join(data_dir, workload), variant['shape'], workload, 'workload', size, suite), input_path)
+          result['report'] = run_variant(variant, run_name, input_path, run_dir,
+            os.path.join(run_dir, 'report.json'), suite, options, measure_read=True)
+        except (RuntimeError, subprocess.CalledProcessError) as ex:
+          result['error'] = str(ex)
+
+        results.append(result)
+        print(json.dumps({'event': 'write_strategy_benchmark_run', **{k: v for k, v in result.items() if k != 'report'},
+          **{header: lookup(result.get('report', {}), path) for header, path in RESULT_COLUMNS}}))
+
+  os.makedirs(options.output_dir, exist_ok=True)
+  with open(os.path.join(options.output_dir, 'results.json'), 'w') as f:
+    json.dump(results, f, indent=2)
+  table = format_markdown_table(results)
+  with open(os.path.join(options.output_dir, 'results.md'), 'w') as f:
+    f.write(f"{table}\n")
+  print(table)
+
+
+if __name__ == '__main__':
+  main()
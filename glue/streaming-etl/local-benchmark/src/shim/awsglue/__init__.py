@@ -0,0 +1,9 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+#XXX: A minimal stand-in for the `awsglue` library, which only exists inside AWS Glue.
+# It implements just what the streaming ETL scripts of this repository call,
+# so that they can run on plain PySpark with `run_local_benchmark.py`.
+
+from awsglue.dynamicframe import DynamicFrame
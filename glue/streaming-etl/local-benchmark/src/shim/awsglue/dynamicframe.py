@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+
+class DynamicFrame:
+  '''Wrap a Spark DataFrame; the scripts only convert DataFrames to DynamicFrames and back.'''
+
+  def __init__(self, data_frame, glue_ctx=None, name=None):
+    self._df = data_frame
+    self.glue_ctx = glue_ctx
+    self.name = name
+
+  @classmethod
+  def fromDF(cls, data_frame, glue_ctx, name):
+    return cls(data_frame, glue_ctx, name)
+
+  def toDF(self):
+    return self._df
+
+  def count(self):
+    return self._df.count()
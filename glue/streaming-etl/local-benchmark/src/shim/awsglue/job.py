@@ -0,0 +1,16 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+
+class Job:
+  '''Job bookmarks and run state do not exist locally, so init() and commit() do nothing.'''
+
+  def __init__(self, glue_context):
+    self.glue_context = glue_context
+
+  def init(self, job_name, args=None):
+    self.job_name = job_name
+
+  def commit(self):
+    pass
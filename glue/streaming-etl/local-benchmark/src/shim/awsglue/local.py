@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import os
+import re
+import time
+
+from pyspark.sql.readwriter import DataFrameWriter
+from pyspark.sql.streaming import DataStreamReader, DataStreamWriter, StreamingQuery
+
+_harness = None
+
+#XXX: Completed commits of each table format, and the directories that hold table metadata instead of data files.
+COMMIT_FILE_PATTERN = re.compile(r'(\.metadata\.json|/_delta_log/\d+\.json|/\.hoodie/[^/]+\.(commit|deltacommit|replacecommit)|/_SUCCESS)$')
+METADATA_DIRS = {'metadata', '_delta_log', '.hoodie'}
+DATA_FILE_PATTERN = re.compile(r'(\.parquet|\.orc|\.avro|\.log\.\d+(_[\w-]+)?)$')
+
+
+def harness():
+  if _harness is None:
+    raise RuntimeError("The awsglue shim only works under run_local_benchmark.py")
+  return _harness
+
+
+def install(local_harness):
+  global _harness
+  _harness = local_harness
+  local_harness.patch_pyspark()
+
+
+def percentile(values, q):
+  if not values:
+    return None
+  ordered = sorted(values)
+  return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+class LocalHarness:
+  '''Feed the Glue streaming scripts from local files or a rate source and measure every micro-batch
+
+  Micro-batches run back to back when reading files, so that every variant processes the same input
+  as fast as it can; with the rate source they follow the window size of the script for `duration_sec`.
+  '''
+
+  def __init__(self, warehouse_path, input_path=None, max_files_per_trigger=1,
+      rate_rows_per_second=None, rate_select_exprs=None, duration_sec=60, setup_sql=None):
+    self.warehouse_path = warehouse_path
+    self.input_path = input_path
+    self.max_files_per_trigger = max_files_per_trigger
+    self.rate_rows_per_second = rate_rows_per_second
+    self.rate_select_exprs = rate_select_exprs or []
+    self.duration_sec = duration_sec
+    self.setup_sql = setup_sql
+
+    self.batches = {}
+    self.progress = []
+    self._schema = None
+    self._is_set_up = False
+    self._start_files = None
+    self._started_at = None
+    self._finished_at = None
+
+  @property
+  def is_rate_source(self) -> bool:
+    return self.rate_rows_per_second is not None
+
+  def patch_pyspark(self):
+    '''Send the Kinesis and Kafka readers of Spark to the local source, let queries run until the input is consumed,
+    and turn off the Hive sync of Hudi writes, which needs the Glue Data Catalog'''
+    local_harness = self
+    original_format = DataStreamReader.format
+    original_load = DataStreamReader.load
+    original_trigger = DataStreamWriter.trigger
+    original_await_termination = StreamingQuery.awaitTermination
+    original_write_format = DataFrameWriter.format
+    original_save = DataFrameWriter.save
+
+    def _format(reader, source):
+      reader._local_source = source
+      return original_format(reader, source)
+
+    def _load(reader, path=None, format=None, schema=None, **options):
+      source = format or getattr(reader, '_local_source', None)
+      if source in ('kinesis', 'kafka'):
+        return local_harness.create_raw_stream(reader._spark, source)
+      return original_load(reader, path, format, schema, **options)
+
+    def _trigger(writer, *args, **kwargs):
+      if not local_harness.is_rate_source:
+        return writer
+      return original_trigger(writer, *args, **kwargs)
+
+    def _awaitTermination(query, timeout=None):
+      #XXX: A query waited for in steps, e.g. to poll its progress, also runs until the input is consumed and then stops.
+      local_harness.await_query(query)
+      return True if timeout is not None else None
+
+    def _writeFormat(writer, source):
+      writer._local_format = source
+      return original_write_format(writer, source)
+
+    def _save(writer, path=None, format=None, mode=None, partitionBy=None, **options):
+      if (format or getattr(writer, '_local_format', None)) in ('hudi', 'org.apache.hudi'):
+        writer.option('hoodie.datasource.hive_sync.enable', 'false')
+      return original_save(writer, path, format, mode, partitionBy, **options)
+
+    self._original_await_termination = original_await_termination
+    DataStreamReader.format = _format
+    DataStreamReader.load = _load
+    DataStreamWriter.trigger = _trigger
+    StreamingQuery.awaitTermination = _awaitTermination
+    DataFrameWriter.format = _writeFormat
+    DataFrameWriter.save = _save
+
+  def setup(self, spark):
+    if self._is_set_up:
+      return
+    self._is_set_up = True
+    self._localize_catalogs(spark)
+
+    if self.setup_sql:
+      with open(self.setup_sql) as f:
+        statements = [e.strip() for e in f.read().split(';')]
+      for statement in [e for e in statements if e]:
+        spark.sql(statement)
+    self._start_files = self.scan_warehouse()
+
+  def _localize_catalogs(self, spark):
+    #XXX: Replace the Glue Data Catalog, S3 and DynamoDB settings of Iceberg catalogs with a Hadoop catalog,
+    # whose warehouse is the local `iceberg_s3_path` given to the script.
+    for key, value in spark.sparkContext.getConf().getAll():
+      m = re.match(r'^spark\.sql\.catalog\.([^.]+)\.catalog-impl$', key)
+      if not m or value != 'org.apache.iceberg.aws.glue.GlueCatalog':
+        continue
+      prefix = f"spark.sql.catalog.{m.group(1)}"
+      for suffix in ('catalog-impl', 'io-impl', 'lock-impl', 'lock.table'):
+        spark.conf.unset(f"{prefix}.{suffix}")
+      spark.conf.set(f"{prefix}.type", "hadoop")
+
+  def source_schema(self, spark):
+    if self._schema is None:
+      if self.is_rate_source:
+        self._schema = spark.createDataFrame([], 'timestamp TIMESTAMP, value BIGINT') \
+          .selectExpr(*self.rate_select_exprs).schema
+      else:
+        self._schema = spark.read.json(self.input_path).schema
+    return self._schema
+
+  def create_stream(self, spark, options={}):
+    '''The parsed records, like the Glue sources return them'''
+    if self.is_rate_source:
+      return spark.readStream.format('rate') \
+        .option('rowsPerSecond', self.rate_rows_per_second) \
+        .load() \
+        .selectExpr(*self.rate_select_exprs)
+    return spark.readStream.schema(self.source_schema(spark)) \
+      .option('maxFilesPerTrigger', self.max_files_per_trigger) \
+      .json(self.input_path)
+
+  def create_raw_stream(self, spark, source):
+    '''The records as binary payloads, like the Spark Kinesis (`data`) and Kafka (`value`) sources return them'''
+    payload_column = 'data' if source == 'kinesis' else 'value'
+    if self.is_rate_source:
+      return self.create_stream(spark) \
+        .selectExpr(f"CAST(to_json(struct(*)) AS BINARY) AS {payload_column}")
+    return spark.readStream.option('maxFilesPerTrigger', self.max_files_per_trigger) \
+      .text(self.input_path) \
+      .selectExpr(f"CAST(value AS BINARY) AS {payload_column}")
+
+  def run_for_each_batch(self, frame, batch_function, options):
+    writer = frame.writeStream \
+      .foreachBatch(self._instrument(batch_function)) \
+      .option('checkpointLocation', options['checkpointLocation'])
+    if self.is_rate_source:
+      writer = writer.trigger(processingTime=options.get('windowSize', '10 seconds'))
+    self.await_query(writer.start())
+
+  def await_query(self, query):
+    self._started_at = time.perf_counter()
+    try:
+      if self.is_rate_source:
+        self._original_await_termination(query, self.duration_sec)
+      else:
+        query.processAllAvailable()
+    finally:
+      self._finished_at = time.perf_counter()
+      self.progress = query.recentProgress
+      query.stop()
+
+  def _instrument(self, batch_function):
+    def instrumented_batch_function(data_frame, batch_id):
+      files_before = self.scan_warehouse()
+      start_time = time.perf_counter()
+      batch_function(data_frame, batch_id)
+      elapsed_sec = time.perf_counter() - start_time
+      files_after = self.scan_warehouse()
+
+      self.batches[batch_id] = {
+        'batch_id': batch_id,
+        'elapsed_sec': elapsed_sec,
+        'commits': len(files_after['commits'] - files_before['commits']),
+        'data_files': len(files_after['data_files'] - files_before['data_files'])
+      }
+    return instrumented_batch_function
+
+  def scan_warehouse(self):
+    commits, data_files = set(), set()
+    for root, dirs, files in os.walk(self.warehouse_path):
+      in_metadata_dir = bool(METADATA_DIRS.intersection(os.path.relpath(root, self.warehouse_path).split(os.sep)))
+      for name in files:
+        path = os.path.join(root, name)
+        if COMMIT_FILE_PATTERN.search(path) and '/.hoodie/metadata/' not in path:
+          commits.add(path)
+        elif not in_metadata_dir and not name.endswith('.crc') and DATA_FILE_PATTERN.search(name):
+          data_files.add(path)
+    return {'commits': commits, 'data_files': data_files}
+
+  def measure_read(self, data_frame) -> dict:
+    '''The cost of reading the whole table back, i.e. of the first query after the writes'''
+    start_time = time.perf_counter()
+    #XXX: The noop sink reads every column of every row without writing them anywhere.
+    data_frame.write.format('noop').mode('overwrite').save()
+    scan_sec = time.perf_counter() - start_time
+    return {
+      'scan_sec': scan_sec,
+      'rows': data_frame.count(),
+      'files': len(data_frame.inputFiles())
+    }
+
+  def report(self) -> dict:
+    end_files = self.scan_warehouse()
+    batches = []
+    for progress in self.progress:
+      if progress['numInputRows'] == 0 and progress['batchId'] not in self.batches:
+        continue
+      batch = {
+        'batch_id': progress['batchId'],
+        'rows': progress['numInputRows'],
+        'elapsed_sec': progress['durationMs'].get('triggerExecution', 0) / 1000
+      }
+      batch.update(self.batches.get(progress['batchId'], {}))
+      batches.append(batch)
+
+    rows = sum([e['rows'] for e in batches])
+    batch_elapsed = [e['elapsed_sec'] for e in batches]
+    processing_sec = sum(batch_elapsed)
+    commits = len(end_files['commits'] - self._start_files['commits'])
+    data_files = len(end_files['data_files'] - self._start_files['data_files'])
+    return {
+      'batches': len(batches),
+      'rows': rows,
+      'wall_clock_sec': (self._finished_at - self._started_at) if self._started_at else None,
+      'processing_sec': processing_sec,
+      'rows_per_sec': rows / processing_sec if processing_sec else None,
+      'batch_latency_p50_sec': percentile(batch_elapsed, 0.5),
+      'batch_latency_p95_sec': percentile(batch_elapsed, 0.95),
+      'batch_latency_max_sec': max(batch_elapsed) if batch_elapsed else None,
+      'commits': commits,
+      'data_files': data_files,
+      'commits_per_batch': commits / len(batches) if batches else None,
+      'data_files_per_batch': data_files / len(batches) if batches else None,
+      'per_batch': batches
+    }
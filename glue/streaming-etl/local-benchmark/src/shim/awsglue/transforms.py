@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+from pyspark.sql.functions import col
+
+from awsglue.dynamicframe import DynamicFrame
+
+__all__ = ['ApplyMapping']
+
+
+class ApplyMapping:
+
+  @staticmethod
+  def apply(frame, mappings, transformation_ctx=None, **kwargs):
+    data_frame = frame.toDF().select([col(source).cast(target_type).alias(target)
+      for source, _source_type, target, target_type in mappings])
+    return DynamicFrame(data_frame, frame.glue_ctx, transformation_ctx)
@@ -0,0 +1,20 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import argparse
+
+#XXX: AWS Glue passes these arguments to every job and returns them even if the script does not ask for them.
+RESERVED_OPTIONS = ['TempDir', 'job_bookmark_option', 'job_id', 'JOB_RUN_ID']
+
+
+def getResolvedOptions(args, options):
+  parser = argparse.ArgumentParser(allow_abbrev=False)
+  for option in options:
+    parser.add_argument(f'--{option}', required=True)
+  for option in RESERVED_OPTIONS:
+    if option not in options:
+      parser.add_argument(f'--{option}')
+
+  parsed, _ = parser.parse_known_args(args[1:])
+  return {k: v for k, v in vars(parsed).items() if v is not None}
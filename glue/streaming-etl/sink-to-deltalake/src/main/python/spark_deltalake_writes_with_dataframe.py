@@ -2,9 +2,12 @@
 # -*- encoding: utf-8 -*-
 # vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
 
+import json
 import os
 import sys
 import re
+import time
+import traceback
 
 from awsglue.transforms import *
 from awsglue.utils import getResolvedOptions
@@ -15,9 +18,12 @@ from awsglue import DynamicFrame
 
 from pyspark.conf import SparkConf
 from pyspark.sql import DataFrame, Row
+from pyspark.sql.utils import ParseException
 from pyspark.sql.types import *
 from pyspark.sql.functions import *
 
+from streaming_batch_helpers import getOptionalResolvedOptions
+
 
 def get_kinesis_stream_name_from_arn(stream_arn):
   ARN_PATTERN = re.compile(r'arn:aws:kinesis:([a-z0-9-]+):(\d+):stream/([a-zA-Z0-9-_]+)')
@@ -38,6 +44,16 @@ args = getResolvedOptions(sys.argv, ['JOB_NAME',
   'window_size'
 ])
 
+args.update(getOptionalResolvedOptions(sys.argv, {
+  'optimize_write': 'false',
+  'optimize_interval_batches': '0',
+  'optimize_zorder_columns': '',
+  'optimize_min_files': '10',
+  'delta_checkpoint_interval': '',
+  'checkpoint_min_batches_to_retain': '',
+  'checkpoint_location': ''
+}))
+
 CATALOG = args['catalog']
 
 DELTA_S3_PATH = args['delta_s3_path']
@@ -55,6 +71,14 @@ STARTING_POSITION_OF_KINESIS_ITERATOR = args.get('starting_position_of_kinesis_i
 
 AWS_REGION = args['aws_region']
 WINDOW_SIZE = args.get('window_size', '100 seconds')
+OPTIMIZE_WRITE = args['optimize_write'].lower() == 'true'
+OPTIMIZE_INTERVAL_BATCHES = int(args['optimize_interval_batches'])
+#XXX: Frequently filtered columns; the partition column cannot be Z-ordered.
+OPTIMIZE_ZORDER_COLUMNS = [c.strip() for c in args['optimize_zorder_columns'].split(',') if c.strip()]
+if PARTITION_KEY in OPTIMIZE_ZORDER_COLUMNS:
+  raise ValueError(f"optimize_zorder_columns cannot include the partition column '{PARTITION_KEY}'")
+#XXX: e.g., '10'; the number of commits between two checkpoints of the Delta log
+DELTA_CHECKPOINT_INTERVAL = args['delta_checkpoint_interval']
 
 
 def setSparkDeltalakeConf() -> SparkConf:
@@ -86,6 +110,132 @@ LOCATION '{DELTA_S3_PATH}'
 
 spark.sql(CREATE_DELTA_TABLE_SQL)
 
+class DeltaTableMaintenance:
+  '''Compact and Z-order the partitions of a streaming Delta table, and set how often its log is checkpointed
+
+  `OPTIMIZE ... ZORDER BY` needs Delta Lake 2.0 or later (AWS Glue 4.0). With older versions, the partitions
+  with at least `min_files` files are compacted by rewriting them with `dataChange = false`, sorted by the
+  Z-order columns, so that streaming readers of the table skip the rewrite.
+  Set `compact_fallback` to False when the maintenance runs next to a streaming append to the same
+  partitions: the `replaceWhere` rewrite would conflict with it (ConcurrentAppendException).
+  '''
+
+  def __init__(self, spark, table, table_path, partition_key, interval_batches,
+      zorder_columns=None, min_files=10, checkpoint_interval=None, compact_fallback=True):
+    self.spark = spark
+    self.table = table
+    self.table_path = table_path
+    self.partition_key = partition_key
+    self.interval_batches = interval_batches
+    self.zorder_columns = zorder_columns or []
+    self.min_files = min_files
+    self.checkpoint_interval = checkpoint_interval
+    self.compact_fallback = compact_fallback
+    self._is_configured = False
+    self._optimize_supported = True
+    #XXX: None means all partitions, e.g. when the job cannot see what each micro-batch wrote.
+    self._pending_partition_values = None
+
+  def isDue(self, batch_id) -> bool:
+    return self.interval_batches > 0 and batch_id > 0 and batch_id % self.interval_batches == 0
+
+  def configure(self):
+    if self._is_configured or not self.checkpoint_interval:
+      return
+    properties = {row['key']: row['value'] for row in self.spark.sql(f"SHOW TBLPROPERTIES {self.table}").collect()}
+    if properties.get('delta.checkpointInterval') != str(self.checkpoint_interval):
+      self.spark.sql(f"ALTER TABLE {self.table} SET TBLPROPERTIES ('delta.checkpointInterval' = '{self.checkpoint_interval}')")
+    self._is_configured = True
+
+  def addWrittenPartitions(self, data_frame):
+    '''Remember the partitions a micro-batch wrote to, so that only those are optimized'''
+    if self.interval_batches <= 0:
+      return
+    values = [row[0] for row in data_frame.select(self.partition_key).distinct().collect()]
+    self._pending_partition_values = (self._pending_partition_values or set()) | set(values)
+
+  def _partitionFilter(self, values):
+    partition_column = col(self.partition_key)
+    partition_filter = partition_column.isin([v for v in values if v is not None])
+    return partition_filter | partition_column.isNull() if None in values else partition_filter
+
+  @staticmethod
+  def _literal(value) -> str:
+    if isinstance(value, str):
+      return "'{}'".format(value.replace('\\', '\\\\').replace("'", "\\'"))
+    return str(value)
+
+  def _partitionPredicate(self, values) -> str:
+    predicates = [f"{self.partition_key} = {self._literal(v)}" for v in sorted([v for v in values if v is not None])]
+    predicates += [f"{self.partition_key} IS NULL"] if None in values else []
+    return ' OR '.join(predicates)
+
+  def _optimize(self, values):
+    where = f" WHERE {self._partitionPredicate(values)}" if values is not None else ''
+    zorder_by = f" ZORDER BY ({', '.join(self.zorder_columns)})" if self.zorder_columns else ''
+    rows = self.spark.sql(f"OPTIMIZE {self.table}{where}{zorder_by}").collect()
+    return {'optimize': rows[0].asDict(recursive=True)['metrics'] if rows else {}}
+
+  def _compact(self, values):
+    table_df = self.spark.read.format('delta').load(self.table_path)
+    if values is not None:
+      table_df = table_df.filter(self._partitionFilter(values))
+    file_counts = table_df.select(self.partition_key, input_file_name().alias('_file')).distinct() \
+      .groupBy(self.partition_key).count() \
+      .collect()
+    compact_values = set([row[0] for row in file_counts if row['count'] >= self.min_files])
+    if not compact_values:
+      return {'compacted_partitions': 0}
+
+    #XXX: One file per partition, since the rewrite only covers the partitions of a streaming table that have piled up small files.
+    compacted_df = table_df.filter(self._partitionFilter(compact_values)).repartition(self.partition_key)
+    if self.zorder_columns:
+      compacted_df = compacted_df.sortWithinPartitions(*self.zorder_columns)
+    compacted_df.write.format('delta') \
+      .mode('overwrite') \
+      .option('dataChange', 'false') \
+      .option('replaceWhere', self._partitionPredicate(compact_values)) \
+      .save(self.table_path)
+    return {'compacted_partitions': len(compact_values)}
+
+  def run(self):
+    start_time = time.monotonic()
+    values = self._pending_partition_values
+    report = {
+      'event': 'delta_table_maintenance',
+      'table': self.table,
+      'partitions': len(values) if values is not None else 'all'
+    }
+    try:
+      if values is not None and not values:
+        report['skipped'] = 'no partitions written since the last run'
+      else:
+        if self._optimize_supported:
+          try:
+            report.update(self._optimize(values))
+          except ParseException:
+            #XXX: OPTIMIZE is not in the SQL grammar of Delta Lake 1.0 (AWS Glue 3.0).
+            self._optimize_supported = False
+        if not self._optimize_supported and not self.compact_fallback:
+          report['skipped'] = 'OPTIMIZE needs Delta Lake 2.0 or later, and compaction is disabled'
+        elif not self._optimize_supported:
+          report.update(self._compact(values))
+        self._pending_partition_values = None if values is None else set()
+    except Exception as ex:
+      #XXX: A failed maintenance run should not stop the stream; its partitions are tried again on the next run.
+      traceback.print_exc()
+      report['error'] = str(ex)
+    report['elapsed_sec'] = time.monotonic() - start_time
+    print(json.dumps(report, default=str))
+
+table_maintenance = DeltaTableMaintenance(spark, f"{DATABASE}.{TABLE_NAME}", DELTA_S3_PATH, PARTITION_KEY, OPTIMIZE_INTERVAL_BATCHES,
+  zorder_columns=OPTIMIZE_ZORDER_COLUMNS,
+  min_files=int(args['optimize_min_files']),
+  checkpoint_interval=DELTA_CHECKPOINT_INTERVAL,
+  #XXX: The maintenance runs while the stream keeps appending to the same partitions, see below.
+  compact_fallback=False)
+table_maintenance.configure()
+
 # Read from Kinesis Data Stream
 streaming_data = spark.readStream \
                     .format("kinesis") \
@@ -101,7 +251,18 @@ streaming_data_df = streaming_data \
     .select("source_table.*") \
     .withColumn('updated_at', to_timestamp(col('updated_at'), 'yyyy-MM-dd HH:mm:ss'))
 
-checkpointPath = os.path.join(args["TempDir"], args["JOB_NAME"], "checkpoint/")
+if OPTIMIZE_WRITE:
+  #XXX: Shuffle the rows by the partition column before writing them, so that
+  # each partition gets a few large files per micro-batch instead of one per task.
+  streaming_data_df = streaming_data_df.repartition(PARTITION_KEY)
+
+#XXX: e.g., a checkpoint written by the checkpoint tool, to restart the job from other offsets
+checkpointPath = args['checkpoint_location'] or os.path.join(args["TempDir"], args["JOB_NAME"], "checkpoint/")
+
+#XXX: The checkpoint keeps the offsets and commits of the last `checkpoint_min_batches_to_retain` micro-batches
+# (Spark default: 100); fewer of them make the checkpoint smaller and faster to list when the job restarts.
+if args['checkpoint_min_batches_to_retain']:
+  spark.conf.set("spark.sql.streaming.minBatchesToRetain", args['checkpoint_min_batches_to_retain'])
 
 query = streaming_data_df.writeStream \
     .format("delta") \
@@ -111,4 +272,17 @@ query = streaming_data_df.writeStream \
     .option("checkpointLocation", checkpointPath) \
     .start()
 
+if OPTIMIZE_INTERVAL_BATCHES > 0:
+  #XXX: The streaming writer has no batch function, so the maintenance runs from the driver every
+  # OPTIMIZE_INTERVAL_BATCHES micro-batches while the query keeps running. Only OPTIMIZE (Delta Lake 2.0 or later)
+  # runs here, since it does not conflict with the appends of the stream; the `replaceWhere` compaction of
+  # Delta Lake 1.0 would fail with ConcurrentAppendException whenever a micro-batch appends to a compacted partition.
+  last_maintained_batch_id = 0
+  while query.isActive:
+    query.awaitTermination(30)
+    progress = query.lastProgress
+    if progress and progress['batchId'] - last_maintained_batch_id >= OPTIMIZE_INTERVAL_BATCHES:
+      last_maintained_batch_id = progress['batchId']
+      table_maintenance.run()
+
 query.awaitTermination()
@@ -2,8 +2,10 @@
 # -*- encoding: utf-8 -*-
 # vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
 
+import json
 import os
 import sys
+import time
 import traceback
 
 from awsglue.transforms import *
@@ -15,14 +17,22 @@ from awsglue import DynamicFrame
 
 from pyspark.conf import SparkConf
 from pyspark.sql import DataFrame, Row
-from pyspark.sql.window import Window
+from pyspark.sql.utils import ParseException
 from pyspark.sql.functions import (
   col,
-  desc,
-  row_number,
+  expr,
+  get_json_object,
+  input_file_name,
   to_timestamp
 )
 
+from streaming_batch_helpers import (
+  isEmptyDataFrame,
+  dedupLatest,
+  getOptionalResolvedOptions
+)
+from adaptive_window import AdaptiveWindowController, parseWindowSizeSec, runAdaptiveForEachBatch
+
 
 args = getResolvedOptions(sys.argv, ['JOB_NAME',
   'catalog',
@@ -37,6 +47,24 @@ args = getResolvedOptions(sys.argv, ['JOB_NAME',
   'window_size'
 ])
 
+args.update(getOptionalResolvedOptions(sys.argv, {
+  'adaptive_window': 'false',
+  'adaptive_min_window_sec': '30',
+  'adaptive_max_window_sec': '300',
+  'adaptive_min_records_per_trigger': '10000',
+  'adaptive_max_records_per_trigger': '1000000',
+  'adaptive_target_utilization': '0.8',
+  'adaptive_min_batch_rows': '1000',
+  'optimize_write': 'false',
+  'optimize_interval_batches': '0',
+  'optimize_zorder_columns': '',
+  'optimize_min_files': '10',
+  'delta_checkpoint_interval': '',
+  'checkpoint_min_batches_to_retain': '',
+  'checkpoint_location': '',
+  'idempotent_writes': 'false'
+}))
+
 CATALOG = args['catalog']
 DELTA_S3_PATH = args['delta_s3_path']
 DATABASE = args['database_name']
@@ -49,6 +77,16 @@ KINESIS_STREAM_ARN = args['kinesis_stream_arn']
 STARTING_POSITION_OF_KINESIS_ITERATOR = args.get('starting_position_of_kinesis_iterator', 'LATEST')
 AWS_REGION = args['aws_region']
 WINDOW_SIZE = args.get('window_size', '100 seconds')
+ADAPTIVE_WINDOW = args['adaptive_window'].lower() == 'true'
+OPTIMIZE_WRITE = args['optimize_write'].lower() == 'true'
+OPTIMIZE_INTERVAL_BATCHES = int(args['optimize_interval_batches'])
+#XXX: Frequently filtered columns; the partition column cannot be Z-ordered.
+OPTIMIZE_ZORDER_COLUMNS = [c.strip() for c in args['optimize_zorder_columns'].split(',') if c.strip()]
+if PARTITION_KEY in OPTIMIZE_ZORDER_COLUMNS:
+  raise ValueError(f"optimize_zorder_columns cannot include the partition column '{PARTITION_KEY}'")
+#XXX: e.g., '10'; the number of commits between two checkpoints of the Delta log
+DELTA_CHECKPOINT_INTERVAL = args['delta_checkpoint_interval']
+IDEMPOTENT_WRITES = args['idempotent_writes'].lower() == 'true'
 
 def setSparkDeltalakeConf() -> SparkConf:
   conf_list = [
@@ -66,17 +104,194 @@ spark = glueContext.spark_session
 job = Job(glueContext)
 job.init(args['JOB_NAME'], args)
 
-kds_df = glueContext.create_data_frame.from_options(
-  connection_type="kinesis",
-  connection_options={
-    "typeOfData": "kinesis",
-    "streamARN": KINESIS_STREAM_ARN,
-    "classification": "json",
-    "startingPosition": f"{STARTING_POSITION_OF_KINESIS_ITERATOR}",
-    "inferSchema": "true",
-  },
-  transformation_ctx="kds_df",
-)
+kds_options = {
+  "typeOfData": "kinesis",
+  "streamARN": KINESIS_STREAM_ARN,
+  "classification": "json",
+  "startingPosition": f"{STARTING_POSITION_OF_KINESIS_ITERATOR}",
+  "inferSchema": "true",
+}
+
+def createSourceDataFrame(max_records_per_trigger=None):
+  connection_options = {**kds_options, "maxFetchRecordsPerShard": str(max_records_per_trigger)} \
+    if max_records_per_trigger else kds_options
+  return glueContext.create_data_frame.from_options(
+    connection_type="kinesis",
+    connection_options=connection_options,
+    transformation_ctx="kds_df",
+  )
+
+class DeltaTableMaintenance:
+  '''Compact and Z-order the partitions of a streaming Delta table, and set how often its log is checkpointed
+
+  `OPTIMIZE ... ZORDER BY` needs Delta Lake 2.0 or later (AWS Glue 4.0). With older versions, the partitions
+  with at least `min_files` files are compacted by rewriting them with `dataChange = false`, sorted by the
+  Z-order columns, so that streaming readers of the table skip the rewrite.
+  '''
+
+  def __init__(self, spark, table, table_path, partition_key, interval_batches,
+      zorder_columns=None, min_files=10, checkpoint_interval=None):
+    self.spark = spark
+    self.table = table
+    self.table_path = table_path
+    self.partition_key = partition_key
+    self.interval_batches = interval_batches
+    self.zorder_columns = zorder_columns or []
+    self.min_files = min_files
+    self.checkpoint_interval = checkpoint_interval
+    self._is_configured = False
+    self._optimize_supported = True
+    #XXX: None means all partitions, e.g. when the job cannot see what each micro-batch wrote.
+    self._pending_partition_values = None
+
+  def isDue(self, batch_id) -> bool:
+    return self.interval_batches > 0 and batch_id > 0 and batch_id % self.interval_batches == 0
+
+  def configure(self):
+    if self._is_configured or not self.checkpoint_interval:
+      return
+    properties = {row['key']: row['value'] for row in self.spark.sql(f"SHOW TBLPROPERTIES {self.table}").collect()}
+    if properties.get('delta.checkpointInterval') != str(self.checkpoint_interval):
+      self.spark.sql(f"ALTER TABLE {self.table} SET TBLPROPERTIES ('delta.checkpointInterval' = '{self.checkpoint_interval}')")
+    self._is_configured = True
+
+  def addWrittenPartitions(self, data_frame):
+    '''Remember the partitions a micro-batch wrote to, so that only those are optimized'''
+    if self.interval_batches <= 0:
+      return
+    values = [row[0] for row in data_frame.select(self.partition_key).distinct().collect()]
+    self._pending_partition_values = (self._pending_partition_values or set()) | set(values)
+
+  def _partitionFilter(self, values):
+    partition_column = col(self.partition_key)
+    partition_filter = partition_column.isin([v for v in values if v is not None])
+    return partition_filter | partition_column.isNull() if None in values else partition_filter
+
+  @staticmethod
+  def _literal(value) -> str:
+    if isinstance(value, str):
+      return "'{}'".format(value.replace('\\', '\\\\').replace("'", "\\'"))
+    return str(value)
+
+  def _partitionPredicate(self, values) -> str:
+    predicates = [f"{self.partition_key} = {self._literal(v)}" for v in sorted([v for v in values if v is not None])]
+    predicates += [f"{self.partition_key} IS NULL"] if None in values else []
+    return ' OR '.join(predicates)
+
+  def _optimize(self, values):
+    where = f" WHERE {self._partitionPredicate(values)}" if values is not None else ''
+    zorder_by = f" ZORDER BY ({', '.join(self.zorder_columns)})" if self.zorder_columns else ''
+    rows = self.spark.sql(f"OPTIMIZE {self.table}{where}{zorder_by}").collect()
+    return {'optimize': rows[0].asDict(recursive=True)['metrics'] if rows else {}}
+
+  def _compact(self, values):
+    table_df = self.spark.read.format('delta').load(self.table_path)
+    if values is not None:
+      table_df = table_df.filter(self._partitionFilter(values))
+    file_counts = table_df.select(self.partition_key, input_file_name().alias('_file')).distinct() \
+      .groupBy(self.partition_key).count() \
+      .collect()
+    compact_values = set([row[0] for row in file_counts if row['count'] >= self.min_files])
+    if not compact_values:
+      return {'compacted_partitions': 0}
+
+    #XXX: One file per partition, since the rewrite only covers the partitions of a streaming table that have piled up small files.
+    compacted_df = table_df.filter(self._partitionFilter(compact_values)).repartition(self.partition_key)
+    if self.zorder_columns:
+      compacted_df = compacted_df.sortWithinPartitions(*self.zorder_columns)
+    compacted_df.write.format('delta') \
+      .mode('overwrite') \
+      .option('dataChange', 'false') \
+      .option('replaceWhere', self._partitionPredicate(compact_values)) \
+      .save(self.table_path)
+    return {'compacted_partitions': len(compact_values)}
+
+  def run(self):
+    start_time = time.monotonic()
+    values = self._pending_partition_values
+    report = {
+      'event': 'delta_table_maintenance',
+      'table': self.table,
+      'partitions': len(values) if values is not None else 'all'
+    }
+    try:
+      if values is not None and not values:
+        report['skipped'] = 'no partitions written since the last run'
+      else:
+        if self._optimize_supported:
+          try:
+            report.update(self._optimize(values))
+          except ParseException:
+            #XXX: OPTIMIZE is not in the SQL grammar of Delta Lake 1.0 (AWS Glue 3.0).
+            self._optimize_supported = False
+        if not self._optimize_supported:
+          report.update(self._compact(values))
+        self._pending_partition_values = None if values is None else set()
+    except Exception as ex:
+      #XXX: A failed maintenance run should not stop the stream; its partitions are tried again on the next run.
+      traceback.print_exc()
+      report['error'] = str(ex)
+    report['elapsed_sec'] = time.monotonic() - start_time
+    print(json.dumps(report, default=str))
+
+table_maintenance = DeltaTableMaintenance(spark, f"{CATALOG}.{DATABASE}.{TABLE_NAME}", DELTA_S3_PATH, PARTITION_KEY, OPTIMIZE_INTERVAL_BATCHES,
+  zorder_columns=OPTIMIZE_ZORDER_COLUMNS,
+  min_files=int(args['optimize_min_files']),
+  checkpoint_interval=DELTA_CHECKPOINT_INTERVAL)
+
+class DeltaIdempotentWriter:
+  '''Skip the micro-batches a restarted job replays, by the batch ids in the commits of the table
+
+  When a job stops after a micro-batch has committed to the table but before the checkpoint has, `forEachBatch`
+  runs that micro-batch again on restart. Each write records the writer id and the batch id in the `userMetadata`
+  of its commit, and with Delta Lake 2.0 or later (AWS Glue 4.0) also as the `txnAppId` and `txnVersion` of its
+  transaction, so that Delta Lake itself ignores a write of a batch it has already committed. A micro-batch is
+  skipped when a commit of the same writer already has its batch id or a later one. The writer id is the checkpoint
+  location, because a new checkpoint numbers its micro-batches from 0 again.
+  The history is only looked up on the first micro-batch of a job run, and only its latest `history_limit` commits.
+  '''
+
+  def __init__(self, spark, table_path, writer_id, history_limit=100):
+    self.spark = spark
+    self.table_path = table_path
+    self.writer_id = writer_id
+    self.history_limit = history_limit
+    self.last_batch_id = None
+    self._is_loaded = False
+
+  def _load(self):
+    user_metadata = col('userMetadata')
+    rows = self.spark.sql(f"DESCRIBE HISTORY delta.`{self.table_path}` LIMIT {self.history_limit}") \
+      .filter(get_json_object(user_metadata, '$.writer_id') == self.writer_id) \
+      .select(get_json_object(user_metadata, '$.batch_id').cast('bigint').alias('batch_id')) \
+      .agg(expr('max(batch_id) AS batch_id')) \
+      .collect()
+    self.last_batch_id = rows[0]['batch_id']
+    self._is_loaded = True
+
+  def isCommitted(self, batch_id) -> bool:
+    if not self._is_loaded:
+      self._load()
+    return self.last_batch_id is not None and batch_id <= self.last_batch_id
+
+  def writer(self, data_frame, batch_id):
+    '''A DataFrameWriter of the table, which records `batch_id` in the commit it makes'''
+    return data_frame.write.format('delta') \
+      .option('txnAppId', self.writer_id) \
+      .option('txnVersion', batch_id) \
+      .option('userMetadata', json.dumps({'writer_id': self.writer_id, 'batch_id': batch_id}))
+
+  def markCommitted(self, batch_id):
+    self.last_batch_id = batch_id if self.last_batch_id is None else max(self.last_batch_id, batch_id)
+
+  def reportSkipped(self, batch_id):
+    print(json.dumps({
+      'event': 'idempotent_batch_skipped',
+      'table': self.table_path,
+      'writer_id': self.writer_id,
+      'batch_id': batch_id,
+      'last_committed_batch_id': self.last_batch_id
+    }))
 
 def processBatch(data_frame, batch_id):
 
@@ -92,8 +307,11 @@ LOCATION '{DELTA_S3_PATH}'
 '''
 
   spark.sql(CREATE_DELTA_TABLE_SQL)
+  table_maintenance.configure()
 
-  if data_frame.count() > 0:
+  if IDEMPOTENT_WRITES and idempotent_writer.isCommitted(batch_id):
+    idempotent_writer.reportSkipped(batch_id)
+  elif not isEmptyDataFrame(data_frame):
     stream_data_dynf = DynamicFrame.fromDF(
       data_frame, glueContext, "from_data_frame"
     )
@@ -101,13 +319,17 @@ LOCATION '{DELTA_S3_PATH}'
     _df = spark.sql(f"SELECT * FROM {CATALOG}.{DATABASE}.{TABLE_NAME} LIMIT 0")
 
     # Apply De-duplication logic on input data to pick up the latest record based on timestamp and operation
-    window = Window.partitionBy(PRIMARY_KEY).orderBy(desc("updated_at"))
     stream_data_df = stream_data_dynf.toDF()
     stream_data_df = stream_data_df.withColumn('updated_at', to_timestamp(col('updated_at'), 'yyyy-MM-dd HH:mm:ss'))
-    upsert_data_df = stream_data_df.withColumn("row", row_number().over(window)) \
-      .filter(col("row") == 1).drop("row") \
-      .select(_df.schema.names)
+    upsert_data_df = dedupLatest(stream_data_df, PRIMARY_KEY, 'updated_at', _df.schema.names)
+
+    if OPTIMIZE_WRITE:
+      #XXX: Shuffle the rows by the partition column before writing them, so that
+      # each partition gets a few large files per micro-batch instead of one per task.
+      upsert_data_df = upsert_data_df.repartition(PARTITION_KEY)
 
+    #XXX: Persist the records, so that the overwrite and collecting the partitions it wrote read the micro-batch once.
+    upsert_data_df.persist()
     upsert_data_df.createOrReplaceTempView(f"{TABLE_NAME}_upsert")
     # print(f"Table '{TABLE_NAME}' is upserting...")
 
@@ -115,21 +337,52 @@ LOCATION '{DELTA_S3_PATH}'
     INSERT OVERWRITE {CATALOG}.{DATABASE}.{TABLE_NAME} SELECT * FROM {TABLE_NAME}_upsert
     """
     try:
-      spark.sql(sql_query)
+      if IDEMPOTENT_WRITES:
+        #XXX: The same overwrite of the whole table as the INSERT OVERWRITE statement, with the batch id in its commit.
+        idempotent_writer.writer(upsert_data_df, batch_id).mode('overwrite').save(DELTA_S3_PATH)
+        idempotent_writer.markCommitted(batch_id)
+      else:
+        spark.sql(sql_query)
+      table_maintenance.addWrittenPartitions(upsert_data_df)
     except Exception as ex:
       traceback.print_exc()
       raise ex
+    finally:
+      upsert_data_df.unpersist()
 
+  #XXX: Run the table maintenance between micro-batches, so that it never conflicts with the writes of this job.
+  if table_maintenance.isDue(batch_id):
+    table_maintenance.run()
 
-checkpointPath = os.path.join(args["TempDir"], args["JOB_NAME"], "checkpoint/")
 
-glueContext.forEachBatch(
-  frame=kds_df,
-  batch_function=processBatch,
-  options={
-    "windowSize": WINDOW_SIZE,
-    "checkpointLocation": checkpointPath,
-  }
-)
+#XXX: e.g., a checkpoint written by the checkpoint tool, to restart the job from other offsets
+checkpointPath = args['checkpoint_location'] or os.path.join(args["TempDir"], args["JOB_NAME"], "checkpoint/")
+
+#XXX: The checkpoint location tells the commits of this job from those of other jobs, and of its earlier checkpoints.
+idempotent_writer = DeltaIdempotentWriter(spark, DELTA_S3_PATH, checkpointPath)
+
+#XXX: The checkpoint keeps the offsets and commits of the last `checkpoint_min_batches_to_retain` micro-batches
+# (Spark default: 100); fewer of them make the checkpoint smaller and faster to list when the job restarts.
+if args['checkpoint_min_batches_to_retain']:
+  spark.conf.set("spark.sql.streaming.minBatchesToRetain", args['checkpoint_min_batches_to_retain'])
+
+if ADAPTIVE_WINDOW:
+  controller = AdaptiveWindowController(parseWindowSizeSec(WINDOW_SIZE),
+    int(args['adaptive_min_window_sec']),
+    int(args['adaptive_max_window_sec']),
+    int(args['adaptive_min_records_per_trigger']),
+    int(args['adaptive_max_records_per_trigger']),
+    target_utilization=float(args['adaptive_target_utilization']),
+    min_batch_rows=int(args['adaptive_min_batch_rows']))
+  runAdaptiveForEachBatch(createSourceDataFrame, processBatch, checkpointPath, controller)
+else:
+  glueContext.forEachBatch(
+    frame=createSourceDataFrame(),
+    batch_function=processBatch,
+    options={
+      "windowSize": WINDOW_SIZE,
+      "checkpointLocation": checkpointPath,
+    }
+  )
 
 job.commit()
@@ -2,8 +2,11 @@
 # -*- encoding: utf-8 -*-
 # vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
 
+import json
 import os
 import sys
+import threading
+import time
 import traceback
 
 from awsglue.transforms import *
@@ -15,14 +18,25 @@ from awsglue import DynamicFrame
 from pyspark.context import SparkContext
 from pyspark.conf import SparkConf
 from pyspark.sql import DataFrame, Row
-from pyspark.sql.window import Window
+from pyspark.sql.utils import ParseException
+from pyspark.sql.types import StructType
 from pyspark.sql.functions import (
+  broadcast,
+  coalesce,
   col,
-  desc,
-  row_number,
+  count,
+  input_file_name,
+  lit,
   to_timestamp
 )
 
+from streaming_batch_helpers import (
+  isEmptyDataFrame,
+  dedupLatest,
+  getOptionalResolvedOptions
+)
+from adaptive_window import AdaptiveWindowController, parseWindowSizeSec, runAdaptiveForEachBatch
+
 
 args = getResolvedOptions(sys.argv, ['JOB_NAME',
   'catalog',
@@ -37,6 +51,26 @@ args = getResolvedOptions(sys.argv, ['JOB_NAME',
   'window_size'
 ])
 
+args.update(getOptionalResolvedOptions(sys.argv, {
+  'adaptive_window': 'false',
+  'adaptive_min_window_sec': '30',
+  'adaptive_max_window_sec': '300',
+  'adaptive_min_records_per_trigger': '10000',
+  'adaptive_max_records_per_trigger': '1000000',
+  'adaptive_target_utilization': '0.8',
+  'adaptive_min_batch_rows': '1000',
+  'optimize_write': 'false',
+  'optimize_interval_batches': '0',
+  'optimize_zorder_columns': '',
+  'optimize_min_files': '10',
+  'delta_checkpoint_interval': '',
+  'checkpoint_min_batches_to_retain': '',
+  'checkpoint_location': '',
+  'enrichment_path': '',
+  'enrichment_ttl_sec': '3600',
+  'enrichment_max_rows': '1000000'
+}))
+
 CATALOG = args['catalog']
 DELTA_S3_PATH = args['delta_s3_path']
 DATABASE = args['database_name']
@@ -49,6 +83,17 @@ KINESIS_STREAM_ARN = args['kinesis_stream_arn']
 STARTING_POSITION_OF_KINESIS_ITERATOR = args.get('starting_position_of_kinesis_iterator', 'LATEST')
 AWS_REGION = args['aws_region']
 WINDOW_SIZE = args.get('window_size', '100 seconds')
+ADAPTIVE_WINDOW = args['adaptive_window'].lower() == 'true'
+OPTIMIZE_WRITE = args['optimize_write'].lower() == 'true'
+OPTIMIZE_INTERVAL_BATCHES = int(args['optimize_interval_batches'])
+#XXX: Frequently filtered columns; the partition column cannot be Z-ordered.
+OPTIMIZE_ZORDER_COLUMNS = [c.strip() for c in args['optimize_zorder_columns'].split(',') if c.strip()]
+if PARTITION_KEY in OPTIMIZE_ZORDER_COLUMNS:
+  raise ValueError(f"optimize_zorder_columns cannot include the partition column '{PARTITION_KEY}'")
+#XXX: e.g., '10'; the number of commits between two checkpoints of the Delta log
+DELTA_CHECKPOINT_INTERVAL = args['delta_checkpoint_interval']
+#XXX: e.g., 's3://bucket/conf/enrichment.json'; the dimension tables to enrich the records with before merging them
+ENRICHMENT_PATH = args['enrichment_path']
 
 def setSparkDeltalakeConf() -> SparkConf:
   conf_list = [
@@ -66,17 +111,262 @@ spark = glueContext.spark_session
 job = Job(glueContext)
 job.init(args['JOB_NAME'], args)
 
-kds_df = glueContext.create_data_frame.from_options(
-  connection_type="kinesis",
-  connection_options={
-    "typeOfData": "kinesis",
-    "streamARN": KINESIS_STREAM_ARN,
-    "classification": "json",
-    "startingPosition": f"{STARTING_POSITION_OF_KINESIS_ITERATOR}",
-    "inferSchema": "true",
-  },
-  transformation_ctx="kds_df",
-)
+if OPTIMIZE_WRITE:
+  #XXX: Shuffle the rows of MERGE by the partition columns before writing them, so that
+  # each partition gets a few large files per micro-batch instead of one per task.
+  spark.conf.set("spark.databricks.delta.merge.repartitionBeforeWrite.enabled", "true")
+
+kds_options = {
+  "typeOfData": "kinesis",
+  "streamARN": KINESIS_STREAM_ARN,
+  "classification": "json",
+  "startingPosition": f"{STARTING_POSITION_OF_KINESIS_ITERATOR}",
+  "inferSchema": "true",
+}
+
+def createSourceDataFrame(max_records_per_trigger=None):
+  connection_options = {**kds_options, "maxFetchRecordsPerShard": str(max_records_per_trigger)} \
+    if max_records_per_trigger else kds_options
+  return glueContext.create_data_frame.from_options(
+    connection_type="kinesis",
+    connection_options=connection_options,
+    transformation_ctx="kds_df",
+  )
+
+class DeltaTableMaintenance:
+  '''Compact and Z-order the partitions of a streaming Delta table, and set how often its log is checkpointed
+
+  `OPTIMIZE ... ZORDER BY` needs Delta Lake 2.0 or later (AWS Glue 4.0). With older versions, the partitions
+  with at least `min_files` files are compacted by rewriting them with `dataChange = false`, sorted by the
+  Z-order columns, so that streaming readers of the table skip the rewrite.
+  '''
+
+  def __init__(self, spark, table, table_path, partition_key, interval_batches,
+      zorder_columns=None, min_files=10, checkpoint_interval=None):
+    self.spark = spark
+    self.table = table
+    self.table_path = table_path
+    self.partition_key = partition_key
+    self.interval_batches = interval_batches
+    self.zorder_columns = zorder_columns or []
+    self.min_files = min_files
+    self.checkpoint_interval = checkpoint_interval
+    self._is_configured = False
+    self._optimize_supported = True
+    #XXX: None means all partitions, e.g. when the job cannot see what each micro-batch wrote.
+    self._pending_partition_values = None
+
+  def isDue(self, batch_id) -> bool:
+    return self.interval_batches > 0 and batch_id > 0 and batch_id % self.interval_batches == 0
+
+  def configure(self):
+    if self._is_configured or not self.checkpoint_interval:
+      return
+    properties = {row['key']: row['value'] for row in self.spark.sql(f"SHOW TBLPROPERTIES {self.table}").collect()}
+    if properties.get('delta.checkpointInterval') != str(self.checkpoint_interval):
+      self.spark.sql(f"ALTER TABLE {self.table} SET TBLPROPERTIES ('delta.checkpointInterval' = '{self.checkpoint_interval}')")
+    self._is_configured = True
+
+  def addWrittenPartitions(self, data_frame):
+    '''Remember the partitions a micro-batch wrote to, so that only those are optimized'''
+    if self.interval_batches <= 0:
+      return
+    values = [row[0] for row in data_frame.select(self.partition_key).distinct().collect()]
+    self._pending_partition_values = (self._pending_partition_values or set()) | set(values)
+
+  def _partitionFilter(self, values):
+    partition_column = col(self.partition_key)
+    partition_filter = partition_column.isin([v for v in values if v is not None])
+    return partition_filter | partition_column.isNull() if None in values else partition_filter
+
+  @staticmethod
+  def _literal(value) -> str:
+    if isinstance(value, str):
+      return "'{}'".format(value.replace('\\', '\\\\').replace("'", "\\'"))
+    return str(value)
+
+  def _partitionPredicate(self, values) -> str:
+    predicates = [f"{self.partition_key} = {self._literal(v)}" for v in sorted([v for v in values if v is not None])]
+    predicates += [f"{self.partition_key} IS NULL"] if None in values else []
+    return ' OR '.join(predicates)
+
+  def _optimize(self, values):
+    where = f" WHERE {self._partitionPredicate(values)}" if values is not None else ''
+    zorder_by = f" ZORDER BY ({', '.join(self.zorder_columns)})" if self.zorder_columns else ''
+    rows = self.spark.sql(f"OPTIMIZE {self.table}{where}{zorder_by}").collect()
+    return {'optimize': rows[0].asDict(recursive=True)['metrics'] if rows else {}}
+
+  def _compact(self, values):
+    table_df = self.spark.read.format('delta').load(self.table_path)
+    if values is not None:
+      table_df = table_df.filter(self._partitionFilter(values))
+    file_counts = table_df.select(self.partition_key, input_file_name().alias('_file')).distinct() \
+      .groupBy(self.partition_key).count() \
+      .collect()
+    compact_values = set([row[0] for row in file_counts if row['count'] >= self.min_files])
+    if not compact_values:
+      return {'compacted_partitions': 0}
+
+    #XXX: One file per partition, since the rewrite only covers the partitions of a streaming table that have piled up small files.
+    compacted_df = table_df.filter(self._partitionFilter(compact_values)).repartition(self.partition_key)
+    if self.zorder_columns:
+      compacted_df = compacted_df.sortWithinPartitions(*self.zorder_columns)
+    compacted_df.write.format('delta') \
+      .mode('overwrite') \
+      .option('dataChange', 'false') \
+      .option('replaceWhere', self._partitionPredicate(compact_values)) \
+      .save(self.table_path)
+    return {'compacted_partitions': len(compact_values)}
+
+  def run(self):
+    start_time = time.monotonic()
+    values = self._pending_partition_values
+    report = {
+      'event': 'delta_table_maintenance',
+      'table': self.table,
+      'partitions': len(values) if values is not None else 'all'
+    }
+    try:
+      if values is not None and not values:
+        report['skipped'] = 'no partitions written since the last run'
+      else:
+        if self._optimize_supported:
+          try:
+            report.update(self._optimize(values))
+          except ParseException:
+            #XXX: OPTIMIZE is not in the SQL grammar of Delta Lake 1.0 (AWS Glue 3.0).
+            self._optimize_supported = False
+        if not self._optimize_supported:
+          report.update(self._compact(values))
+        self._pending_partition_values = None if values is None else set()
+    except Exception as ex:
+      #XXX: A failed maintenance run should not stop the stream; its partitions are tried again on the next run.
+      traceback.print_exc()
+      report['error'] = str(ex)
+    report['elapsed_sec'] = time.monotonic() - start_time
+    print(json.dumps(report, default=str))
+
+class DimensionEnrichment:
+  '''Add the columns of small dimension tables to the records of a micro-batch, e.g. the price of a `product_id`
+
+  Each dimension table is read once, cached on the executors and reloaded at most once every `ttl_sec` seconds.
+  It is joined with a broadcast hint, so that the records of a micro-batch are joined where they are instead of
+  being shuffled; only the cached dimension rows are sent to the executors. A dimension table that fails to reload
+  is used as it was cached until the next try, so that the stream keeps running.
+  '''
+
+  def __init__(self, spark, dimensions: list, ttl_sec, max_rows):
+    self.spark = spark
+    #XXX: e.g. [{"table": "spark_catalog.deltalake_db.product_prices", "join_key": "product_id", "columns": ["price"]}]
+    self.dimensions = dimensions
+    self.ttl_sec = ttl_sec
+    self.max_rows = max_rows
+    self.columns = set([c for e in dimensions for c in e['columns']])
+    self.marker_columns = [f"_dim_{i}_matched" for i in range(len(dimensions))]
+    self._cache = {}
+    self._lock = threading.Lock()
+
+  def _load(self, index, dimension):
+    start_time = time.monotonic()
+    dimension_key = dimension.get('dimension_key', dimension['join_key'])
+    #XXX: Keep one row per key, so that the join never multiplies the records of a micro-batch.
+    dimension_df = self.spark.table(dimension['table']) \
+      .select(col(dimension_key).alias(f"_dim_{index}_key"), *[col(c).alias(f"_dim_{index}_{c}") for c in dimension['columns']]) \
+      .dropDuplicates([f"_dim_{index}_key"]) \
+      .withColumn(f"_dim_{index}_matched", lit(True)) \
+      .persist()
+    rows = dimension_df.count()
+    if rows > self.max_rows:
+      dimension_df.unpersist()
+      raise ValueError(f"{dimension['table']} has {rows} rows, more than --enrichment_max_rows {self.max_rows} to broadcast")
+    print(json.dumps({
+      'event': 'dimension_table_refresh',
+      'table': dimension['table'],
+      'rows': rows,
+      'elapsed_sec': time.monotonic() - start_time
+    }))
+    return {'data_frame': dimension_df, 'rows': rows, 'loaded_at': time.monotonic()}
+
+  def refresh(self):
+    with self._lock:
+      for index, dimension in enumerate(self.dimensions):
+        cached = self._cache.get(index)
+        if cached is not None and (time.monotonic() - cached['loaded_at']) < self.ttl_sec:
+          continue
+        try:
+          self._cache[index] = self._load(index, dimension)
+        except Exception:
+          if cached is None:
+            raise
+          traceback.print_exc()
+          #XXX: Try again after another TTL instead of on every micro-batch.
+          cached['loaded_at'] = time.monotonic()
+          continue
+        if cached is not None:
+          cached['data_frame'].unpersist()
+
+  def enrich(self, data_frame, target_schema: StructType):
+    '''Left-join the dimension tables whose join key is a column of `data_frame`, replacing or adding
+    their columns that are in `target_schema`, cast to its types, and a `_dim_<i>_matched` column per dimension
+
+    A record whose key has no row in a dimension table keeps its own values of the dimension columns, if it has them.
+    '''
+    self.refresh()
+    enriched_df = data_frame
+    for index, dimension in enumerate(self.dimensions):
+      columns = [c for c in dimension['columns'] if c in target_schema.names]
+      if not columns or dimension['join_key'] not in enriched_df.columns:
+        continue
+      dimension_df = self._cache[index]['data_frame'].select(f"_dim_{index}_key", *[f"_dim_{index}_{c}" for c in columns], f"_dim_{index}_matched")
+      joined_df = enriched_df.join(broadcast(dimension_df), col(dimension['join_key']) == col(f"_dim_{index}_key"), 'left')
+      dimension_columns = []
+      for c in columns:
+        dimension_column = col(f"_dim_{index}_{c}").cast(target_schema[c].dataType)
+        #XXX: Without a match, the dimension value is NULL, and it would overwrite the value of the table in the MERGE.
+        if c in enriched_df.columns:
+          dimension_column = coalesce(dimension_column, col(c).cast(target_schema[c].dataType))
+        dimension_columns.append(dimension_column.alias(c))
+      enriched_df = joined_df.select(*[c for c in enriched_df.columns if c not in columns], *dimension_columns, f"_dim_{index}_matched")
+    return enriched_df
+
+  def report(self, batch_id, table, enriched_df):
+    '''Log the records of a micro-batch that found a row in each dimension table'''
+    start_time = time.monotonic()
+    markers = [(index, f"_dim_{index}_matched") for index in range(len(self.dimensions)) if f"_dim_{index}_matched" in enriched_df.columns]
+    counts = enriched_df.agg(count(lit(1)).alias('rows'), *[count(col(c)).alias(c) for _, c in markers]).collect()[0]
+    print(json.dumps({
+      'event': 'dimension_enrichment',
+      'batch_id': batch_id,
+      'table': table,
+      'rows': counts['rows'],
+      'dimensions': [{
+        'table': self.dimensions[index]['table'],
+        'join_key': self.dimensions[index]['join_key'],
+        'cached_rows': self._cache[index]['rows'],
+        'cache_age_sec': time.monotonic() - self._cache[index]['loaded_at'],
+        'matched_rows': counts[c],
+        'unmatched_rows': counts['rows'] - counts[c]
+      } for index, c in markers],
+      'elapsed_sec': time.monotonic() - start_time
+    }))
+
+def loadDimensionEnrichment(enrichment_path):
+  '''Read the dimension tables from the enrichment file, e.g.
+  {"dimensions": [{"table": "spark_catalog.deltalake_db.product_prices", "join_key": "product_id",
+    "dimension_key": "product_id", "columns": ["price"]}]}
+  '''
+  #XXX: wholeTextFiles reads a single JSON document from Amazon S3 or a local path alike.
+  enrichment = json.loads(spark.sparkContext.wholeTextFiles(enrichment_path).collect()[0][1])
+  return DimensionEnrichment(spark, enrichment['dimensions'],
+    ttl_sec=int(args['enrichment_ttl_sec']),
+    max_rows=int(args['enrichment_max_rows']))
+
+dimension_enrichment = loadDimensionEnrichment(ENRICHMENT_PATH) if ENRICHMENT_PATH else None
+
+table_maintenance = DeltaTableMaintenance(spark, f"{CATALOG}.{DATABASE}.{TABLE_NAME}", DELTA_S3_PATH, PARTITION_KEY, OPTIMIZE_INTERVAL_BATCHES,
+  zorder_columns=OPTIMIZE_ZORDER_COLUMNS,
+  min_files=int(args['optimize_min_files']),
+  checkpoint_interval=DELTA_CHECKPOINT_INTERVAL)
 
 def processBatch(data_frame, batch_id):
 
@@ -92,8 +382,9 @@ LOCATION '{DELTA_S3_PATH}'
 '''
 
   spark.sql(CREATE_DELTA_TABLE_SQL)
+  table_maintenance.configure()
 
-  if data_frame.count() > 0:
+  if not isEmptyDataFrame(data_frame):
     stream_data_dynf = DynamicFrame.fromDF(
       data_frame, glueContext, "from_data_frame"
     )
@@ -106,14 +397,22 @@ LOCATION '{DELTA_S3_PATH}'
       _df = spark.sql(f"SELECT * FROM {CATALOG}.{DATABASE}.{TABLE_NAME} LIMIT 0")
 
       # Apply De-duplication logic on input data to pick up the latest record based on timestamp and operation
-      window = Window.partitionBy(PRIMARY_KEY).orderBy(desc("updated_at"))
       stream_data_df = stream_data_dynf.toDF()
       stream_data_df = stream_data_df.withColumn('updated_at', to_timestamp(col('updated_at'), 'yyyy-MM-dd HH:mm:ss'))
-      upsert_data_df = stream_data_df.withColumn("row", row_number().over(window)) \
-        .filter(col("row") == 1).drop("row") \
-        .select(_df.schema.names)
+      if dimension_enrichment is None:
+        upsert_data_df = dedupLatest(stream_data_df, PRIMARY_KEY, 'updated_at', _df.schema.names)
+      else:
+        #XXX: The records do not need to carry the columns that the dimension tables add.
+        record_columns = [c for c in _df.schema.names if c in stream_data_df.columns or c not in dimension_enrichment.columns]
+        upsert_data_df = dimension_enrichment.enrich(dedupLatest(stream_data_df, PRIMARY_KEY, 'updated_at', record_columns), _df.schema)
+      #XXX: Persist the records, so that counting the matches, the MERGE and collecting the partitions
+      # it wrote read the micro-batch once.
+      upsert_data_df.persist()
+      if dimension_enrichment is not None:
+        dimension_enrichment.report(batch_id, f"{CATALOG}.{DATABASE}.{TABLE_NAME}", upsert_data_df)
 
-      upsert_data_df.createOrReplaceTempView(f"{TABLE_NAME}_upsert")
+      upsert_data_df.drop(*(dimension_enrichment.marker_columns if dimension_enrichment else [])) \
+        .createOrReplaceTempView(f"{TABLE_NAME}_upsert")
       # print(f"Table '{TABLE_NAME}' is upserting...")
 
       try:
@@ -123,19 +422,42 @@ LOCATION '{DELTA_S3_PATH}'
           WHEN MATCHED THEN UPDATE SET *
           WHEN NOT MATCHED THEN INSERT *
           """)
+        table_maintenance.addWrittenPartitions(upsert_data_df)
       except Exception as ex:
         traceback.print_exc()
         raise ex
+      finally:
+        upsert_data_df.unpersist()
 
-checkpointPath = os.path.join(args["TempDir"], args["JOB_NAME"], "checkpoint/")
+  #XXX: Run the table maintenance between micro-batches, so that it never conflicts with the writes of this job.
+  if table_maintenance.isDue(batch_id):
+    table_maintenance.run()
 
-glueContext.forEachBatch(
-  frame=kds_df,
-  batch_function=processBatch,
-  options={
-    "windowSize": WINDOW_SIZE,
-    "checkpointLocation": checkpointPath,
-  }
-)
+#XXX: e.g., a checkpoint written by the checkpoint tool, to restart the job from other offsets
+checkpointPath = args['checkpoint_location'] or os.path.join(args["TempDir"], args["JOB_NAME"], "checkpoint/")
+
+#XXX: The checkpoint keeps the offsets and commits of the last `checkpoint_min_batches_to_retain` micro-batches
+# (Spark default: 100); fewer of them make the checkpoint smaller and faster to list when the job restarts.
+if args['checkpoint_min_batches_to_retain']:
+  spark.conf.set("spark.sql.streaming.minBatchesToRetain", args['checkpoint_min_batches_to_retain'])
+
+if ADAPTIVE_WINDOW:
+  controller = AdaptiveWindowController(parseWindowSizeSec(WINDOW_SIZE),
+    int(args['adaptive_min_window_sec']),
+    int(args['adaptive_max_window_sec']),
+    int(args['adaptive_min_records_per_trigger']),
+    int(args['adaptive_max_records_per_trigger']),
+    target_utilization=float(args['adaptive_target_utilization']),
+    min_batch_rows=int(args['adaptive_min_batch_rows']))
+  runAdaptiveForEachBatch(createSourceDataFrame, processBatch, checkpointPath, controller)
+else:
+  glueContext.forEachBatch(
+    frame=createSourceDataFrame(),
+    batch_function=processBatch,
+    options={
+      "windowSize": WINDOW_SIZE,
+      "checkpointLocation": checkpointPath,
+    }
+  )
 
 job.commit()
@@ -2,19 +2,23 @@
 # -*- encoding: utf-8 -*-
 # vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
 
+import hashlib
 import sys
 from awsglue.transforms import *
 from awsglue.utils import getResolvedOptions
 from pyspark.context import SparkContext
 from awsglue.context import GlueContext
 from awsglue.job import Job
-from awsglue import DynamicFrame
 
 from pyspark.sql.session import SparkSession
 from pyspark.sql import DataFrame, Row
+from pyspark.sql.utils import AnalysisException
 from pyspark.sql.functions import * 
 from pyspark.sql.functions import col, to_timestamp, monotonically_increasing_id, to_date, when
 
+from streaming_batch_helpers import isEmptyDataFrame, getOptionalResolvedOptions
+from adaptive_window import AdaptiveWindowController, parseWindowSizeSec, runAdaptiveForEachBatch
+
 
 ## @params: [JOB_NAME]
 args = getResolvedOptions(sys.argv, ["JOB_NAME",
@@ -26,6 +30,27 @@ args = getResolvedOptions(sys.argv, ["JOB_NAME",
   "s3_path_hudi",
   "spark_checkpoint_s3_path"])
 
+args.update(getOptionalResolvedOptions(sys.argv, {
+  'adaptive_window': 'false',
+  'adaptive_min_window_sec': '30',
+  'adaptive_max_window_sec': '300',
+  'adaptive_min_records_per_trigger': '10000',
+  'adaptive_max_records_per_trigger': '1000000',
+  'adaptive_target_utilization': '0.8',
+  'adaptive_min_batch_rows': '1000',
+  'schema_mode': 'infer',
+  'hudi_table_type': 'COPY_ON_WRITE',
+  'compaction_mode': 'inline',
+  'compaction_delta_commits': '5',
+  'clustering_mode': 'none',
+  'clustering_interval_commits': '4',
+  'clustering_small_file_limit_bytes': '314572800',
+  'clustering_target_file_max_bytes': '1073741824',
+  'metadata_table': 'true',
+  'hive_sync_interval_commits': '1',
+  'checkpoint_min_batches_to_retain': ''
+}))
+
 spark = SparkSession.builder.config('spark.serializer', 'org.apache.spark.serializer.KryoSerializer').config('spark.sql.hive.convertMetastoreParquet', 'false').getOrCreate()
 
 sc = spark.sparkContext
@@ -40,18 +65,44 @@ hudi_table_name = args["hudi_table_name"]
 s3_path_hudi = args["s3_path_hudi"]
 s3_path_to_checkpoint = args["spark_checkpoint_s3_path"]
 
+#XXX: The checkpoint keeps the offsets and commits of the last `checkpoint_min_batches_to_retain` micro-batches
+# (Spark default: 100); fewer of them make the checkpoint smaller and faster to list when the job restarts.
+if args['checkpoint_min_batches_to_retain']:
+  spark.conf.set("spark.sql.streaming.minBatchesToRetain", args['checkpoint_min_batches_to_retain'])
+
 # can be set to "LATEST", "TRIM_HORIZON" or "EARLIEST"
 starting_position_of_kinesis_iterator = args["starting_position_of_kinesis_iterator"]
 
 # The amount of time to spend processing each batch
 window_size = args["window_size"]
 
-data_frame_DataSource0 = glueContext.create_data_frame.from_catalog(
-  database = database_name,
-  table_name = kinesis_table_name,
-  transformation_ctx = "DataSource0",
-  additional_options = {"inferSchema":"true", "startingPosition": starting_position_of_kinesis_iterator}
-)
+adaptive_window = args['adaptive_window'].lower() == 'true'
+#XXX: schema_mode: ['infer', 'explicit']
+# 'explicit' parses the records against the columns of the Data Catalog table instead of inferring a schema on every micro-batch.
+schema_mode = args['schema_mode']
+
+#XXX: hudi_table_type: ['COPY_ON_WRITE', 'MERGE_ON_READ']; the type of an existing table cannot be changed.
+hudi_table_type = args['hudi_table_type']
+#XXX: compaction_mode: ['inline', 'async']; 'async' only plans the compactions of MERGE_ON_READ tables,
+# which a separate compaction job runs (Hudi 0.11 or later, i.e. AWS Glue 4.0).
+compaction_mode = args['compaction_mode']
+compaction_delta_commits = int(args['compaction_delta_commits'])
+#XXX: clustering_mode: ['none', 'inline', 'async']; 'async' only plans the clusterings, like 'async' compaction.
+clustering_mode = args['clustering_mode']
+clustering_interval_commits = int(args['clustering_interval_commits'])
+metadata_table = args['metadata_table'].lower() == 'true'
+hive_sync_interval_commits = int(args['hive_sync_interval_commits'])
+
+def createSourceDataFrame(max_records_per_trigger=None):
+  additional_options = {"inferSchema": "false" if schema_mode == 'explicit' else "true", "startingPosition": starting_position_of_kinesis_iterator}
+  if max_records_per_trigger:
+    additional_options["maxFetchRecordsPerShard"] = str(max_records_per_trigger)
+  return glueContext.create_data_frame.from_catalog(
+    database = database_name,
+    table_name = kinesis_table_name,
+    transformation_ctx = "DataSource0",
+    additional_options = additional_options
+  )
 
 # config
 commonConfig = {
@@ -62,7 +113,7 @@ hudiWriteConfig = {
   'className' : 'org.apache.hudi',
   'hoodie.table.name': hudi_table_name,
   'hoodie.datasource.write.operation': 'upsert',
-  'hoodie.datasource.write.table.type': 'COPY_ON_WRITE',
+  'hoodie.datasource.write.table.type': hudi_table_type,
   'hoodie.datasource.write.precombine.field': 'date',
   'hoodie.datasource.write.recordkey.field': 'name',
   'hoodie.datasource.write.partitionpath.field': 'name:SIMPLE,year:SIMPLE,month:SIMPLE,day:SIMPLE',
@@ -83,50 +134,153 @@ hudiGlueConfig = {
   'hoodie.datasource.hive_sync.partition_fields': 'name,year,month,day'
 }
 
+def buildHudiTableServicesConfig() -> dict:
+  '''The metadata table, compaction and clustering settings of the table'''
+  #XXX: The metadata table keeps the file listing of the table, so that writes do not list the partitions on S3.
+  config = {'hoodie.metadata.enable': 'true' if metadata_table else 'false'}
+  if hudi_table_type == 'MERGE_ON_READ':
+    config.update({
+      'hoodie.compact.inline': 'true' if compaction_mode == 'inline' else 'false',
+      'hoodie.compact.schedule.inline': 'true' if compaction_mode == 'async' else 'false',
+      'hoodie.compact.inline.max.delta.commits': str(compaction_delta_commits),
+      #XXX: Sync the read-optimized view under the table name, and the real-time view as `<table>_rt`.
+      'hoodie.datasource.hive_sync.skip_ro_suffix': 'true'
+    })
+  if clustering_mode != 'none':
+    config.update({
+      'hoodie.clustering.inline': 'true' if clustering_mode == 'inline' else 'false',
+      'hoodie.clustering.schedule.inline': 'true' if clustering_mode == 'async' else 'false',
+      'hoodie.clustering.inline.max.commits': str(clustering_interval_commits),
+      'hoodie.clustering.plan.strategy.small.file.limit': args['clustering_small_file_limit_bytes'],
+      'hoodie.clustering.plan.strategy.target.file.max.bytes': args['clustering_target_file_max_bytes']
+    })
+  return config
+
 combinedConf = {
   **commonConfig,
   **hudiWriteConfig,
-  **hudiGlueConfig
+  **hudiGlueConfig,
+  **buildHudiTableServicesConfig()
 }
 
-# ensure the incomong record has the correct current schema, new fresh columns are fine, if a column exists in current schema but not in incoming record then manually add before inserting
-def evolveSchema(kinesis_df, table, forcecast=False):
-  try:
-    #get existing table's schema
-    glue_catalog_df = spark.sql(f"SELECT * FROM {table} LIMIT 0")
-
-    #sanitize for hudi specific system columns
-    columns_to_drop = ['_hoodie_commit_time', '_hoodie_commit_seqno', '_hoodie_record_key', '_hoodie_partition_path', '_hoodie_file_name']
-    glue_catalog_df_sanitized = glue_catalog_df.drop(*columns_to_drop)
-    if (kinesis_df.schema != glue_catalog_df_sanitized.schema):
-      merged_df = kinesis_df.unionByName(glue_catalog_df_sanitized, allowMissingColumns=True)
-    return merged_df
-  except Exception as e:
-    print(e)
-    return kinesis_df
+class HudiSchemaRegistry:
+  '''Align the incoming records with the columns of the Hudi table, with the schemas cached between micro-batches
+
+  The table schema is read from the catalog once, and again only after a write has added columns to it.
+  The union with an incoming schema is computed once per distinct incoming schema, keyed by its fingerprint,
+  so a micro-batch whose schema was already seen is aligned by a single projection.
+  '''
+
+  HUDI_META_COLUMNS = ['_hoodie_commit_time', '_hoodie_commit_seqno', '_hoodie_record_key', '_hoodie_partition_path', '_hoodie_file_name']
+
+  def __init__(self, spark, table):
+    self.spark = spark
+    self.table = table
+    self._table_schema = None
+    self._is_table_schema_loaded = False
+    self._union_schemas = {}
+
+  def _tableSchema(self):
+    if not self._is_table_schema_loaded:
+      try:
+        table_df = self.spark.table(self.table).drop(*self.HUDI_META_COLUMNS)
+        self._table_schema = table_df.schema
+      except AnalysisException:
+        #XXX: The table is created (and synced to the catalog) by the first write.
+        self._table_schema = None
+      self._is_table_schema_loaded = True
+      self._union_schemas = {}
+    return self._table_schema
+
+  def unionSchema(self, incoming_schema):
+    '''The incoming columns followed by the table columns missing from them, with the types unionByName resolves'''
+    table_schema = self._tableSchema()
+    if table_schema is None or incoming_schema == table_schema:
+      return incoming_schema
+    fingerprint = hashlib.sha256(incoming_schema.json().encode('utf-8')).hexdigest()
+    if fingerprint not in self._union_schemas:
+      empty_df = self.spark.createDataFrame([], incoming_schema)
+      self._union_schemas[fingerprint] = empty_df.unionByName(
+        self.spark.createDataFrame([], table_schema), allowMissingColumns=True).schema
+    return self._union_schemas[fingerprint]
+
+  def evolve(self, data_frame):
+    '''Add the table columns missing from the micro-batch as nulls, so that Hudi does not drop them from the table'''
+    union_schema = self.unionSchema(data_frame.schema)
+    if union_schema == data_frame.schema:
+      return data_frame
+    incoming_columns = set(data_frame.columns)
+    return data_frame.select([(col(f.name) if f.name in incoming_columns else lit(None)).cast(f.dataType).alias(f.name)
+      for f in union_schema.fields])
+
+  def changesTable(self, schema) -> bool:
+    '''Whether writing `schema` creates the table or adds columns to it'''
+    table_schema = self._tableSchema()
+    return table_schema is None or bool(set(schema.names) - set(table_schema.names))
+
+  def afterWrite(self, written_schema):
+    #XXX: A write adding columns evolves the table schema, so read it again before the next micro-batch.
+    if self.changesTable(written_schema):
+      self._is_table_schema_loaded = False
+
+class HiveSyncSchedule:
+  '''Sync the Hudi table to the Data Catalog once every `interval_commits` writes instead of on every micro-batch
+
+  A write creating the table or adding columns is always synced, so the catalog never misses them;
+  partitions added in between become visible in the catalog with the next sync.
+  '''
+
+  def __init__(self, interval_commits):
+    self.interval_commits = interval_commits
+    self._writes_since_sync = 0
+
+  def isDue(self, changes_table=False) -> bool:
+    return changes_table or self._writes_since_sync + 1 >= self.interval_commits
+
+  def recordWrite(self, synced):
+    self._writes_since_sync = 0 if synced else self._writes_since_sync + 1
+
+hive_sync_schedule = HiveSyncSchedule(hive_sync_interval_commits)
+
+schema_registry = HudiSchemaRegistry(spark, f"{database_name}.{hudi_table_name}")
+
+#XXX: The options of the Hudi datasource, i.e. the connector options without its class name and the table path.
+hudiDataSourceOptions = {k: v for k, v in combinedConf.items() if k not in ('className', 'path')}
 
 def processBatch(data_frame, batch_id):
-  
-  if data_frame.count() > 0:
-
-    kinesis_dynamic_frame = DynamicFrame.fromDF(data_frame, glueContext, "from_kinesis_data_frame")
-    kinesis_data_frame = kinesis_dynamic_frame.toDF()
-
-    kinesis_data_frame = evolveSchema(kinesis_data_frame, f"{database_name}.{hudi_table_name}", False)
-
-    glueContext.write_dynamic_frame.from_options(
-      frame = DynamicFrame.fromDF(kinesis_data_frame, glueContext, "evolved_kinesis_data_frame"),
-      connection_type = "custom.spark",
-      connection_options = combinedConf
-    )
-
-glueContext.forEachBatch(
-  frame = data_frame_DataSource0,
-  batch_function = processBatch,
-  options = {
-    "windowSize": window_size,
-    "checkpointLocation": s3_path_to_checkpoint
-  }
-)
+
+  if not isEmptyDataFrame(data_frame):
+    evolved_data_frame = schema_registry.evolve(data_frame)
+    hive_sync = hive_sync_schedule.isDue(schema_registry.changesTable(evolved_data_frame.schema))
+
+    #XXX: Write the DataFrame with the Hudi datasource of the connector,
+    # instead of converting it to a DynamicFrame and back for the connection writer.
+    evolved_data_frame.write.format("hudi") \
+      .options(**hudiDataSourceOptions) \
+      .option('hoodie.datasource.hive_sync.enable', 'true' if hive_sync else 'false') \
+      .mode("append") \
+      .save(s3_path_hudi)
+
+    hive_sync_schedule.recordWrite(hive_sync)
+    schema_registry.afterWrite(evolved_data_frame.schema)
+
+if adaptive_window:
+  controller = AdaptiveWindowController(parseWindowSizeSec(window_size),
+    int(args['adaptive_min_window_sec']),
+    int(args['adaptive_max_window_sec']),
+    int(args['adaptive_min_records_per_trigger']),
+    int(args['adaptive_max_records_per_trigger']),
+    target_utilization=float(args['adaptive_target_utilization']),
+    min_batch_rows=int(args['adaptive_min_batch_rows']))
+  runAdaptiveForEachBatch(createSourceDataFrame, processBatch, s3_path_to_checkpoint, controller)
+else:
+  glueContext.forEachBatch(
+    frame = createSourceDataFrame(),
+    batch_function = processBatch,
+    options = {
+      "windowSize": window_size,
+      "checkpointLocation": s3_path_to_checkpoint
+    }
+  )
 
 job.commit()
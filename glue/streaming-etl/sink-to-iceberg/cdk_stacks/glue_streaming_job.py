@@ -26,7 +26,8 @@ class GlueStreamingJobStack(Stack):
       "--enable-continuous-cloudwatch-log": "true",
       "--job-bookmark-option": "job-bookmark-disable",
       "--job-language": "python",
-      "--TempDir": f"s3://{glue_assets_s3_bucket_name}/temporary/"
+      "--TempDir": f"s3://{glue_assets_s3_bucket_name}/temporary/",
+      "--extra-py-files": f"s3://{glue_assets_s3_bucket_name}/scripts/streaming_batch_helpers.py,s3://{glue_assets_s3_bucket_name}/scripts/adaptive_window.py,s3://{glue_assets_s3_bucket_name}/scripts/iceberg_table_helpers.py,s3://{glue_assets_s3_bucket_name}/scripts/streaming_progress.py"
     }
 
     glue_job_default_arguments.update(glue_job_input_arguments)
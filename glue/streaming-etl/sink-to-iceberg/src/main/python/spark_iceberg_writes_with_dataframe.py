@@ -18,6 +18,8 @@ from pyspark.sql import DataFrame, Row
 from pyspark.sql.types import *
 from pyspark.sql.functions import *
 
+from streaming_batch_helpers import getOptionalResolvedOptions
+
 
 def get_kinesis_stream_name_from_arn(stream_arn):
   ARN_PATTERN = re.compile(r'arn:aws:kinesis:([a-z0-9-]+):(\d+):stream/([a-zA-Z0-9-_]+)')
@@ -37,6 +39,17 @@ args = getResolvedOptions(sys.argv, ['JOB_NAME',
   'window_size'
 ])
 
+args.update(getOptionalResolvedOptions(sys.argv, {
+  'lock_acquire_interval_ms': '',
+  'lock_acquire_timeout_ms': '',
+  'commit_retry_num_retries': '',
+  'commit_retry_min_wait_ms': '',
+  'commit_retry_max_wait_ms': '',
+  'commit_retry_total_timeout_ms': '',
+  'checkpoint_min_batches_to_retain': '',
+  'checkpoint_location': ''
+}))
+
 CATALOG = args['catalog']
 
 ICEBERG_S3_PATH = args['iceberg_s3_path']
@@ -54,6 +67,19 @@ STARTING_POSITION_OF_KINESIS_ITERATOR = args.get('starting_position_of_kinesis_i
 AWS_REGION = args['aws_region']
 WINDOW_SIZE = args.get('window_size', '100 seconds')
 
+#XXX: Empty values keep the defaults of Iceberg, i.e. the DynamoDB lock is tried every 5 seconds for up to 3 minutes,
+# and a commit that conflicts with another writer is retried 4 times, waiting from 100 ms up to 60 seconds in between.
+LOCK_ACQUIRE_PROPERTIES = {
+  'lock.acquire-interval-ms': args['lock_acquire_interval_ms'],
+  'lock.acquire-timeout-ms': args['lock_acquire_timeout_ms']
+}
+COMMIT_RETRY_PROPERTIES = {
+  'commit.retry.num-retries': args['commit_retry_num_retries'],
+  'commit.retry.min-wait-ms': args['commit_retry_min_wait_ms'],
+  'commit.retry.max-wait-ms': args['commit_retry_max_wait_ms'],
+  'commit.retry.total-timeout-ms': args['commit_retry_total_timeout_ms']
+}
+
 def setSparkIcebergConf() -> SparkConf:
   conf_list = [
     (f"spark.sql.catalog.{CATALOG}", "org.apache.iceberg.spark.SparkCatalog"),
@@ -65,6 +91,7 @@ def setSparkIcebergConf() -> SparkConf:
     ("spark.sql.extensions", "org.apache.iceberg.spark.extensions.IcebergSparkSessionExtensions"),
     ("spark.sql.iceberg.handle-timestamp-without-timezone", "true")
   ]
+  conf_list += [(f"spark.sql.catalog.{CATALOG}.{k}", v) for k, v in LOCK_ACQUIRE_PROPERTIES.items() if v]
   spark_conf = SparkConf().setAll(conf_list)
   return spark_conf
 
@@ -92,7 +119,26 @@ streaming_data_df = streaming_data \
     .withColumn('m_time', to_timestamp(col('m_time'), 'yyyy-MM-dd HH:mm:ss'))
 
 table_identifier = f"{CATALOG}.{DATABASE}.{TABLE_NAME}"
-checkpointPath = os.path.join(args["TempDir"], args["JOB_NAME"], "checkpoint/")
+#XXX: e.g., a checkpoint written by the checkpoint tool, to restart the job from other offsets
+checkpointPath = args['checkpoint_location'] or os.path.join(args["TempDir"], args["JOB_NAME"], "checkpoint/")
+
+#XXX: The checkpoint keeps the offsets and commits of the last `checkpoint_min_batches_to_retain` micro-batches
+# (Spark default: 100); fewer of them make the checkpoint smaller and faster to list when the job restarts.
+if args['checkpoint_min_batches_to_retain']:
+  spark.conf.set("spark.sql.streaming.minBatchesToRetain", args['checkpoint_min_batches_to_retain'])
+
+def setCommitRetryProperties(table_ident, retry_properties: dict):
+  #XXX: Commit retries are table properties, so they are set on the table once before streaming, not on every write.
+  retry_properties = {k: v for k, v in retry_properties.items() if v}
+  if not retry_properties:
+    return
+  properties = {row['key']: row['value'] for row in spark.sql(f"SHOW TBLPROPERTIES {table_ident}").collect()}
+  changed = {k: v for k, v in retry_properties.items() if properties.get(k) != v}
+  if changed:
+    table_properties = ', '.join([f"'{k}' = '{v}'" for k, v in changed.items()])
+    spark.sql(f"ALTER TABLE {table_ident} SET TBLPROPERTIES ({table_properties})")
+
+setCommitRetryProperties(table_identifier, COMMIT_RETRY_PROPERTIES)
 
 #XXX: Writing against partitioned table
 # https://iceberg.apache.org/docs/0.14.0/spark-structured-streaming/#writing-against-partitioned-table
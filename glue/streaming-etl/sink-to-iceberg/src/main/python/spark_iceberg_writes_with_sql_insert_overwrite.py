@@ -2,6 +2,7 @@
 # -*- encoding: utf-8 -*-
 # vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
 
+import functools
 import os
 import sys
 import traceback
@@ -15,14 +16,27 @@ from awsglue import DynamicFrame
 
 from pyspark.conf import SparkConf
 from pyspark.sql import DataFrame, Row
-from pyspark.sql.window import Window
+from pyspark.sql.utils import AnalysisException
 from pyspark.sql.functions import (
   col,
-  desc,
-  row_number,
   to_timestamp
 )
 
+from streaming_batch_helpers import (
+  isEmptyDataFrame,
+  dedupLatest,
+  getOptionalResolvedOptions,
+  loadPayloadSchema,
+  createParsedSourceDataFrame,
+  processExplicitSchemaBatch
+)
+from adaptive_window import AdaptiveWindowController, parseWindowSizeSec, runAdaptiveForEachBatch
+from iceberg_table_helpers import (
+  TableMetadataCache,
+  IcebergTableMaintenance,
+  IcebergCommitMonitor,
+  IcebergIdempotentWriter
+)
 
 args = getResolvedOptions(sys.argv, ['JOB_NAME',
   'catalog',
@@ -37,6 +51,38 @@ args = getResolvedOptions(sys.argv, ['JOB_NAME',
   'window_size'
 ])
 
+args.update(getOptionalResolvedOptions(sys.argv, {
+  'metadata_cache_ttl_sec': '300',
+  'adaptive_window': 'false',
+  'adaptive_min_window_sec': '30',
+  'adaptive_max_window_sec': '300',
+  'adaptive_min_records_per_trigger': '10000',
+  'adaptive_max_records_per_trigger': '1000000',
+  'adaptive_target_utilization': '0.8',
+  'adaptive_min_batch_rows': '1000',
+  'maintenance_interval_batches': '0',
+  'maintenance_target_file_size_bytes': '134217728',
+  'maintenance_min_small_files': '20',
+  'maintenance_max_manifests': '50',
+  'maintenance_snapshot_retention_hours': '24',
+  'maintenance_retain_last_snapshots': '10',
+  'maintenance_orphan_file_retention_hours': '72',
+  'maintenance_orphan_files_every_n_runs': '24',
+  'schema_mode': 'infer',
+  'dead_letter_s3_path': '',
+  'dedup_watermark_delay': '',
+  'lock_acquire_interval_ms': '',
+  'lock_acquire_timeout_ms': '',
+  'commit_retry_num_retries': '',
+  'commit_retry_min_wait_ms': '',
+  'commit_retry_max_wait_ms': '',
+  'commit_retry_total_timeout_ms': '',
+  'commit_monitor': 'false',
+  'checkpoint_min_batches_to_retain': '',
+  'checkpoint_location': '',
+  'idempotent_writes': 'false'
+}))
+
 CATALOG = args['catalog']
 ICEBERG_S3_PATH = args['iceberg_s3_path']
 DATABASE = args['database_name']
@@ -48,6 +94,30 @@ KINESIS_STREAM_ARN = args['kinesis_stream_arn']
 STARTING_POSITION_OF_KINESIS_ITERATOR = args.get('starting_position_of_kinesis_iterator', 'LATEST')
 AWS_REGION = args['aws_region']
 WINDOW_SIZE = args.get('window_size', '100 seconds')
+METADATA_CACHE_TTL_SEC = int(args['metadata_cache_ttl_sec'])
+ADAPTIVE_WINDOW = args['adaptive_window'].lower() == 'true'
+MAINTENANCE_INTERVAL_BATCHES = int(args['maintenance_interval_batches'])
+#XXX: schema_mode: ['infer', 'explicit']
+SCHEMA_MODE = args['schema_mode']
+DEAD_LETTER_S3_PATH = args['dead_letter_s3_path'] or os.path.join(args["TempDir"], args["JOB_NAME"], "dead_letter/")
+#XXX: e.g., '10 minutes'; cross-batch de-duplication needs schema_mode 'explicit'
+DEDUP_WATERMARK_DELAY = args['dedup_watermark_delay']
+IDEMPOTENT_WRITES = args['idempotent_writes'].lower() == 'true'
+
+#XXX: Empty values keep the defaults of Iceberg, i.e. the DynamoDB lock is tried every 5 seconds for up to 3 minutes,
+# and a commit that conflicts with another writer is retried 4 times, waiting from 100 ms up to 60 seconds in between.
+LOCK_ACQUIRE_PROPERTIES = {
+  'lock.acquire-interval-ms': args['lock_acquire_interval_ms'],
+  'lock.acquire-timeout-ms': args['lock_acquire_timeout_ms']
+}
+COMMIT_RETRY_PROPERTIES = {
+  'commit.retry.num-retries': args['commit_retry_num_retries'],
+  'commit.retry.min-wait-ms': args['commit_retry_min_wait_ms'],
+  'commit.retry.max-wait-ms': args['commit_retry_max_wait_ms'],
+  'commit.retry.total-timeout-ms': args['commit_retry_total_timeout_ms']
+}
+#XXX: 'true' logs the commits and commit contention of every micro-batch as an `iceberg_commit_contention` JSON line
+COMMIT_MONITOR = args['commit_monitor'].lower() == 'true'
 
 def setSparkIcebergConf() -> SparkConf:
   conf_list = [
@@ -60,6 +130,7 @@ def setSparkIcebergConf() -> SparkConf:
     ("spark.sql.extensions", "org.apache.iceberg.spark.extensions.IcebergSparkSessionExtensions"),
     ("spark.sql.iceberg.handle-timestamp-without-timezone", "true")
   ]
+  conf_list += [(f"spark.sql.catalog.{CATALOG}.{k}", v) for k, v in LOCK_ACQUIRE_PROPERTIES.items() if v]
   spark_conf = SparkConf().setAll(conf_list)
   return spark_conf
 
@@ -71,56 +142,142 @@ spark = glueContext.spark_session
 job = Job(glueContext)
 job.init(args['JOB_NAME'], args)
 
-kds_df = glueContext.create_data_frame.from_options(
-  connection_type="kinesis",
-  connection_options={
-    "typeOfData": "kinesis",
-    "streamARN": KINESIS_STREAM_ARN,
-    "classification": "json",
-    "startingPosition": f"{STARTING_POSITION_OF_KINESIS_ITERATOR}",
-    "inferSchema": "true",
-  },
-  transformation_ctx="kds_df",
-)
+kds_options = {
+  "typeOfData": "kinesis",
+  "streamARN": KINESIS_STREAM_ARN,
+  "classification": "json",
+  "startingPosition": f"{STARTING_POSITION_OF_KINESIS_ITERATOR}",
+  "inferSchema": "true",
+}
+
+def createSourceDataFrame(max_records_per_trigger=None):
+  connection_options = {**kds_options, "maxFetchRecordsPerShard": str(max_records_per_trigger)} \
+    if max_records_per_trigger else kds_options
+  return glueContext.create_data_frame.from_options(
+    connection_type="kinesis",
+    connection_options=connection_options,
+    transformation_ctx="kds_df",
+  )
+
+#XXX: The options of the Spark Kinesis source, which reads the records as they are for --schema_mode explicit
+raw_reader_options = {
+  "streamName": KINESIS_STREAM_ARN.split('/')[-1],
+  "endpointUrl": f"https://kinesis.{AWS_REGION}.amazonaws.com",
+  "startingPosition": f"{STARTING_POSITION_OF_KINESIS_ITERATOR}"
+}
+
+table_metadata = TableMetadataCache(spark, CATALOG, DATABASE, TABLE_NAME, METADATA_CACHE_TTL_SEC)
+
+table_maintenance = IcebergTableMaintenance(spark, CATALOG, DATABASE, TABLE_NAME, MAINTENANCE_INTERVAL_BATCHES,
+  target_file_size_bytes=int(args['maintenance_target_file_size_bytes']),
+  min_small_files=int(args['maintenance_min_small_files']),
+  max_manifests=int(args['maintenance_max_manifests']),
+  snapshot_retention_hours=int(args['maintenance_snapshot_retention_hours']),
+  retain_last_snapshots=int(args['maintenance_retain_last_snapshots']),
+  orphan_file_retention_hours=int(args['maintenance_orphan_file_retention_hours']),
+  orphan_files_every_n_runs=int(args['maintenance_orphan_files_every_n_runs']))
+
+commit_monitor = IcebergCommitMonitor(spark, f"{CATALOG}.{DATABASE}.{TABLE_NAME}", COMMIT_RETRY_PROPERTIES,
+  enabled=COMMIT_MONITOR)
+
+def insertOverwriteBatch(stream_data_dynf, table_columns, batch_id):
+  # Apply De-duplication logic on input data to pick up the latest record based on timestamp and operation
+  stream_data_df = stream_data_dynf.toDF()
+  stream_data_df = stream_data_df.withColumn('m_time', to_timestamp(col('m_time'), 'yyyy-MM-dd HH:mm:ss'))
+  upsert_data_df = dedupLatest(stream_data_df, PRIMARY_KEY, 'm_time', table_columns)
+
+  upsert_data_df.createOrReplaceTempView(f"{TABLE_NAME}_upsert")
+  # print(f"Table '{TABLE_NAME}' is upserting...")
+
+  sql_query = f"""
+  INSERT OVERWRITE {CATALOG}.{DATABASE}.{TABLE_NAME} SELECT * FROM {TABLE_NAME}_upsert
+  """
+  try:
+    if IDEMPOTENT_WRITES:
+      #XXX: The same overwrite as the INSERT OVERWRITE statement, with the batch id in its snapshot summary.
+      idempotent_writer.overwrite(upsert_data_df, batch_id)
+    else:
+      spark.sql(sql_query)
+  except Exception as ex:
+    traceback.print_exc()
+    raise ex
 
 def processBatch(data_frame, batch_id):
-  if data_frame.count() > 0:
+  if not isEmptyDataFrame(data_frame):
     stream_data_dynf = DynamicFrame.fromDF(
       data_frame, glueContext, "from_data_frame"
     )
 
-    _df = spark.sql(f"SELECT * FROM {CATALOG}.{DATABASE}.{TABLE_NAME} LIMIT 0")
+    if not table_metadata.exists():
+      print(f"Table {TABLE_NAME} doesn't exist in {CATALOG}.{DATABASE}.")
+    elif IDEMPOTENT_WRITES and idempotent_writer.isCommitted(batch_id):
+      idempotent_writer.reportSkipped(batch_id)
+    else:
+      if commit_monitor.enabled:
+        commit_monitor.start()
+      else:
+        commit_monitor.configure()
+      try:
+        insertOverwriteBatch(stream_data_dynf, table_metadata.columns(), batch_id)
+      except AnalysisException as ex:
+        #XXX: The cached table schema might be stale (e.g., the table has been altered),
+        # so reload it from the catalog and retry the batch once.
+        table_metadata.invalidate()
+        if not table_metadata.exists():
+          #XXX: The table has been dropped, so there is no schema to retry with; raise the original error.
+          raise ex
+        insertOverwriteBatch(stream_data_dynf, table_metadata.columns(), batch_id)
+      if commit_monitor.enabled:
+        commit_monitor.stop()
+        commit_monitor.report(batch_id)
 
-    # Apply De-duplication logic on input data to pick up the latest record based on timestamp and operation
-    window = Window.partitionBy(PRIMARY_KEY).orderBy(desc("m_time"))
-    stream_data_df = stream_data_dynf.toDF()
-    stream_data_df = stream_data_df.withColumn('m_time', to_timestamp(col('m_time'), 'yyyy-MM-dd HH:mm:ss'))
-    upsert_data_df = stream_data_df.withColumn("row", row_number().over(window)) \
-      .filter(col("row") == 1).drop("row") \
-      .select(_df.schema.names)
+  #XXX: Run the table maintenance between micro-batches, so that it never conflicts with the writes of this job.
+  if table_maintenance.isDue(batch_id) and table_metadata.exists():
+    table_maintenance.run()
 
-    upsert_data_df.createOrReplaceTempView(f"{TABLE_NAME}_upsert")
-    # print(f"Table '{TABLE_NAME}' is upserting...")
 
-    sql_query = f"""
-    INSERT OVERWRITE {CATALOG}.{DATABASE}.{TABLE_NAME} SELECT * FROM {TABLE_NAME}_upsert
-    """
-    try:
-      spark.sql(sql_query)
-    except Exception as ex:
-      traceback.print_exc()
-      raise ex
+#XXX: e.g., a checkpoint written by the checkpoint tool, to restart the job from other offsets
+checkpointPath = args['checkpoint_location'] or os.path.join(args["TempDir"], args["JOB_NAME"], "checkpoint/")
 
+#XXX: The checkpoint location tells the snapshots of this job from those of other jobs, and of its earlier checkpoints.
+idempotent_writer = IcebergIdempotentWriter(spark, f"{CATALOG}.{DATABASE}.{TABLE_NAME}", checkpointPath)
 
-checkpointPath = os.path.join(args["TempDir"], args["JOB_NAME"], "checkpoint/")
+#XXX: The checkpoint keeps the offsets and commits of the last `checkpoint_min_batches_to_retain` micro-batches
+# (Spark default: 100); fewer of them make the checkpoint smaller and faster to list when the job restarts.
+if args['checkpoint_min_batches_to_retain']:
+  spark.conf.set("spark.sql.streaming.minBatchesToRetain", args['checkpoint_min_batches_to_retain'])
 
-glueContext.forEachBatch(
-  frame=kds_df,
-  batch_function=processBatch,
-  options={
-    "windowSize": WINDOW_SIZE,
-    "checkpointLocation": checkpointPath,
-  }
-)
+if DEDUP_WATERMARK_DELAY and SCHEMA_MODE != 'explicit':
+  raise ValueError("--dedup_watermark_delay requires --schema_mode explicit")
+
+if SCHEMA_MODE == 'explicit':
+  #XXX: Derive the payload schema once from the table instead of inferring it on every micro-batch.
+  payload_schema = loadPayloadSchema(spark, f"{CATALOG}.{DATABASE}.{TABLE_NAME}")
+  create_source_data_frame = functools.partial(createParsedSourceDataFrame, spark, 'kinesis', raw_reader_options, payload_schema,
+    dedup_key=col(f'_parsed.{PRIMARY_KEY}'),
+    dedup_event_time=to_timestamp(col('_parsed.m_time'), 'yyyy-MM-dd HH:mm:ss'),
+    dedup_watermark_delay=DEDUP_WATERMARK_DELAY)
+  batch_function = functools.partial(processExplicitSchemaBatch, process_batch=processBatch, dead_letter_s3_path=DEAD_LETTER_S3_PATH)
+else:
+  create_source_data_frame, batch_function = createSourceDataFrame, processBatch
+
+if ADAPTIVE_WINDOW:
+  controller = AdaptiveWindowController(parseWindowSizeSec(WINDOW_SIZE),
+    int(args['adaptive_min_window_sec']),
+    int(args['adaptive_max_window_sec']),
+    int(args['adaptive_min_records_per_trigger']),
+    int(args['adaptive_max_records_per_trigger']),
+    target_utilization=float(args['adaptive_target_utilization']),
+    min_batch_rows=int(args['adaptive_min_batch_rows']))
+  runAdaptiveForEachBatch(create_source_data_frame, batch_function, checkpointPath, controller)
+else:
+  glueContext.forEachBatch(
+    frame=create_source_data_frame(),
+    batch_function=batch_function,
+    options={
+      "windowSize": WINDOW_SIZE,
+      "checkpointLocation": checkpointPath,
+    }
+  )
 
 job.commit()
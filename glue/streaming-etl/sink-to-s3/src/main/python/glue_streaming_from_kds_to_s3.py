@@ -2,9 +2,14 @@
 # -*- encoding: utf-8 -*-
 # vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
 
+import boto3
+import datetime
+import json
+import math
 import os
 import sys
-import datetime
+import time
+import traceback
 
 from pyspark.sql import DataFrame, Row
 from pyspark.context import SparkContext
@@ -13,10 +18,11 @@ from pyspark.sql.functions import *
 
 from awsglue.transforms import *
 from awsglue.utils import getResolvedOptions
-from pyspark.context import SparkContext
 from awsglue.context import GlueContext
 from awsglue.job import Job
-from awsglue import DynamicFrame
+
+from streaming_batch_helpers import isEmptyDataFrame, getOptionalResolvedOptions
+from adaptive_window import AdaptiveWindowController, parseWindowSizeSec, runAdaptiveForEachBatch
 
 
 args = getResolvedOptions(sys.argv, [
@@ -28,6 +34,24 @@ args = getResolvedOptions(sys.argv, [
   'stream_starting_position'
 ])
 
+args.update(getOptionalResolvedOptions(sys.argv, {
+  'adaptive_window': 'false',
+  'adaptive_min_window_sec': '30',
+  'adaptive_max_window_sec': '300',
+  'adaptive_min_records_per_trigger': '10000',
+  'adaptive_max_records_per_trigger': '1000000',
+  'adaptive_target_utilization': '0.8',
+  'adaptive_min_batch_rows': '1000',
+  'schema_mode': 'infer',
+  'partition_time': 'ingest',
+  'compression_codec': 'snappy',
+  'target_file_size_mb': '128',
+  'output_database': '',
+  'output_table_name': '',
+  'checkpoint_min_batches_to_retain': '',
+  'checkpoint_location': ''
+}))
+
 sc = SparkContext()
 glueContext = GlueContext(sc)
 spark = glueContext.spark_session
@@ -42,44 +66,203 @@ aws_region = args['aws_region']
 output_path = args['output_path']
 
 s3_target = os.path.join(output_path, "ventilator_metrics")
-checkpoint_location = os.path.join(output_path, "cp/")
+#XXX: e.g., a checkpoint written by the checkpoint tool, to restart the job from other offsets
+checkpoint_location = args['checkpoint_location'] or os.path.join(output_path, "cp/")
 temp_path = os.path.join(output_path, "temp/")
 
+#XXX: The checkpoint keeps the offsets and commits of the last `checkpoint_min_batches_to_retain` micro-batches
+# (Spark default: 100); fewer of them make the checkpoint smaller and faster to list when the job restarts.
+if args['checkpoint_min_batches_to_retain']:
+  spark.conf.set("spark.sql.streaming.minBatchesToRetain", args['checkpoint_min_batches_to_retain'])
+
+adaptive_window = args['adaptive_window'].lower() == 'true'
+#XXX: schema_mode: ['infer', 'explicit']
+# 'explicit' parses the records against the columns of the Data Catalog table instead of inferring a schema on every micro-batch.
+schema_mode = args['schema_mode']
+
+#XXX: partition_time: ['ingest', 'event']
+# 'event' partitions the output by the hour of `eventtime` instead of the hour the micro-batch was processed,
+# so that queries over a time range of the metrics prune partitions.
+partition_time = args['partition_time']
+if partition_time not in ('ingest', 'event'):
+  raise ValueError(f"Unsupported partition_time: {partition_time}")
+partition_columns = [f"{partition_time}_{e}" for e in ('year', 'month', 'day', 'hour')]
+compression_codec = args['compression_codec']
+target_file_bytes = int(args['target_file_size_mb']) * 1024 * 1024
+
+#XXX: The Data Catalog table over `s3_target` (e.g. the table created in Athena) to add new partitions to.
+output_database = args['output_database'] or database
+output_table_name = args['output_table_name']
+
+def toOutputDataFrame(data_frame, ingest_time):
+  '''Cast the records to the output schema and add the partition columns'''
+  eventtime = to_timestamp(col('eventtime'))
+  #XXX: Records without a valid `eventtime` fall into the partition of their ingest time.
+  partition_timestamp = lit(ingest_time) if partition_time == 'ingest' else coalesce(eventtime, lit(ingest_time))
+  return data_frame.select(
+    col('ventilatorid').cast('long').alias('ventilatorid'),
+    eventtime.alias('eventtime'),
+    col('serialnumber').cast('string').alias('serialnumber'),
+    col('pressurecontrol').cast('long').alias('pressurecontrol'),
+    col('o2stats').cast('long').alias('o2stats'),
+    col('minutevolume').cast('long').alias('minutevolume'),
+    col('manufacturer').cast('string').alias('manufacturer'),
+    *[date_format(partition_timestamp, fmt).alias(name) for name, fmt in zip(partition_columns, ['yyyy', 'MM', 'dd', 'HH'])])
+
+def partitionLocation(values) -> str:
+  return s3_target + '/' + '/'.join([f"{name}={value}" for name, value in zip(partition_columns, values)]) + '/'
+
+class OutputFileSizer:
+  '''Cap the rows per output file, so that the files of a partition grow towards `target_file_bytes`
+
+  Every partition of a micro-batch is written by a single task, i.e. to a single file,
+  until it holds more rows than fit in a file of the target size. The bytes per row are learnt
+  from the files that the previous micro-batches wrote to their largest partitions.
+  '''
+
+  def __init__(self, spark, target_file_bytes, sample_partitions=4):
+    self.spark = spark
+    self.target_file_bytes = target_file_bytes
+    self.sample_partitions = sample_partitions
+    self.row_bytes = None
+
+  def maxRecordsPerFile(self) -> int:
+    #XXX: 0 means no limit, until the bytes per row are known.
+    return int(self.target_file_bytes // self.row_bytes) if self.row_bytes else 0
+
+  def _writtenBytes(self, location, written_after_ms) -> int:
+    path = self.spark._jvm.org.apache.hadoop.fs.Path(location)
+    fs = path.getFileSystem(self.spark._jsc.hadoopConfiguration())
+    return int(math.fsum([status.getLen() for status in fs.listStatus(path)
+      if status.isFile() and status.getPath().getName().startswith('part-') and status.getModificationTime() >= written_after_ms]))
+
+  def observe(self, partition_rows, written_after_ms):
+    '''Learn the bytes per row from the files written to the largest partitions of a micro-batch'''
+    sampled = sorted(partition_rows, key=lambda e: e[1], reverse=True)[:self.sample_partitions]
+    rows = math.fsum([e[1] for e in sampled])
+    written_bytes = math.fsum([self._writtenBytes(location, written_after_ms) for location, _ in sampled])
+    if rows > 0 and written_bytes > 0:
+      row_bytes = written_bytes / rows
+      self.row_bytes = row_bytes if self.row_bytes is None else (self.row_bytes + row_bytes) / 2
+
+class CatalogPartitionRegistry:
+  '''Add the partitions written by micro-batches to a Data Catalog table,
+  so that queries prune them without `MSCK REPAIR TABLE`'''
+
+  #XXX: BatchCreatePartition takes at most 100 partitions per call.
+  MAX_PARTITIONS_PER_CALL = 100
+
+  def __init__(self, glue_client, database, table_name, partition_columns):
+    self.glue_client = glue_client
+    self.database = database
+    self.table_name = table_name
+    self.partition_columns = partition_columns
+    self._registered = set()
+    #XXX: Partitions that failed to be added, by their values, to be tried again with the next micro-batch.
+    self._pending = {}
+
+    table = glue_client.get_table(DatabaseName=database, Name=table_name)['Table']
+    partition_keys = [e['Name'] for e in table.get('PartitionKeys', [])]
+    if partition_keys != partition_columns:
+      raise ValueError(f"The partition keys of {database}.{table_name} {partition_keys} do not match {partition_columns}")
+    self._storage_descriptor = table['StorageDescriptor']
+
+  def register(self, partitions) -> dict:
+    '''Add the partitions, given as (values, location), that are not in the table yet'''
+    self._pending.update({values: location for values, location in partitions if values not in self._registered})
+    new_partitions = list(self._pending.items())
+    report = {'partitions_added': 0, 'partitions_failed': 0}
+    try:
+      for i in range(0, len(new_partitions), self.MAX_PARTITIONS_PER_CALL):
+        chunk = new_partitions[i:i + self.MAX_PARTITIONS_PER_CALL]
+        response = self.glue_client.batch_create_partition(
+          DatabaseName=self.database,
+          TableName=self.table_name,
+          PartitionInputList=[{'Values': list(values), 'StorageDescriptor': {**self._storage_descriptor, 'Location': location}} for values, location in chunk])
+        errors = response.get('Errors', [])
+        #XXX: Partitions added before a restart of the job, or by hand, come back as AlreadyExistsException.
+        failed = set([tuple(e['PartitionValues']) for e in errors if e['ErrorDetail']['ErrorCode'] != 'AlreadyExistsException'])
+        for e in errors:
+          if tuple(e['PartitionValues']) in failed:
+            print(json.dumps({'event': 'catalog_partition_error', 'values': e['PartitionValues'], **e['ErrorDetail']}))
+        for values, _ in chunk:
+          if values not in failed:
+            self._registered.add(values)
+            del self._pending[values]
+        report['partitions_added'] += len(chunk) - len(errors)
+        report['partitions_failed'] += len(failed)
+    except Exception as ex:
+      #XXX: The data is already written, so a failure to add its partitions should not stop the stream.
+      traceback.print_exc()
+      report['error'] = str(ex)
+    report['partitions_pending'] = len(self._pending)
+    return report
+
+file_sizer = OutputFileSizer(spark, target_file_bytes)
+partition_registry = CatalogPartitionRegistry(boto3.client('glue', region_name=aws_region),
+  output_database, output_table_name, partition_columns) if output_table_name else None
+
 def processBatch(data_frame, batchId):
-  _now = datetime.datetime.now()
-
-  year, month, day, hour = (_now.year, _now.month, _now.day, _now.hour)
-  partition = f"/ingest_year={year:0>4}/ingest_month={month:0>2}/ingest_day={day:0>2}/ingest_hour={hour:0>2}/"
-
-  if (data_frame.count() > 0):
-    dynamic_frame = DynamicFrame.fromDF(data_frame, glueContext, "from_data_frame")
-    apply_mapping = ApplyMapping.apply(frame=dynamic_frame, mappings = [
-      ("ventilatorid", "long", "ventilatorid", "long"),
-      ("eventtime", "string", "eventtime", "timestamp"),
-      ("serialnumber", "string", "serialnumber", "string"),
-      ("pressurecontrol", "long", "pressurecontrol", "long"),
-      ("o2stats", "long", "o2stats", "long"),
-      ("minutevolume", "long", "minutevolume", "long"),
-      ("manufacturer", "string", "manufacturer", "string")],
-      transformation_ctx = "apply_mapping")
-
-    # Write to S3 Sink
-    s3path = s3_target + partition
-    s3sink = glueContext.write_dynamic_frame.from_options(frame=apply_mapping, connection_type="s3",
-      connection_options={"path": s3path}, format="parquet", transformation_ctx="s3sink")
+  if isEmptyDataFrame(data_frame):
+    return
+
+  start_time = time.monotonic()
+  output_df = toOutputDataFrame(data_frame, datetime.datetime.now()).persist()
+  partition_rows = [(tuple([row[e] for e in partition_columns]), row['count'])
+    for row in output_df.groupBy(*partition_columns).count().collect()]
+
+  max_records_per_file = file_sizer.maxRecordsPerFile()
+  written_after_ms = int(time.time() * 1000)
+  #XXX: Shuffle the rows of a partition into one task instead of writing a file per partition from every task,
+  # so that each micro-batch adds as few and as large files as possible.
+  output_df.repartition(*partition_columns).write \
+    .mode("append") \
+    .partitionBy(*partition_columns) \
+    .option("compression", compression_codec) \
+    .option("maxRecordsPerFile", max_records_per_file) \
+    .parquet(s3_target)
+  output_df.unpersist()
+
+  file_sizer.observe([(partitionLocation(values), rows) for values, rows in partition_rows], written_after_ms)
+  report = {
+    'event': 'ventilator_metrics_write',
+    'batch_id': batchId,
+    'rows': int(math.fsum([rows for _, rows in partition_rows])),
+    'partitions': len(partition_rows),
+    'max_records_per_file': max_records_per_file,
+    'row_bytes': file_sizer.row_bytes,
+    'elapsed_sec': time.monotonic() - start_time
+  }
+  if partition_registry:
+    report.update(partition_registry.register([(values, partitionLocation(values)) for values, _ in partition_rows]))
+  print(json.dumps(report))
 
 # Read from Kinesis Data Stream
-sourceData = glueContext.create_data_frame.from_catalog(
-  database = database,
-  table_name = table_name,
-  transformation_ctx = "datasource1",
-  additional_options = {"startingPosition": stream_starting_position, "inferSchema": "true"})
-
-glueContext.forEachBatch(frame=sourceData,
-  batch_function=processBatch,
-  options = {
-    "windowSize": "100 seconds",
-    "checkpointLocation": checkpoint_location
-  })
+def createSourceDataFrame(max_records_per_trigger=None):
+  additional_options = {"startingPosition": stream_starting_position, "inferSchema": "false" if schema_mode == 'explicit' else "true"}
+  if max_records_per_trigger:
+    additional_options["maxFetchRecordsPerShard"] = str(max_records_per_trigger)
+  return glueContext.create_data_frame.from_catalog(
+    database = database,
+    table_name = table_name,
+    transformation_ctx = "datasource1",
+    additional_options = additional_options)
+
+if adaptive_window:
+  controller = AdaptiveWindowController(parseWindowSizeSec("100 seconds"),
+    int(args['adaptive_min_window_sec']),
+    int(args['adaptive_max_window_sec']),
+    int(args['adaptive_min_records_per_trigger']),
+    int(args['adaptive_max_records_per_trigger']),
+    target_utilization=float(args['adaptive_target_utilization']),
+    min_batch_rows=int(args['adaptive_min_batch_rows']))
+  runAdaptiveForEachBatch(createSourceDataFrame, processBatch, checkpoint_location, controller)
+else:
+  glueContext.forEachBatch(frame=createSourceDataFrame(),
+    batch_function=processBatch,
+    options = {
+      "windowSize": "100 seconds",
+      "checkpointLocation": checkpoint_location
+    })
 
 job.commit()